@@ -0,0 +1,113 @@
+from array import array
+
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex
+
+from models import MOVE
+
+
+def format_action(action):
+    return (f"{action.type}: {action.button if action.button else ''} "
+            f"{'x=' + str(action.x) + ' y=' + str(action.y) if action.x is not None else ''} "
+            f"{'scroll=' + str(action.scroll_amount) if action.scroll_amount is not None else ''} "
+            f"delay={action.delay}")
+
+
+def _narrower(types, area, old_types, old_area):
+    # True when everything matching (types, area) also matches the old filter
+    if old_types is not None and (types is None or not set(types) <= set(old_types)):
+        return False
+    if old_area is not None:
+        if area is None:
+            return False
+        min_x, min_y, max_x, max_y = area
+        old_min_x, old_min_y, old_max_x, old_max_y = old_area
+        if min_x < old_min_x or min_y < old_min_y or max_x > old_max_x or max_y > old_max_y:
+            return False
+    return True
+
+
+class ActionListModel(QAbstractListModel):
+    # Presents an ActionTable to a view without building an item per
+    # action: rows are formatted only when the view asks for them. With a
+    # filter set, the model rows map to an array of table indices.
+    def __init__(self, table, parent=None):
+        super().__init__(parent)
+        self.table = table
+        self.types = None
+        self.area = None
+        self._rows = None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.table) if self._rows is None else len(self._rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        return format_action(self.table[self.source_row(index.row())])
+
+    def source_row(self, row):
+        return row if self._rows is None else self._rows[row]
+
+    def source_rows(self, rows=None):
+        # Table indices for the given model rows, or every visible row
+        if rows is None:
+            return range(len(self.table)) if self._rows is None else self._rows
+        if self._rows is None:
+            return rows
+        return array('l', (self._rows[row] for row in rows))
+
+    @property
+    def filtered(self):
+        return self._rows is not None
+
+    def set_filter(self, types=None, area=None):
+        # types is a collection of type codes, area is (min_x, min_y,
+        # max_x, max_y). A filter narrower than the current one only scans
+        # the rows that are already visible.
+        rows = None
+        if self._rows is not None and _narrower(types, area, self.types, self.area):
+            rows = self._rows
+        self.beginResetModel()
+        self.types = types
+        self.area = area
+        self._rows = self._apply(rows)
+        self.endResetModel()
+
+    def _apply(self, rows):
+        if self.types is not None:
+            rows = self.table.rows_of_type(self.types, rows)
+        if self.area is not None:
+            rows = self.table.rows_in_area(*self.area, rows)
+        return rows
+
+    def refresh(self):
+        # Re-run the filter from scratch after rows were added or removed
+        self.beginResetModel()
+        self._rows = self._apply(None)
+        self.endResetModel()
+
+    def rows_changed(self, first=0, last=None):
+        if last is None:
+            last = self.rowCount() - 1
+        if last >= first:
+            self.dataChanged.emit(self.index(first), self.index(last))
+
+    def shift_delays(self, amount, rows=None):
+        self.table.shift_delays(amount, self.source_rows(rows))
+        self.rows_changed()
+
+    def offset_positions(self, dx, dy, rows=None):
+        self.table.offset_positions(dx, dy, self.source_rows(rows))
+        self.rows_changed()
+
+    def delete_moves(self, rows=None):
+        if rows is None and self._rows is None:
+            doomed = self.table.rows_of_type((MOVE,))
+        else:
+            doomed = self.table.rows_of_type((MOVE,), self.source_rows(rows))
+        removed = self.table.delete_rows(doomed)
+        if removed:
+            self.refresh()
+        return removed
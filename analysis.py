@@ -0,0 +1,258 @@
+from bisect import bisect_right
+from collections import Counter
+from itertools import accumulate, compress
+
+from models import ActionTable, ACTION_TYPES, MOVE, CLICK, KEY_PRESS, KEY_RELEASE, SCROLL, CALL, NONE
+from plan import MIN_SPEED, MAX_SPEED, calls_unchanged
+
+# A dry run works out what playing a macro would do, on a virtual clock
+# and without injecting anything. Everything that touches every row is a
+# column operation (slices, sums, byte counts, accumulate and compress),
+# only key and click rows are walked one at a time, and pointer hot spots
+# come from a fixed number of samples of the virtual clock, so a million
+# actions take a fraction of a second.
+
+HOT_SPOT_SIZE = 50  # Pixels per side of a hot spot cell
+HOT_SPOTS = 5
+DWELL_SAMPLES = 10000
+
+# Type codes of the rows that carry a pointer position, as a translation
+# table that turns the type column into a compress() mask
+_POSITIONED = bytes(1 if code in (MOVE, CLICK) else 0 for code in range(256))
+_CLICKS = bytes(1 if code == CLICK else 0 for code in range(256))
+_KEYS = bytes(1 if code in (KEY_PRESS, KEY_RELEASE) else 0 for code in range(256))
+_SCROLLS = bytes(1 if code == SCROLL else 0 for code in range(256))
+
+
+def flatten(table, library=None, stack=(), calls=None):
+    # The table with its calls expanded in place the way action_rows plays
+    # them: the called macro's rows, then the call row for its delay
+    if not library or CALL not in table.types:
+        return table
+    flat = ActionTable()
+    start = 0
+    for row in table.rows_of_type((CALL,)):
+        value_id = table.buttons[row]
+        called = library.get(table.values[value_id]) if value_id >= 0 else None
+        if called is None or called in stack:
+            continue
+        if calls is not None:
+            calls.append((library, called.name, called, called.actions, called.actions.version))
+        flat.extend_table(table, start, row)
+        flat.extend_table(flatten(called.actions, called.library, stack + (called,), calls))
+        start = row
+    flat.extend_table(table, start)
+    return flat
+
+
+class MacroAnalysis:
+    # The result of a dry run. Times are in seconds of playback, after the
+    # macro's speed and gap cap; positions are screen pixels.
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}  # action type -> rows
+        self.runtime = 0.0  # One run
+        self.loops = 1  # 0 = until stopped
+        self.bbox = None
+        self.start = None  # First and last pointer positions
+        self.end = None
+        self.keys = {}  # key -> [presses, releases]
+        self.held = []  # (key, time pressed) of keys still down after a run
+        self.unmatched = Counter()  # key -> releases while it wasn't down
+        self.clicks = Counter()  # button -> clicks
+        self.scrolled = 0
+        self.longest_pause = (0.0, 0.0)  # (pause, time it starts)
+        self.hot_spots = []  # ((x, y) of the cell, share of the runtime the pointer is there)
+        self.click_spots = []  # ((x, y) of the cell, clicks in it)
+        # What the analysis was made from, see matches()
+        self.actions = None
+        self.version = None
+        self.speed = None
+        self.max_gap = None
+        self.repeat = None
+        self.calls = ()
+
+    def matches(self, macro):
+        return (self.actions is macro.actions and self.version == self.actions.version
+                and self.speed == macro.speed and self.max_gap == macro.max_gap
+                and self.repeat == macro.repeat and self.loops == (macro.loops if macro.repeat else 1)
+                and calls_unchanged(self.calls))
+
+    @property
+    def total_runtime(self):
+        # None when the macro repeats until stopped
+        return self.runtime * self.loops if self.loops else None
+
+    @property
+    def balanced(self):
+        return not self.held and not self.unmatched
+
+    def summary(self):
+        lines = []
+        count = sum(self.counts.values())
+        parts = [f"{rows} {name}" for name, rows in self.counts.items() if rows]
+        lines.append(f"{self.name}: {count} actions" + (f" ({', '.join(parts)})" if parts else ""))
+        runtime = f"Runtime {self.runtime:.3f}s per run"
+        if self.loops == 0:
+            runtime += ", repeats until stopped"
+        elif self.loops > 1:
+            runtime += f", {self.total_runtime:.3f}s for {self.loops} runs"
+        lines.append(runtime)
+        if self.bbox is not None:
+            min_x, min_y, max_x, max_y = self.bbox
+            lines.append(f"Region ({min_x}, {min_y}) to ({max_x}, {max_y}), "
+                         f"{max_x - min_x + 1} x {max_y - min_y + 1} px; "
+                         f"starts at {self.start}, ends at {self.end}")
+        else:
+            lines.append("Never moves the pointer")
+        pressed = len(self.keys)
+        if self.balanced:
+            lines.append(f"Keys: {pressed} used, every press released")
+        else:
+            lines.append(f"Keys: {pressed} used")
+            if self.held:
+                lines.append("Left down: " + ", ".join(f"{key} (pressed at {time:.3f}s)"
+                                                       for key, time in self.held))
+            if self.unmatched:
+                lines.append("Released while up: " + ", ".join(f"{key} x{count}"
+                                                               for key, count in self.unmatched.items()))
+        if self.clicks:
+            lines.append("Clicks: " + ", ".join(f"{button} x{count}" for button, count in self.clicks.most_common()))
+        if self.scrolled:
+            lines.append(f"Scrolls {self.scrolled} in all")
+        pause, at = self.longest_pause
+        if pause:
+            lines.append(f"Longest pause {pause:.3f}s at {at:.3f}s")
+        if self.hot_spots:
+            lines.append(f"Pointer rests most at ({HOT_SPOT_SIZE} px cells): "
+                         + ", ".join(f"({x}, {y}) {share:.1%}" for (x, y), share in self.hot_spots))
+        if self.click_spots:
+            lines.append(f"Clicks most at ({HOT_SPOT_SIZE} px cells): "
+                         + ", ".join(f"({x}, {y}) x{count}" for (x, y), count in self.click_spots))
+        return "\n".join(lines)
+
+
+def analyze(macro):
+    calls = []
+    table = flatten(macro.actions, macro.library, (macro,), calls)
+    analysis = MacroAnalysis(macro.name)
+    analysis.actions = macro.actions
+    analysis.version = macro.actions.version
+    analysis.speed = macro.speed
+    analysis.max_gap = macro.max_gap
+    analysis.repeat = macro.repeat
+    analysis.loops = macro.loops if macro.repeat else 1
+    analysis.calls = tuple(calls)
+    count = len(table)
+    if not count:
+        return analysis
+
+    types = table.types.tobytes()
+    analysis.counts = {name: types.count(code) for code, name in enumerate(ACTION_TYPES)}
+
+    # The virtual clock: delays capped the way the step compiler caps them,
+    # in milliseconds at speed 1, and the time each row ends
+    speed = min(max(macro.speed, MIN_SPEED), MAX_SPEED)
+    scale = 1.0 / (speed * 1000.0)
+    delays = table.delays
+    longest = max(delays)
+    pause_row = delays.index(longest)
+    if macro.max_gap and longest > macro.max_gap * speed:
+        limit = macro.max_gap * speed
+        delays = delays[:]
+        for row in [row for row, delay in enumerate(delays) if delay > limit]:
+            delays[row] = limit
+        longest = limit
+    ends = list(accumulate(delays))
+    analysis.runtime = ends[-1] * scale
+    if longest > 0:
+        analysis.longest_pause = (longest * scale, (ends[pause_row] - longest) * scale)
+
+    xs = table.xs
+    ys = table.ys
+    positioned = list(compress(range(count), types.translate(_POSITIONED)))
+    if positioned:
+        # Rows without a position hold NONE, which is never the largest
+        min_x = min(compress(xs, types.translate(_POSITIONED)))
+        min_y = min(compress(ys, types.translate(_POSITIONED)))
+        if min_x == NONE or min_y == NONE:
+            points = [(xs[row], ys[row]) for row in positioned if xs[row] != NONE and ys[row] != NONE]
+            positioned = [row for row in positioned if xs[row] != NONE and ys[row] != NONE]
+            if points:
+                min_x = min(x for x, _ in points)
+                min_y = min(y for _, y in points)
+    if positioned:
+        analysis.bbox = (min_x, min_y, max(xs), max(ys))
+        first = positioned[0]
+        last = positioned[-1]
+        analysis.start = (xs[first], ys[first])
+        analysis.end = (xs[last], ys[last])
+        analysis.hot_spots = _dwell_spots(ends, positioned, xs, ys)
+
+    values = table.values
+    buttons = table.buttons
+    clicks = Counter()
+    click_cells = Counter()
+    cell = HOT_SPOT_SIZE
+    for row in compress(range(count), types.translate(_CLICKS)):
+        value_id = buttons[row]
+        clicks[values[value_id] if value_id >= 0 else None] += 1
+        x = xs[row]
+        y = ys[row]
+        if x != NONE and y != NONE:
+            click_cells[x // cell, y // cell] += 1
+    analysis.clicks = clicks
+    analysis.click_spots = [((x * cell, y * cell), hits) for (x, y), hits in click_cells.most_common(HOT_SPOTS)]
+
+    # The virtual keyboard: which keys are down, and since which row
+    keys = analysis.keys
+    down = {}
+    for row in compress(range(count), types.translate(_KEYS)):
+        value_id = buttons[row]
+        if value_id < 0:
+            continue
+        key = values[value_id]
+        counts = keys.get(key)
+        if counts is None:
+            counts = keys[key] = [0, 0]
+        if types[row] == KEY_PRESS:
+            counts[0] += 1
+            if key not in down:
+                down[key] = row
+        else:
+            counts[1] += 1
+            if down.pop(key, None) is None:
+                analysis.unmatched[key] += 1
+    analysis.held = [(key, (ends[row] - delays[row]) * scale) for key, row in down.items()]
+
+    if analysis.counts['scroll']:
+        analysis.scrolled = sum(amount for amount in compress(table.scrolls, types.translate(_SCROLLS))
+                                if amount != NONE)
+    return analysis
+
+
+def _dwell_spots(ends, positioned, xs, ys):
+    # Where the pointer rests longest, from its position at evenly spaced
+    # moments of the virtual clock
+    runtime = ends[-1]
+    if runtime <= 0:
+        last = positioned[-1]
+        return [((xs[last] // HOT_SPOT_SIZE * HOT_SPOT_SIZE, ys[last] // HOT_SPOT_SIZE * HOT_SPOT_SIZE), 1)]
+    cell = HOT_SPOT_SIZE
+    cells = Counter()
+    step = runtime / DWELL_SAMPLES
+    for sample in range(DWELL_SAMPLES):
+        # The row playing at this moment, then the last position set by then
+        row = bisect_right(ends, (sample + 0.5) * step)
+        index = bisect_right(positioned, row) - 1
+        if index >= 0:
+            row = positioned[index]
+            cells[xs[row] // cell, ys[row] // cell] += 1
+    return [((x * cell, y * cell), samples / DWELL_SAMPLES) for (x, y), samples in cells.most_common(HOT_SPOTS)]
+
+
+def get_analysis(macro):
+    analysis = macro.analysis
+    if analysis is None or not analysis.matches(macro):
+        analysis = macro.analysis = analyze(macro)
+    return analysis
@@ -0,0 +1,269 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from models import Profile, Macro, ActionTable, MOVE, CLICK
+from playback import MacroScheduler
+from plan import PynputInjector
+from recording import Recorder
+from storage import ProfileStore
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+DEFAULT_DELAYS = (0.5, 1, 5, 10)  # Zero delays would collapse into a single plan step
+DRAIN_INTERVAL = 0.02  # Same as the GUI's record timer
+
+
+class FakeMouse:
+    # Stands in for pynput's mouse Controller and timestamps every call
+    def __init__(self):
+        self._position = (0, 0)
+        self.times = []
+        self.calls = 0
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self.times.append(time.perf_counter())
+        self._position = value
+        self.calls += 1
+
+    def click(self, button, count=1):
+        self.times.append(time.perf_counter())
+        self.calls += 1
+
+    def scroll(self, dx, dy):
+        self.times.append(time.perf_counter())
+        self.calls += 1
+
+
+class FakeKeyboard:
+    def __init__(self):
+        self.times = []
+        self.calls = 0
+
+    def press(self, key):
+        self.times.append(time.perf_counter())
+        self.calls += 1
+
+    def release(self, key):
+        self.times.append(time.perf_counter())
+        self.calls += 1
+
+
+class FakeListener(threading.Thread):
+    # Plays the part of a pynput listener: calls the given callbacks from
+    # its own thread as fast as they return
+    def __init__(self, events, on_move, on_click):
+        super().__init__(daemon=True)
+        self.events = events
+        self.on_move = on_move
+        self.on_click = on_click
+        self.elapsed = 0.0
+
+    def run(self):
+        on_move = self.on_move
+        on_click = self.on_click
+        start = time.perf_counter()
+        for x, y, button in self.events:
+            if button is None:
+                on_move(x, y)
+            else:
+                on_click(x, y, button, True)
+        self.elapsed = time.perf_counter() - start
+
+
+def make_actions(count, delay=1.0):
+    # A mouse path with a click every 50 actions
+    table = ActionTable()
+    append = table.append_row
+    for i in range(count):
+        x = i % 1920
+        y = (i * 7) % 1080
+        if i % 50 == 49:
+            append(CLICK, x, y, 'left', None, delay)
+        else:
+            append(MOVE, x, y, None, None, delay)
+    return table
+
+
+def bench_recording(count):
+    events = [(i % 1920, (i * 7) % 1080, 'left' if i % 50 == 49 else None) for i in range(count)]
+    recorder = Recorder()
+    macro = Macro('bench')
+    recorder.start(macro)
+    listener = FakeListener(events, recorder.on_move, recorder.on_click)
+    start = time.perf_counter()
+    listener.start()
+    while listener.is_alive():
+        time.sleep(DRAIN_INTERVAL)
+        recorder.drain()
+    listener.join()
+    recorder.stop()
+    elapsed = time.perf_counter() - start
+    return {
+        'events': count,
+        'recorded': len(macro.actions),
+        'dropped': recorder.dropped,
+        'callback_seconds': listener.elapsed,
+        'callback_events_per_sec': count / listener.elapsed if listener.elapsed else None,
+        'total_seconds': elapsed,
+        'events_per_sec': count / elapsed if elapsed else None,
+    }
+
+
+def bench_playback(delay, steps):
+    mouse = FakeMouse()
+    injector = PynputInjector(mouse, FakeKeyboard())
+    done = threading.Event()
+    scheduler = MacroScheduler(injector, on_finished=lambda report: done.set())
+    macro = Macro('bench')
+    table = ActionTable()
+    for i in range(steps):
+        # Every position differs so the plan keeps one move per step
+        table.append_row(MOVE, i % 1920, i // 1920, None, None, delay)
+    macro.actions = table
+
+    start = time.perf_counter()
+    scheduler.play(macro, loops=1)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+    report = scheduler.last_report
+
+    expected = delay / 1000.0
+    intervals = [b - a for a, b in zip(mouse.times, mouse.times[1:])]
+    errors = [interval - expected for interval in intervals]
+    return {
+        'delay_ms': delay,
+        'steps': report.steps,
+        'injected': mouse.calls,
+        'seconds': elapsed,
+        'drift_ms': report.drift * 1000,
+        'mean_late_ms': report.mean_late * 1000,
+        'max_late_ms': report.max_late * 1000,
+        'jitter_ms': statistics.pstdev(errors) * 1000 if errors else 0.0,
+        'max_interval_error_ms': max(map(abs, errors)) * 1000 if errors else 0.0,
+    }
+
+
+def _save_and_load(path, profile):
+    store = ProfileStore(path, delay=0)
+    store.profiles.append(profile)
+    start = time.perf_counter()
+    for macro in profile.macros.values():
+        store.macro_changed(profile, macro, update_index=False)
+    store.profile_changed()
+    store.close()
+    save_seconds = time.perf_counter() - start
+
+    store = ProfileStore(path)
+    start = time.perf_counter()
+    profiles = store.load()
+    index_seconds = time.perf_counter() - start
+    for loaded in profiles:
+        for macro in loaded.macros.values():
+            macro.actions
+    load_seconds = time.perf_counter() - start
+    store.close()
+    return save_seconds, index_seconds, load_seconds
+
+
+def bench_storage(count, work_dir):
+    profile = Profile('bench')
+    macro = Macro('bench')
+    macro.actions = make_actions(count)
+    profile.add_macro(macro)
+
+    path = os.path.join(work_dir, f'storage-{count}')
+    save_seconds, index_seconds, load_seconds = _save_and_load(path, profile)
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+    shutil.rmtree(path)
+
+    # Peak memory is measured in a second run, tracemalloc slows
+    # everything down too much to time the same run
+    gc.collect()
+    tracemalloc.start()
+    _save_and_load(path, profile)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    shutil.rmtree(path)
+
+    return {
+        'actions': count,
+        'save_seconds': save_seconds,
+        'index_load_seconds': index_seconds,
+        'load_seconds': load_seconds,
+        'bytes_on_disk': size,
+        'peak_memory_bytes': peak,
+    }
+
+
+def run(sizes=DEFAULT_SIZES, delays=DEFAULT_DELAYS, playback_steps=500, suites=('record', 'playback', 'storage'),
+        log=None):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if 'record' in suites:
+        results['record'] = []
+        for count in sizes:
+            if log:
+                log(f"record {count}")
+            results['record'].append(bench_recording(count))
+    if 'playback' in suites:
+        results['playback'] = []
+        for delay in delays:
+            if log:
+                log(f"playback {delay} ms")
+            results['playback'].append(bench_playback(delay, playback_steps))
+    if 'storage' in suites:
+        results['storage'] = []
+        work_dir = tempfile.mkdtemp(prefix='ts4windows-bench-')
+        try:
+            for count in sizes:
+                if log:
+                    log(f"storage {count}")
+                results['storage'].append(bench_storage(count, work_dir))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless TS4Windows benchmarks, results are written as JSON")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="macro sizes in actions for the record and storage runs")
+    parser.add_argument('--delays', type=float, nargs='+', default=DEFAULT_DELAYS,
+                        help="per action delays in ms for the playback runs")
+    parser.add_argument('--playback-steps', type=int, default=500)
+    parser.add_argument('--only', choices=('record', 'playback', 'storage'), action='append',
+                        help="run only these suites, may be repeated")
+    parser.add_argument('-o', '--output', help="write the results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    log = lambda message: print(message, file=sys.stderr)
+    results = run(args.sizes, args.delays, args.playback_steps, args.only or ('record', 'playback', 'storage'), log)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import json
+import sys
+import threading
+
+from analysis import get_analysis
+from daemon import DEFAULT_HOST, DEFAULT_PORT, TOKEN_FILE, DaemonError, MacroDaemon, find_profile, send_request
+from library import export_library, import_library
+from optimize import DEFAULT_TOLERANCE, DEFAULT_MERGE_WINDOW, optimize_actions
+from plan import PynputInjector
+from playback import MacroScheduler
+from storage import ProfileStore, DEFAULT_PATH, LEGACY_FILE, convert_json
+from transforms import format_view
+
+# None of the modules above import PyQt6 or pynput: the GUI is imported by
+# the gui command alone and pynput only once a macro is actually played.
+
+
+def _load(args, read_only=False):
+    store = ProfileStore(args.store)
+    store.load(read_only)
+    return store
+
+
+def _find_macro(store, profile_name, macro_name):
+    profile = find_profile(store.profiles, profile_name)
+    if profile is None:
+        sys.exit(f"No profile named {profile_name!r}")
+    macro = profile.macros.get(macro_name)
+    if macro is None:
+        sys.exit(f"No macro named {macro_name!r} in {profile_name}")
+    return profile, macro
+
+
+def cmd_list(args):
+    store = _load(args, read_only=True)
+    for profile in store.profiles:
+        if args.profile and profile.name != args.profile:
+            continue
+        print(profile.name)
+        assigned = {macro_name: button for button, macro_name in profile.button_assignments.items()}
+        for macro_name, macro in sorted(profile.macros.items()):
+            stats = macro.stats
+            line = f"  {macro_name}: {stats.count} actions, {stats.duration / 1000:.3f} s"
+            if macro.repeat:
+                line += f", repeats {macro.loops or 'forever'}"
+            if macro_name in assigned:
+                line += f", on {assigned[macro_name]}"
+            print(line)
+            for view_name, stages in sorted(macro.views.items()):
+                print(f"    view {view_name}: {format_view(stages)}")
+    store.close()
+
+
+def cmd_play(args):
+    store = _load(args, read_only=True)
+    _, macro = _find_macro(store, args.profile, args.macro)
+    if args.speed:
+        macro.speed = args.speed
+    if args.view is not None and args.view not in macro.views:
+        sys.exit(f"No view named {args.view!r} on {args.macro}")
+    try:
+        injector = PynputInjector()
+    except ImportError as e:
+        sys.exit(f"Can't inject input here: {e}")
+    done = threading.Event()
+    playback = MacroScheduler(injector, on_finished=lambda report: done.set())
+    playback.play(macro, loops=args.loops, view=args.view)
+    try:
+        while not done.wait(0.1):
+            pass
+    except KeyboardInterrupt:
+        playback.stop()
+        done.wait()
+    playback.close()
+    store.close()
+    print(playback.last_report.summary())
+
+
+def cmd_analyze(args):
+    store = _load(args, read_only=True)
+    profile = find_profile(store.profiles, args.profile)
+    if profile is None:
+        sys.exit(f"No profile named {args.profile!r}")
+    names = [args.macro] if args.macro else sorted(profile.macros)
+    stuck = []
+    for name in names:
+        _, macro = _find_macro(store, args.profile, name)
+        analysis = get_analysis(macro)
+        print(analysis.summary())
+        print()
+        if analysis.held:
+            stuck.append(name)
+    store.close()
+    if stuck:
+        sys.exit(f"Keys left down by {', '.join(stuck)}")
+
+
+def cmd_convert(args):
+    profiles = convert_json(args.json, args.store)
+    print(f"Converted {len(profiles)} profiles from {args.json} into {args.store}")
+
+
+def cmd_optimize(args):
+    store = _load(args)
+    profile = find_profile(store.profiles, args.profile)
+    if profile is None:
+        sys.exit(f"No profile named {args.profile!r}")
+    names = [args.macro] if args.macro else sorted(profile.macros)
+    for name in names:
+        _, macro = _find_macro(store, args.profile, name)
+        before = len(macro.actions)
+        macro.actions, removed = optimize_actions(macro.actions, args.tolerance or DEFAULT_TOLERANCE,
+                                                  DEFAULT_MERGE_WINDOW if args.window is None else args.window)
+        if removed:
+            store.macro_changed(profile, macro)
+        print(f"{name}: removed {removed} of {before} actions")
+    store.close()
+
+
+def cmd_import(args):
+    store = _load(args)
+    reports = import_library(store, args.paths, args.profile, args.replace, args.jobs)
+    store.close()
+    for report in reports:
+        print(report.summary())
+    imported = sum(report.macros for report in reports)
+    failed = sum(1 for report in reports if not report.ok)
+    print(f"Imported {imported} macros from {len(reports)} files, {failed} with errors")
+    if failed:
+        sys.exit(1)
+
+
+def cmd_export(args):
+    store = _load(args, read_only=True)
+    profiles = store.profiles
+    if args.profile:
+        profiles = [find_profile(profiles, name) for name in args.profile]
+        missing = [name for name, profile in zip(args.profile, profiles) if profile is None]
+        if missing:
+            sys.exit(f"No profile named {missing[0]!r}")
+    reports = export_library(store, profiles, args.directory, args.format, args.jobs)
+    store.close()
+    failed = [report for report in reports if not report.ok]
+    for report in failed:
+        print(report.summary())
+    print(f"Exported {sum(report.macros for report in reports)} macros from {len(profiles)} profiles "
+          f"to {args.directory}")
+    if failed:
+        sys.exit(1)
+
+
+def cmd_daemon(args):
+    try:
+        injector = PynputInjector()
+    except ImportError as e:
+        sys.exit(f"Can't inject input here: {e}")
+    try:
+        daemon = MacroDaemon(args.store, injector, args.host, args.port, args.token_file)
+    except (DaemonError, OSError) as e:
+        sys.exit(f"Can't start the daemon: {e}")
+    print(f"Serving {args.store} on {args.host}:{args.port}", file=sys.stderr)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_send(args):
+    request = {'command': args.request}
+    if args.profile:
+        request['profile'] = args.profile
+    if args.macro:
+        request['macro'] = args.macro
+    if args.loops is not None:
+        request['loops'] = args.loops
+    if args.view:
+        request['view'] = args.view
+    try:
+        reply = send_request(request, args.host, args.port, token_path=args.token_file)
+    except (DaemonError, OSError) as e:
+        sys.exit(f"Daemon request failed: {e}")
+    if reply:
+        print(json.dumps(reply, indent=2))
+
+
+def cmd_gui(args):
+    import ts4windows
+    ts4windows.main()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='ts4windows', description="Record, manage and play TS4Windows macros")
+    parser.add_argument('--store', default=DEFAULT_PATH, help="profile store directory")
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('gui', help="start the GUI (the default)")
+    command.set_defaults(func=cmd_gui)
+
+    command = commands.add_parser('list', help="list profiles and macros")
+    command.add_argument('profile', nargs='?')
+    command.set_defaults(func=cmd_list)
+
+    command = commands.add_parser('play', help="play a macro and wait for it to finish")
+    command.add_argument('profile')
+    command.add_argument('macro')
+    command.add_argument('--loops', type=int, help="runs, 0 = until interrupted; defaults to the macro's setting")
+    command.add_argument('--speed', type=float, help="playback speed multiplier")
+    command.add_argument('--view', help="play through one of the macro's saved views")
+    command.set_defaults(func=cmd_play)
+
+    command = commands.add_parser('analyze', help="dry-run macros and report runtime, region, keys and hot spots; "
+                                                  "exits with 1 if a macro leaves keys down")
+    command.add_argument('profile')
+    command.add_argument('macro', nargs='?', help="defaults to every macro in the profile")
+    command.set_defaults(func=cmd_analyze)
+
+    command = commands.add_parser('convert', help="import a legacy JSON profiles file")
+    command.add_argument('json', nargs='?', default=LEGACY_FILE)
+    command.set_defaults(func=cmd_convert)
+
+    command = commands.add_parser('optimize', help="drop redundant mouse moves from macros")
+    command.add_argument('profile')
+    command.add_argument('macro', nargs='?', help="defaults to every macro in the profile")
+    command.add_argument('--tolerance', type=int, help="pixels")
+    command.add_argument('--window', type=int, help="move merge window in ms")
+    command.set_defaults(func=cmd_optimize)
+
+    command = commands.add_parser('import', help="import macro and profile files or directories of them")
+    command.add_argument('paths', nargs='+')
+    command.add_argument('--profile', help="import everything into this profile")
+    command.add_argument('--replace', action='store_true', help="replace macros that already exist")
+    command.add_argument('--jobs', type=int, help="worker processes, defaults to the number of CPUs")
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser('export', help="export profiles as .json files or directories of .t4m files")
+    command.add_argument('directory')
+    command.add_argument('--profile', action='append', help="export only this profile, may be repeated")
+    command.add_argument('--format', choices=('json', 't4m'), default='json')
+    command.add_argument('--jobs', type=int, help="worker processes, defaults to the number of CPUs")
+    command.set_defaults(func=cmd_export)
+
+    for name, func, help_text in (('daemon', cmd_daemon, "keep macros loaded and play them on request"),
+                                  ('send', cmd_send, "send a request to a running daemon")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--host', default=DEFAULT_HOST)
+        command.add_argument('--port', type=int, default=DEFAULT_PORT)
+        command.add_argument('--token-file', default=TOKEN_FILE, help="file holding the daemon's shared secret")
+        command.set_defaults(func=func)
+    command.add_argument('request', choices=('play', 'stop', 'status', 'list', 'reload', 'shutdown'))
+    command.add_argument('profile', nargs='?')
+    command.add_argument('macro', nargs='?')
+    command.add_argument('--loops', type=int)
+    command.add_argument('--view')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    func = getattr(args, 'func', cmd_gui)
+    func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import threading
+
+from playback import MacroScheduler
+from storage import ProfileStore, DEFAULT_PATH
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 47251
+TOKEN_FILE = os.path.join(os.path.expanduser('~'), '.ts4windows-daemon-token')
+MAX_LINE = 1 << 16  # Bytes in one request line
+
+
+def find_profile(profiles, name):
+    for profile in profiles:
+        if profile.name == name:
+            return profile
+    return None
+
+
+class DaemonError(Exception):
+    pass
+
+
+def read_token(path=TOKEN_FILE):
+    with open(path, 'r') as f:
+        token = f.read().strip()
+    if not token:
+        raise DaemonError(f"{path} holds no token")
+    return token
+
+
+def ensure_token(path=TOKEN_FILE):
+    # The shared secret clients must send first, created readable by the
+    # current user alone (on Windows the home directory already is)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        if hasattr(os, 'getuid'):
+            info = os.stat(path)
+            if info.st_uid != os.getuid() or info.st_mode & 0o077:
+                raise DaemonError(f"{path} must belong to you and be readable by you alone")
+        return read_token(path)
+    token = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MacroDaemon:
+    # Keeps the profile store loaded and every macro's execution plan
+    # compiled, and plays macros on request. Requests and replies are one
+    # JSON object per line on a localhost socket. A connection starts with
+    # {"token": ...} holding the secret from token_path and is closed on
+    # a wrong token or a line that isn't JSON.
+    def __init__(self, path=DEFAULT_PATH, injector=None, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 token_path=TOKEN_FILE):
+        self.token = ensure_token(token_path)
+        if injector is None:
+            from plan import PynputInjector
+            injector = PynputInjector()
+        self.injector = injector
+        self.store = ProfileStore(path)
+        self.playback = MacroScheduler(injector)
+        self.address = (host, port)
+        self.server = None
+        self.profiles = {}  # name -> Profile
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self.playback.stop()
+            self.store.load()
+            self.profiles = {profile.name: profile for profile in self.store.profiles}
+            for profile in self.store.profiles:
+                for macro in profile.macros.values():
+                    self.playback.prepare(macro)
+
+    def _macro(self, request):
+        profile = self.profiles.get(request.get('profile'))
+        if profile is None:
+            raise DaemonError(f"no profile named {request.get('profile')!r}")
+        macro = profile.macros.get(request.get('macro'))
+        if macro is None:
+            raise DaemonError(f"no macro named {request.get('macro')!r} in {profile.name}")
+        return macro
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'play':
+            with self._lock:
+                macro = self._macro(request)
+                view = request.get('view')
+                if view is not None and view not in macro.views:
+                    raise DaemonError(f"no view named {view!r} on {macro.name}")
+                loops = request.get('loops')
+                if loops is not None and (not isinstance(loops, int) or isinstance(loops, bool) or loops < 0):
+                    raise DaemonError(f"loops must be a whole number of runs, 0 or more, not {loops!r}")
+                instance = self.playback.play(macro, loops=loops, view=view)
+            return {'instance': instance.id}
+        if command == 'stop':
+            if request.get('macro') is None:
+                self.playback.stop()
+            else:
+                with self._lock:
+                    macro = self._macro(request)
+                for instance in self.playback.instances:
+                    if instance.macro is macro:
+                        self.playback.cancel(instance)
+            return {}
+        if command == 'status':
+            return {'instances': [{
+                'id': instance.id,
+                'macro': instance.macro.name,
+                'view': instance.view,
+                'state': instance.state,
+                'steps': instance.report.steps,
+                'loops': instance.report.loops,
+            } for instance in self.playback.instances]}
+        if command == 'list':
+            with self._lock:
+                return {'profiles': {profile.name: sorted(profile.macros) for profile in self.store.profiles}}
+        if command == 'reload':
+            self.load()
+            return {}
+        if command == 'shutdown':
+            # The connection's handler shuts the server down once the
+            # reply is written, see shutdown()
+            return {}
+        raise DaemonError(f"unknown command {command!r}")
+
+    def shutdown(self):
+        # serve_forever returns once the server stops; called from a
+        # handler thread, so the wait for that happens elsewhere
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                authorized = False
+                while True:
+                    line = self.rfile.readline(MAX_LINE)
+                    if not line:
+                        return
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('request line too long')
+                        request = json.loads(line)
+                    except ValueError as e:
+                        self.reply({'ok': False, 'error': f"invalid request: {e}"})
+                        return
+                    if not authorized:
+                        token = request.get('token') if isinstance(request, dict) else None
+                        if not isinstance(token, str) or not hmac.compare_digest(token, daemon.token):
+                            self.reply({'ok': False, 'error': 'not authorized'})
+                            return
+                        authorized = True
+                        continue
+                    try:
+                        reply = dict(daemon.handle(request), ok=True)
+                    except (DaemonError, ValueError, TypeError, AttributeError) as e:
+                        reply = {'ok': False, 'error': str(e)}
+                    self.reply(reply)
+                    if reply['ok'] and request.get('command') == 'shutdown':
+                        daemon.shutdown()
+                        return
+
+            def reply(self, reply):
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        with _Server(self.address, Handler) as server:
+            self.server = server
+            try:
+                server.serve_forever()
+            finally:
+                self.playback.close()
+                self.store.close()
+
+
+def send_request(request, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=5.0, token_path=TOKEN_FILE):
+    token = read_token(token_path)
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(json.dumps({'token': token}).encode('utf-8') + b'\n'
+                     + json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise DaemonError('no reply from daemon')
+    reply = json.loads(line)
+    if not reply.pop('ok', False):
+        raise DaemonError(reply.get('error', 'request failed'))
+    return reply
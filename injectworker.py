@@ -0,0 +1,793 @@
+import ctypes
+import itertools
+import math
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+import weakref
+from multiprocessing import shared_memory
+
+from models import MOVE, CLICK, KEY_PRESS, SCROLL, button_from_str, button_to_str
+from plan import get_plan, mouse_button
+from playback import (MacroScheduler, LatencyStats, PlaybackReport, PLAYING, PAUSED, CANCELLED, FINISHED,
+                      KEY_SHARE, STALLED)
+from transforms import view_steps
+
+# Playback can run in a worker process that does nothing but inject, so a
+# stalled GUI never delays input and a stalled injector never freezes the
+# window. Compiled steps and commands go to the worker over one shared
+# memory ring and status comes back over another.
+
+RING_SIZE = 1 << 20
+STEP_BATCH = 1024  # Steps per message while a plan streams to the worker
+MESSAGE_BYTES = 64 * 1024  # A message is cut after the step piece that passes this
+STEP_OPS = 4096  # Ops per piece; bigger steps are sent as several pieces
+STATUS_INTERVAL = 0.1
+CLOCK_SLACK = 0.5  # Seconds the two processes' clocks may seem apart and still be one clock
+MAX_ERROR = 1000  # Characters of an error message sent back
+
+# Commands, GUI process to worker
+PLAN_BEGIN, PLAN_STEPS, PLAN_END, PLAN_DROP, PLAY, PAUSE, RESUME, CANCEL, STOP, KEY_POLICY, SHUTDOWN = range(1, 12)
+# Events, worker to GUI process
+READY, STATE, PROGRESS, DONE, LATENCY, ERROR = range(1, 7)
+
+LENGTH = struct.Struct('<I')
+COUNTERS = 16  # Bytes before the data: consumed and written byte counts
+KIND = struct.Struct('<B')
+ID = struct.Struct('<BI')
+BEGIN = struct.Struct('<BI?')
+STEPS = struct.Struct('<BIH')
+COUNT = struct.Struct('<I')
+STEP = struct.Struct('<dI?')  # delay, ops in this piece, last piece of the step
+OP = struct.Struct('<Bii')
+PLAY_HEADER = struct.Struct('<BIIiId')
+TEXT = struct.Struct('<H')
+PROGRESS_EVENT = struct.Struct('<BIII')
+DONE_EVENT = struct.Struct('<BIIIdddd?')  # Followed by the error text, empty if none
+LATENCY_EVENT = struct.Struct('<Bd')
+READY_EVENT = struct.Struct('<BId')  # pid, the worker's perf_counter() when it sent this
+
+
+def _pack_text(text):
+    data = text.encode('utf-8')
+    return TEXT.pack(len(data)) + data
+
+
+def _unpack_text(data, offset):
+    (length,) = TEXT.unpack_from(data, offset)
+    offset += TEXT.size
+    return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+class SharedRing:
+    # Single producer, single consumer queue of messages in shared memory.
+    # The producer only advances the written count and the consumer only
+    # the consumed one, so neither side takes a lock. Messages are a length
+    # and a payload and may wrap around the end of the buffer. The doorbell
+    # is a semaphore released after each message: unlike an event it has
+    # no lock a killed process could leave held.
+    def __init__(self, doorbell, name=None, size=RING_SIZE):
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=COUNTERS + size)
+        self.name = self.shm.name
+        self.size = size
+        self.doorbell = doorbell
+        self.buf = self.shm.buf
+        self._head = ctypes.c_uint64.from_buffer(self.buf, 0)
+        self._tail = ctypes.c_uint64.from_buffer(self.buf, 8)
+        self._owner = name is None
+
+    def put(self, payload):
+        # False when the consumer is too far behind for the message to fit
+        need = LENGTH.size + len(payload)
+        if need > self.size:
+            raise ValueError(f"message of {len(payload)} bytes is larger than the ring")
+        tail = self._tail.value
+        if self.size - (tail - self._head.value) < need:
+            return False
+        self._write(tail, LENGTH.pack(len(payload)))
+        self._write(tail + LENGTH.size, payload)
+        self._tail.value = tail + need
+        self.doorbell.release()
+        return True
+
+    def wake(self):
+        self.doorbell.release()
+
+    def wait(self, timeout):
+        # Returns once there may be messages, or after timeout
+        if self.doorbell.acquire(timeout=timeout):
+            while self.doorbell.acquire(False):
+                pass
+
+    def get_all(self):
+        head = self._head.value
+        tail = self._tail.value
+        messages = []
+        while head < tail:
+            (length,) = LENGTH.unpack(self._read(head, LENGTH.size))
+            messages.append(self._read(head + LENGTH.size, length))
+            head += LENGTH.size + length
+        self._head.value = head
+        return messages
+
+    def _write(self, position, data):
+        start = position % self.size
+        first = min(len(data), self.size - start)
+        self.buf[COUNTERS + start:COUNTERS + start + first] = data[:first]
+        if first < len(data):
+            self.buf[COUNTERS:COUNTERS + len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        start = position % self.size
+        first = min(length, self.size - start)
+        data = bytes(self.buf[COUNTERS + start:COUNTERS + start + first])
+        if first < length:
+            data += bytes(self.buf[COUNTERS:COUNTERS + length - first])
+        return data
+
+    def close(self):
+        del self._head, self._tail
+        self.buf = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+class WireInjector:
+    # Plans for the worker are compiled against this; only each op's kind
+    # and arguments are sent, and the worker binds them to its own injector
+    def move(self, x, y):
+        pass
+
+    def click(self, button):
+        pass
+
+    def press(self, key):
+        pass
+
+    def release(self, key):
+        pass
+
+    def scroll(self, amount):
+        pass
+
+
+def encode_batches(plan_id, steps):
+    # STEPS messages for a stream of steps. Button and key values are sent
+    # as text once per plan and referred to by number after that. A message
+    # holds at most STEP_BATCH pieces and about MESSAGE_BYTES, and a step
+    # with more than STEP_OPS ops is split into pieces the worker joins
+    # back together, so any plan fits through the ring.
+    values = {}
+    new_values = []
+    body = bytearray()
+    pieces = 0
+    for ops, delay in steps:
+        for start in range(0, max(len(ops), 1), STEP_OPS):
+            piece = ops[start:start + STEP_OPS]
+            body += STEP.pack(delay, len(piece), start + STEP_OPS >= len(ops))
+            for kind, _, args in piece:
+                if kind == MOVE:
+                    body += OP.pack(kind, args[0], args[1])
+                elif kind == SCROLL:
+                    body += OP.pack(kind, args[0], 0)
+                else:
+                    text = button_to_str(args[0])
+                    value_id = values.get(text)
+                    if value_id is None:
+                        value_id = values[text] = len(values)
+                        new_values.append(text)
+                    body += OP.pack(kind, value_id, 0)
+            pieces += 1
+            if pieces >= STEP_BATCH or len(body) >= MESSAGE_BYTES:
+                yield _steps_message(plan_id, new_values, pieces, body)
+                new_values = []
+                body = bytearray()
+                pieces = 0
+    if pieces:
+        yield _steps_message(plan_id, new_values, pieces, body)
+
+
+def _steps_message(plan_id, new_values, pieces, body):
+    return (STEPS.pack(PLAN_STEPS, plan_id, len(new_values)) + b''.join(map(_pack_text, new_values))
+            + COUNT.pack(pieces) + body)
+
+
+class _StreamedPlan:
+    # The steps of one plan in the worker, filled in as they arrive. An
+    # instance that catches up with the stream gets STALLED and is woken
+    # when the next batch is in, so the scheduler thread never waits.
+    def __init__(self, transient):
+        self.transient = transient
+        self.steps = []
+        self.values = []
+        self.partial = []  # Ops of a step whose last piece hasn't arrived
+        self.complete = False
+
+    def add(self, payload, injector):
+        _, _, new_values = STEPS.unpack_from(payload)
+        offset = STEPS.size
+        for _ in range(new_values):
+            text, offset = _unpack_text(payload, offset)
+            self.values.append(text)
+        values = self.values
+        (count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        resolved = {}
+        steps = []
+        ops = self.partial
+        for _ in range(count):
+            delay, op_count, last = STEP.unpack_from(payload, offset)
+            offset += STEP.size
+            for kind, a, b in OP.iter_unpack(payload[offset:offset + op_count * OP.size]):
+                if kind == MOVE:
+                    ops.append((MOVE, injector.move, (a, b)))
+                elif kind == SCROLL:
+                    ops.append((SCROLL, injector.scroll, (a,)))
+                else:
+                    value = resolved.get((kind == CLICK, a))
+                    if value is None:
+                        value = resolved[kind == CLICK, a] = _resolve(kind, values[a])
+                    if kind == CLICK:
+                        ops.append((CLICK, injector.click, (value,)))
+                    else:
+                        ops.append((kind, injector.press if kind == KEY_PRESS else injector.release, (value,)))
+            offset += op_count * OP.size
+            if last:
+                steps.append((tuple(ops), delay))
+                ops = []
+        self.partial = ops
+        self.steps.extend(steps)
+
+    @property
+    def started(self):
+        return bool(self.steps) or self.complete
+
+    def end(self):
+        self.complete = True
+
+    def iterate(self):
+        # complete is only set after the last steps are added, so the
+        # length is checked again once it is seen
+        steps = self.steps
+        index = 0
+        while True:
+            if index < len(steps):
+                yield steps[index]
+                index += 1
+            elif not self.complete:
+                yield STALLED
+            elif index >= len(steps):
+                return
+
+
+def _resolve(kind, text):
+    # Same resolution the in-process compiler does
+    try:
+        return mouse_button(text) if kind == CLICK else button_from_str(text)
+    except (KeyError, ValueError):
+        return text
+
+
+class _MacroName:
+    # What the worker's scheduler needs of a macro
+    def __init__(self, name):
+        self.name = name
+
+
+class _Worker:
+    def __init__(self, commands, events, injector):
+        self.commands = commands
+        self.events = events
+        self.injector = injector
+        self.plans = {}  # plan id -> _StreamedPlan
+        self.instances = {}  # GUI instance id -> worker MacroInstance
+        self.remote_ids = {}  # worker instance id -> (GUI instance id, plan id)
+        self.waiting = {}  # plan id -> PLAY messages held until its first steps arrive
+        self.finished = queue.SimpleQueue()
+        self.pending = []  # Events waiting for room in the ring
+        self.progress = {}  # GUI instance id -> (steps, loops) last sent
+        self.latency_sent = 0
+        self.closed = False
+        self.scheduler = MacroScheduler(injector, on_finished=self._on_finished)
+
+    def _on_finished(self, report):
+        # Scheduler thread
+        self.finished.put(report)
+        self.commands.wake()
+
+    def send(self, payload, required=True):
+        # Events that must arrive wait for room; progress is simply dropped
+        # while the GUI process isn't reading
+        if self.pending or not self.events.put(payload):
+            if required:
+                self.pending.append(payload)
+
+    def flush(self):
+        while self.pending and self.events.put(self.pending[0]):
+            del self.pending[0]
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == PLAN_STEPS:
+            (_, plan_id, _) = STEPS.unpack_from(message)
+            plan = self.plans.get(plan_id)
+            if plan is not None:
+                plan.add(message, self.injector)
+                self.plan_changed(plan_id, plan)
+        elif kind == PLAY:
+            plan_id = PLAY_HEADER.unpack_from(message)[2]
+            plan = self.plans.get(plan_id)
+            if plan is not None and not plan.started:
+                self.waiting.setdefault(plan_id, []).append(message)
+            else:
+                self.play(message, plan)
+        elif kind == PLAN_BEGIN:
+            _, plan_id, transient = BEGIN.unpack(message)
+            self.plans[plan_id] = _StreamedPlan(transient)
+        elif kind in (PLAN_END, PLAN_DROP):
+            plan_id = ID.unpack(message)[1]
+            plan = self.plans.pop(plan_id, None) if kind == PLAN_DROP else self.plans.get(plan_id)
+            if plan is not None:
+                plan.end()
+                self.plan_changed(plan_id, plan)
+        elif kind in (PAUSE, RESUME, CANCEL):
+            remote_id = ID.unpack(message)[1]
+            instance = self.instances.get(remote_id)
+            if instance is None:
+                if kind == CANCEL:
+                    self.drop_waiting(lambda waiting_id: waiting_id == remote_id)
+                return
+            if kind == PAUSE:
+                self.scheduler.pause(instance)
+            elif kind == RESUME:
+                self.scheduler.resume(instance)
+            else:
+                self.scheduler.cancel(instance)
+            self.send(ID.pack(STATE, remote_id) + _pack_text(instance.state))
+        elif kind == STOP:
+            self.drop_waiting(lambda waiting_id: True)
+            self.scheduler.stop()
+        elif kind == KEY_POLICY:
+            self.scheduler.key_policy = _unpack_text(message, KIND.size)[0]
+        elif kind == SHUTDOWN:
+            self.closed = True
+
+    def play(self, message, plan):
+        _, remote_id, plan_id, priority, loops, trigger_time = PLAY_HEADER.unpack_from(message)
+        name, _ = _unpack_text(message, PLAY_HEADER.size)
+        if plan is None:
+            self.send(_done_event(remote_id))
+            return
+        # The trigger time is the only time that crosses processes and is
+        # compared with this process's perf_counter(). The GUI process has
+        # already converted it to this clock, see RemoteScheduler._handle
+        # (READY); everything else the scheduler times is its own.
+        try:
+            instance = self.scheduler.play(_MacroName(name), priority, loops,
+                                           None if math.isnan(trigger_time) else trigger_time,
+                                           source=plan.iterate)
+        except Exception as e:
+            self.send(_done_event(remote_id, error=e))
+            return
+        self.instances[remote_id] = instance
+        self.remote_ids[instance.id] = (remote_id, plan_id)
+
+    def plan_changed(self, plan_id, plan):
+        # Start plays that waited for the plan's first steps and wake the
+        # instances that caught up with it
+        for message in self.waiting.pop(plan_id, ()):
+            self.play(message, plan)
+        for remote_id, playing_id in list(self.remote_ids.values()):
+            if playing_id == plan_id:
+                self.scheduler.wake(self.instances[remote_id])
+
+    def drop_waiting(self, matches):
+        for plan_id, messages in list(self.waiting.items()):
+            kept = []
+            for message in messages:
+                remote_id = PLAY_HEADER.unpack_from(message)[1]
+                if matches(remote_id):
+                    self.send(_done_event(remote_id))
+                else:
+                    kept.append(message)
+            if kept:
+                self.waiting[plan_id] = kept
+            else:
+                del self.waiting[plan_id]
+
+    def report(self):
+        while True:
+            try:
+                report = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            remote_id, plan_id = self.remote_ids.pop(report.instance_id)
+            self.instances.pop(remote_id, None)
+            self.progress.pop(remote_id, None)
+            plan = self.plans.get(plan_id)
+            if plan is not None and plan.transient:
+                del self.plans[plan_id]
+            self.send(_done_event(remote_id, report))
+        for remote_id, instance in list(self.instances.items()):
+            progress = (instance.report.steps, instance.report.loops)
+            if self.progress.get(remote_id) != progress:
+                self.progress[remote_id] = progress
+                self.send(PROGRESS_EVENT.pack(PROGRESS, remote_id, *progress), required=False)
+        latency = self.scheduler.trigger_latency
+        new = min(latency.count - self.latency_sent, len(latency.samples))
+        if new > 0:
+            for value in list(latency.samples)[-new:]:
+                self.send(LATENCY_EVENT.pack(LATENCY, value), required=False)
+        self.latency_sent = latency.count
+
+    def run(self):
+        parent = multiprocessing.parent_process()
+        next_report = 0.0
+        while not self.closed:
+            for message in self.commands.get_all():
+                try:
+                    self.handle(message)
+                except Exception as e:
+                    # A message this worker can't act on is reported and
+                    # skipped; the loop and the scheduler keep going
+                    self.send(KIND.pack(ERROR) + _pack_text(f"Injector worker: {e}"[:MAX_ERROR]))
+            now = time.monotonic()
+            if not self.finished.empty() or now >= next_report:
+                self.report()
+                next_report = now + STATUS_INTERVAL
+            self.flush()
+            if parent is not None and not parent.is_alive():
+                break
+            self.commands.wait(STATUS_INTERVAL)
+        self.drop_waiting(lambda waiting_id: True)
+        self.scheduler.close()
+        self.report()
+        deadline = time.monotonic() + 1.0
+        while self.pending and time.monotonic() < deadline:
+            self.flush()
+            time.sleep(0.01)
+
+
+def _done_event(remote_id, report=None, error=None):
+    # DONE for a finished instance, or for a play that never started
+    if report is None:
+        fields = (0, 0, 0.0, 0.0, 0.0, 0.0, True)
+    else:
+        fields = (report.steps, report.loops, report.max_late, report.total_late, report.drift,
+                  report.duration, report.stopped)
+        error = report.error
+    return DONE_EVENT.pack(DONE, remote_id, *fields) + _pack_text(str(error or '')[:MAX_ERROR])
+
+
+def run_worker(command_name, event_name, size, command_bell, event_bell):
+    commands = SharedRing(command_bell, command_name, size)
+    events = SharedRing(event_bell, event_name, size)
+    try:
+        from plan import PynputInjector
+        try:
+            injector = PynputInjector()
+        except ImportError as e:
+            events.put(KIND.pack(ERROR) + _pack_text(f"Can't inject input here: {e}"))
+            return
+        events.put(READY_EVENT.pack(READY, multiprocessing.current_process().pid, time.perf_counter()))
+        _Worker(commands, events, injector).run()
+    finally:
+        commands.close()
+        events.close()
+
+
+class RemoteInstance:
+    # The GUI process's view of an instance playing in the worker; state
+    # and report are updated as events come back
+    def __init__(self, instance_id, macro, priority, loops, view=None):
+        self.id = instance_id
+        self.macro = macro
+        self.view = view
+        self.priority = priority
+        self.loops = loops
+        self.state = PLAYING
+        self.report = PlaybackReport(macro.name, instance_id)
+
+
+class RemoteScheduler:
+    # Same interface as MacroScheduler, with the injecting done by a worker
+    # process. Calls only queue a command: a sender thread streams plans
+    # and commands into the ring, one batch at a time between commands so a
+    # long plan never holds up a trigger, and a receiver thread turns the
+    # worker's events back into instance state and on_finished calls.
+    # Timing instrumentation isn't collected from the worker.
+    def __init__(self, on_finished=None, key_policy=KEY_SHARE, on_status=None):
+        self.injector = WireInjector()
+        self.on_finished = on_finished
+        self.on_status = on_status
+        self.instrumentation = None
+        self.last_report = None
+        self.trigger_latency = LatencyStats()
+        self.pid = None
+        self._clock_offset = 0.0  # This process's perf_counter() minus the worker's
+        self._key_policy = key_policy
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._ids = itertools.count(1)
+        self._plan_ids = itertools.count(1)
+        self._plans = weakref.WeakKeyDictionary()  # macro -> (plan, plan id) sent to the worker
+        self._instance_plans = {}  # instance id -> plan id it plays
+        self._queue = queue.SimpleQueue()
+        self._closing = False
+        self._closed = False
+
+        context = multiprocessing.get_context('spawn')
+        command_bell = context.Semaphore(0)
+        event_bell = context.Semaphore(0)
+        self._commands = SharedRing(command_bell)
+        self._events = SharedRing(event_bell)
+        self._process = context.Process(target=run_worker, name='ts4windows-injector', daemon=True,
+                                        args=(self._commands.name, self._events.name, RING_SIZE,
+                                              command_bell, event_bell))
+        try:
+            self._process.start()
+        except Exception:
+            self._commands.close()
+            self._events.close()
+            raise
+        self._queue.put(KIND.pack(KEY_POLICY) + _pack_text(key_policy))
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+        self._sender.start()
+        self._receiver.start()
+
+    @property
+    def alive(self):
+        return self._process.is_alive()
+
+    @property
+    def key_policy(self):
+        return self._key_policy
+
+    @key_policy.setter
+    def key_policy(self, policy):
+        self._key_policy = policy
+        self._queue.put(KIND.pack(KEY_POLICY) + _pack_text(policy))
+
+    @property
+    def instances(self):
+        with self._lock:
+            return list(self._instances.values())
+
+    def find(self, macro):
+        for instance in self.instances:
+            if instance.macro is macro:
+                return instance
+        return None
+
+    def prepare(self, macro):
+        # Compiles and starts sending the plan so the first play doesn't
+        # wait for it
+        self._queue.put(('prepare', macro, get_plan(macro, self.injector)))
+
+    def play(self, macro, priority=None, loops=None, trigger_time=None, view=None):
+        if priority is None:
+            priority = macro.priority
+        if loops is None:
+            loops = macro.loops if macro.repeat else 1
+        plan = get_plan(macro, self.injector) if view is None else None
+        with self._lock:
+            instance = RemoteInstance(next(self._ids), macro, priority, loops, view)
+            self._instances[instance.id] = instance
+        self._queue.put(('play', instance, plan, trigger_time))
+        return instance
+
+    def pause(self, instance):
+        if instance.state == PLAYING:
+            instance.state = PAUSED
+            self._queue.put(ID.pack(PAUSE, instance.id))
+
+    def resume(self, instance):
+        if instance.state == PAUSED:
+            instance.state = PLAYING
+            self._queue.put(ID.pack(RESUME, instance.id))
+
+    def cancel(self, instance):
+        if instance.state in (PLAYING, PAUSED):
+            instance.state = CANCELLED
+            self._queue.put(ID.pack(CANCEL, instance.id))
+
+    def stop(self):
+        for instance in self.instances:
+            instance.state = CANCELLED
+        self._queue.put(KIND.pack(STOP))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closing = True
+        self._queue.put(None)
+        self._sender.join()
+        self._process.join(5.0)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._receiver.join()
+        self._closed = True
+        self._commands.close()
+        self._events.close()
+
+    def _send(self, payload):
+        while not self._commands.put(payload):
+            if not self._process.is_alive():
+                return
+            time.sleep(0.0005)
+
+    def _send_plan(self, macro, plan, streams, dropping):
+        sent = self._plans.get(macro)
+        if sent is not None and sent[0] is plan:
+            return sent[1]
+        plan_id = next(self._plan_ids)
+        if sent is not None:
+            # Instances may still be playing the old plan
+            dropping.add(sent[1])
+            if not any(stream_id == sent[1] for stream_id, _ in streams):
+                self._send(ID.pack(PLAN_DROP, sent[1]))
+                dropping.discard(sent[1])
+        self._begin(plan_id, plan.steps, streams)
+        self._plans[macro] = (plan, plan_id)
+        return plan_id
+
+    def _begin(self, plan_id, steps, streams, transient=False):
+        # The first batch goes out right away, the rest between commands.
+        # A plan with no steps is ended at once so plays of it finish.
+        self._send(BEGIN.pack(PLAN_BEGIN, plan_id, transient))
+        batches = encode_batches(plan_id, steps)
+        try:
+            first = next(batches, None)
+        except Exception:
+            self._send(ID.pack(PLAN_DROP, plan_id))
+            raise
+        if first is None:
+            self._send(ID.pack(PLAN_END, plan_id))
+            return
+        self._send(first)
+        streams.append((plan_id, batches))
+
+    def _send_loop(self):
+        # Errors end the plan or play they came from, never this thread
+        streams = []  # (plan id, batches still to send)
+        dropping = set()
+        while True:
+            try:
+                item = self._queue.get(block=not streams)
+            except queue.Empty:
+                plan_id, batches = streams[0]
+                try:
+                    payload = next(batches, None)
+                except Exception as e:
+                    del streams[0]
+                    self._fail_plan(plan_id, e)
+                    continue
+                if payload is not None:
+                    self._send(payload)
+                    continue
+                del streams[0]
+                self._send(ID.pack(PLAN_END, plan_id))
+                if plan_id in dropping:
+                    dropping.discard(plan_id)
+                    self._send(ID.pack(PLAN_DROP, plan_id))
+                continue
+            if item is None:
+                self._send(KIND.pack(SHUTDOWN))
+                return
+            try:
+                if isinstance(item, bytes):
+                    self._send(item)
+                elif item[0] == 'prepare':
+                    self._send_plan(item[1], item[2], streams, dropping)
+                else:
+                    self._send_play(*item[1:], streams, dropping)
+            except Exception as e:
+                if isinstance(item, tuple) and item[0] == 'play':
+                    self._fail(item[1], e)
+                elif self.on_status is not None:
+                    self.on_status(f"Injector worker: {e}")
+
+    def _send_play(self, instance, plan, trigger_time, streams, dropping):
+        if plan is not None:
+            plan_id = self._send_plan(instance.macro, plan, streams, dropping)
+        else:
+            # Views are compiled lazily, once per play; the worker drops
+            # the steps when the instance finishes
+            plan_id = next(self._plan_ids)
+            macro = instance.macro
+            self._begin(plan_id, view_steps(macro, macro.views[instance.view], self.injector),
+                        streams, transient=True)
+        self._instance_plans[instance.id] = plan_id
+        self._send(PLAY_HEADER.pack(PLAY, instance.id, plan_id, instance.priority, instance.loops,
+                                    math.nan if trigger_time is None else trigger_time - self._clock_offset)
+                   + _pack_text(instance.macro.name))
+
+    def _fail_plan(self, plan_id, error):
+        # A plan that couldn't be sent in full: the worker drops what it
+        # has and the instances playing it end with the error
+        self._send(ID.pack(PLAN_DROP, plan_id))
+        for macro, (_, sent_id) in list(self._plans.items()):
+            if sent_id == plan_id:
+                del self._plans[macro]
+        for instance in self.instances:
+            if self._instance_plans.get(instance.id) == plan_id:
+                self._fail(instance, error)
+
+    def _fail(self, instance, error):
+        instance.report.error = str(error)
+        self._send(ID.pack(CANCEL, instance.id))
+        self._finish(instance, stopped=True)
+        if self.on_status is not None:
+            self.on_status(f"Injector worker: {instance.macro.name} failed: {error}")
+
+    def _receive_loop(self):
+        while True:
+            for message in self._events.get_all():
+                self._handle(message)
+            if not self._process.is_alive():
+                for message in self._events.get_all():
+                    self._handle(message)
+                break
+            self._events.wait(STATUS_INTERVAL)
+        # Whatever was still playing ended with the worker
+        for instance in self.instances:
+            self._finish(instance, stopped=True)
+        if self.on_status is not None and not self._closing:
+            self.on_status("Injector worker stopped")
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == PROGRESS:
+            _, instance_id, steps, loops = PROGRESS_EVENT.unpack(message)
+            instance = self._instances.get(instance_id)
+            if instance is not None:
+                instance.report.steps = steps
+                instance.report.loops = loops
+        elif kind == DONE:
+            _, instance_id, *fields, stopped = DONE_EVENT.unpack_from(message)
+            instance = self._instances.get(instance_id)
+            if instance is not None:
+                report = instance.report
+                report.steps, report.loops, report.max_late, report.total_late, report.drift, report.duration = fields
+                error = _unpack_text(message, DONE_EVENT.size)[0]
+                if error:
+                    report.error = error
+                self._finish(instance, stopped)
+        elif kind == STATE:
+            instance = self._instances.get(ID.unpack_from(message)[1])
+            if instance is not None:
+                instance.state = _unpack_text(message, ID.size)[0]
+        elif kind == LATENCY:
+            self.trigger_latency.add(LATENCY_EVENT.unpack(message)[1])
+        elif kind == READY:
+            _, self.pid, worker_clock = READY_EVENT.unpack(message)
+            # perf_counter() is one system-wide clock on Windows and Linux,
+            # so the two readings only differ by the time this event took
+            # to arrive. Where each process has a clock of its own they
+            # differ by far more, and trigger times are shifted by the
+            # difference, off by no more than that delivery time.
+            offset = time.perf_counter() - worker_clock
+            if abs(offset) > CLOCK_SLACK:
+                self._clock_offset = offset
+            if self.on_status is not None:
+                self.on_status(f"Injector worker running (pid {self.pid})")
+        elif kind == ERROR:
+            if self.on_status is not None:
+                self.on_status(_unpack_text(message, KIND.size)[0])
+
+    def _finish(self, instance, stopped=False):
+        with self._lock:
+            if self._instances.pop(instance.id, None) is None:
+                return
+        self._instance_plans.pop(instance.id, None)
+        if instance.state != CANCELLED:
+            instance.state = FINISHED
+        instance.report.stopped = stopped
+        self.last_report = instance.report
+        if self.on_finished:
+            self.on_finished(instance.report)
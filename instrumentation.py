@@ -0,0 +1,241 @@
+import csv
+import json
+import threading
+import time
+from array import array
+from collections import deque
+from functools import wraps
+
+SUB_BUCKET_BITS = 7  # 64 buckets per power of two, under 2% error
+MAX_TRACE_STEPS = 1000000  # Per step rows kept for CSV export, histograms go on
+MAX_RUNS = 20
+
+
+class Histogram:
+    # HDR-style histogram of non-negative integers (nanoseconds here).
+    # Values below 2**SUB_BUCKET_BITS get a bucket each; above that every
+    # power of two is split into the same number of buckets, so relative
+    # precision is constant and record() is a shift and an add.
+    __slots__ = ('counts', 'count', 'total', 'min', 'max', '_half')
+
+    def __init__(self):
+        self._half = 1 << (SUB_BUCKET_BITS - 1)
+        self.counts = array('Q')
+        self.reset()
+
+    def reset(self):
+        del self.counts[:]
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift < 0:
+            return value
+        return shift * self._half + (value >> shift)
+
+    def _bounds(self, index):
+        shift = max(0, index // self._half - 1)
+        low = (index - shift * self._half) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend(array('Q', [0]) * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend(array('Q', [0]) * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(1, round(self.count * percent / 100.0))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                low, high = self._bounds(index)
+                return min((low + high) // 2, self.max)
+        return self.max
+
+    def buckets(self):
+        # (lowest value, highest value, count) of every non-empty bucket
+        return [(*self._bounds(index), count) for index, count in enumerate(self.counts) if count]
+
+    def to_dict(self, scale=1e-6):
+        # Summary in milliseconds by default, buckets stay in raw units
+        return {
+            'count': self.count,
+            'min': (self.min or 0) * scale,
+            'mean': self.mean * scale,
+            'p50': self.percentile(50) * scale,
+            'p90': self.percentile(90) * scale,
+            'p99': self.percentile(99) * scale,
+            'p999': self.percentile(99.9) * scale,
+            'max': self.max * scale,
+            'buckets': self.buckets(),
+        }
+
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        return (f"n={self.count} mean {self.mean / 1e6:.3f} p50 {self.percentile(50) / 1e6:.3f} "
+                f"p99 {self.percentile(99) / 1e6:.3f} max {self.max / 1e6:.3f} ms")
+
+
+class RunTrace:
+    # Timing of every step of one macro instance, times are perf_counter()
+    # seconds stored relative to the start of the run
+    def __init__(self, instrumentation, macro_name, instance_id, started):
+        self.instrumentation = instrumentation
+        self.macro_name = macro_name
+        self.instance_id = instance_id
+        self.started = started
+        self.wall_time = time.time()
+        self.scheduled = array('d')
+        self.dispatched = array('d')
+        self.injection = array('d')
+        self.lateness = Histogram()
+        self.injection_time = Histogram()
+        self.truncated = False
+        self.report = None
+
+    def add_step(self, scheduled, dispatched, done):
+        late = dispatched - scheduled
+        injection = done - dispatched
+        self.lateness.record(late * 1e9)
+        self.injection_time.record(injection * 1e9)
+        instrumentation = self.instrumentation
+        instrumentation.lateness.record(late * 1e9)
+        instrumentation.injection_time.record(injection * 1e9)
+        if len(self.scheduled) < MAX_TRACE_STEPS:
+            self.scheduled.append(scheduled - self.started)
+            self.dispatched.append(dispatched - self.started)
+            self.injection.append(injection)
+        else:
+            self.truncated = True
+
+    def finish(self, report):
+        self.report = report
+        self.instrumentation.finish_run(self)
+
+    @property
+    def title(self):
+        return f"{time.strftime('%H:%M:%S', time.localtime(self.wall_time))} {self.macro_name} #{self.instance_id}"
+
+    def to_dict(self):
+        data = {
+            'macro': self.macro_name,
+            'instance': self.instance_id,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.wall_time)),
+            'steps': self.lateness.count,
+            'truncated': self.truncated,
+            'lateness_ms': self.lateness.to_dict(),
+            'injection_ms': self.injection_time.to_dict(),
+        }
+        report = self.report
+        if report is not None:
+            data.update(loops=report.loops, duration=report.duration, drift_ms=report.drift * 1000,
+                        stopped=report.stopped)
+        return data
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['step', 'scheduled_ms', 'dispatched_ms', 'late_ms', 'injection_ms'])
+            for step, (scheduled, dispatched, injection) in enumerate(
+                    zip(self.scheduled, self.dispatched, self.injection)):
+                writer.writerow([step, f"{scheduled * 1000:.4f}", f"{dispatched * 1000:.4f}",
+                                 f"{(dispatched - scheduled) * 1000:.4f}", f"{injection * 1000:.4f}"])
+
+
+class Instrumentation:
+    # Collects playback and listener timings while attached to a
+    # MacroScheduler; with no Instrumentation attached the hot paths only
+    # pay for an "is None" check
+    def __init__(self):
+        self.lateness = Histogram()
+        self.injection_time = Histogram()
+        self.listener = {}
+        self.runs = deque(maxlen=MAX_RUNS)
+        self._lock = threading.Lock()
+
+    def start_run(self, macro, instance_id, started):
+        return RunTrace(self, macro.name, instance_id, started)
+
+    def finish_run(self, trace):
+        with self._lock:
+            self.runs.append(trace)
+
+    def finished_runs(self):
+        with self._lock:
+            return list(self.runs)
+
+    def listener_done(self, kind, start):
+        histogram = self.listener.get(kind)
+        if histogram is None:
+            histogram = self.listener[kind] = Histogram()
+        histogram.record((time.perf_counter() - start) * 1e9)
+
+    def reset(self):
+        self.lateness.reset()
+        self.injection_time.reset()
+        self.listener = {}
+        with self._lock:
+            self.runs.clear()
+
+    def summary(self):
+        lines = [f"Step lateness:   {self.lateness.summary()}",
+                 f"Injection time:  {self.injection_time.summary()}"]
+        for kind, histogram in sorted(self.listener.items()):
+            lines.append(f"Listener {kind + ':':<8} {histogram.summary()}")
+        return "\n".join(lines)
+
+
+def timed_callback(kind):
+    # For listener callbacks on an object with an instrumentation
+    # attribute: times the call when instrumentation is switched on
+    def decorate(method):
+        @wraps(method)
+        def callback(self, *args):
+            instrumentation = self.instrumentation
+            if instrumentation is None:
+                return method(self, *args)
+            start = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                instrumentation.listener_done(kind, start)
+        return callback
+    return decorate
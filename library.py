@@ -0,0 +1,389 @@
+import json
+import multiprocessing
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from math import isfinite
+
+from macrofile import EXTENSION, encode_macro, read_macro_file
+from models import (ACTION_TYPES, TYPE_CODES, NONE, CLICK, KEY_PRESS, KEY_RELEASE, CALL, Profile, Macro,
+                    ActionTable, button_to_str)
+from storage import apply_macro_meta, atomic_write, macro_meta
+
+# Bulk import and export of macro libraries. Files are parsed, validated
+# and converted in a process pool; only the merge into the store runs in
+# the calling process, and it lands with a single index write.
+#
+# Formats: a .json file holds one profile ({"name", "macros",
+# "button_assignments"}, actions as in the legacy profiles file) or a list
+# of them. A .t4m file is one macro; its profile is the directory it is
+# in, whose profile.json holds the settings and button assignments (and
+# imports like any other .json file).
+
+MANIFEST = 'profile.json'
+MIN_COORD = -32768  # Limits of the Windows virtual screen
+MAX_COORD = 32767
+MAX_ERRORS = 20  # Listed per file, the rest are only counted
+
+NAMES_UNCHECKED = "key and button names not checked, pynput can't be loaded here"
+
+_names = None
+
+
+class FileReport:
+    def __init__(self, path):
+        self.path = path
+        # (profile name, button assignments, [(macro name, settings, ActionTable)])
+        self.profiles = []
+        self.errors = []
+        self.warnings = []
+        self.hidden = 0
+        self.macros = 0  # Imported or exported
+
+    def error(self, message):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(message)
+        else:
+            self.hidden += 1
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def summary(self):
+        lines = [f"{self.path}: {self.macros} macros"
+                 + (f", {len(self.errors) + self.hidden} errors" if self.errors else "")]
+        lines.extend(f"  error: {message}" for message in self.errors)
+        if self.hidden:
+            lines.append(f"  ... and {self.hidden} more errors")
+        lines.extend(f"  warning: {message}" for message in self.warnings)
+        return "\n".join(lines)
+
+
+def _key_names():
+    # Mouse button and key names pynput knows on this platform, or None
+    # when it can't be loaded (no display, say) and names can't be checked
+    global _names
+    if _names is None:
+        try:
+            from pynput.keyboard import Key
+            from pynput.mouse import Button
+        except ImportError:
+            _names = False
+        else:
+            _names = (set(Button.__members__), set(Key.__members__))
+    return _names or None
+
+
+def _value_error(code, value, names):
+    if code == CALL:
+        return None if value else "a call without a macro name"
+    if names is None or not isinstance(value, str):
+        return None
+    buttons, keys = names
+    if code == CLICK:
+        name = value[len('Button.'):] if value.startswith('Button.') else value
+        return None if name in buttons else f"unknown mouse button {value!r}"
+    if code in (KEY_PRESS, KEY_RELEASE):
+        if value.startswith('Key.'):
+            return None if value[len('Key.'):] in keys else f"unknown key {value!r}"
+        if len(value) == 1 or (len(value) == 3 and value[0] == value[-1] == "'"):
+            return None
+        if len(value) >= 3 and value[0] == '<' and value[-1] == '>' and value[1:-1].isdigit():
+            return None
+        return f"unresolvable key name {value!r}"
+    return None
+
+
+def _first_rows(rows):
+    rows = list(rows)
+    shown = ", ".join(str(row) for row in rows[:5])
+    return f"row {shown}" if len(rows) == 1 else f"{len(rows)} rows ({shown}{', ...' if len(rows) > 5 else ''})"
+
+
+def validate_table(table, where, report, source_rows=None):
+    # source_rows maps table rows to the rows of the file for messages
+    def rows_at(rows):
+        return _first_rows(rows if source_rows is None else map(source_rows.__getitem__, rows))
+
+    types = table.types
+    if types and max(types) >= len(ACTION_TYPES):
+        unknown = [i for i, code in enumerate(types) if code >= len(ACTION_TYPES)]
+        report.error(f"{where}: unknown action type at {rows_at(unknown)}")
+    outside = [i for i, (x, y) in enumerate(zip(table.xs, table.ys))
+               if (x != NONE and not MIN_COORD <= x <= MAX_COORD) or (y != NONE and not MIN_COORD <= y <= MAX_COORD)]
+    if outside:
+        report.error(f"{where}: coordinates outside {MIN_COORD}..{MAX_COORD} at {rows_at(outside)}")
+    bad_delays = [i for i, delay in enumerate(table.delays) if not (delay >= 0 and isfinite(delay))]
+    if bad_delays:
+        report.error(f"{where}: negative or invalid delay at {rows_at(bad_delays)}")
+    names = _key_names()
+    values = table.values
+    if names is None and values and NAMES_UNCHECKED not in report.warnings:
+        report.warnings.append(NAMES_UNCHECKED)
+    for code, value_id in sorted(set(zip(types, table.buttons))):
+        if value_id >= 0 and code < len(ACTION_TYPES):
+            message = _value_error(code, values[value_id], names)
+            if message:
+                report.error(f"{where}: {message}")
+
+
+def table_from_dicts(actions, where, report):
+    # The table and the file row of each table row
+    table = ActionTable()
+    append = table.append_row
+    source_rows = array('l')
+    unknown = {}
+    for i, action in enumerate(actions):
+        code = TYPE_CODES.get(action.get('type'))
+        if code is None:
+            unknown.setdefault(action.get('type'), []).append(i)
+            continue
+        try:
+            append(code, action.get('x'), action.get('y'), action.get('button'), action.get('scroll_amount'),
+                   float(action.get('delay', 0)))
+            source_rows.append(i)
+        except (TypeError, ValueError, OverflowError) as e:
+            report.error(f"{where}: row {i}: {e}")
+    for action_type, rows in unknown.items():
+        report.error(f"{where}: unknown action type {action_type!r} at {_first_rows(rows)}")
+    return table, source_rows
+
+
+def _read_json(path, profile_name, report):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    for profile_data in data if isinstance(data, list) else [data]:
+        name = profile_name or profile_data.get('name') or os.path.splitext(os.path.basename(path))[0]
+        macros = []
+        for macro_name, macro_data in profile_data.get('macros', {}).items():
+            # Entries without actions are the settings of .t4m files
+            if 'actions' not in macro_data:
+                continue
+            where = f"{name}/{macro_name}"
+            table, source_rows = table_from_dicts(macro_data['actions'], where, report)
+            validate_table(table, where, report, source_rows)
+            settings = {key: value for key, value in macro_data.items() if key != 'actions'}
+            macros.append((macro_name, settings, table))
+        report.profiles.append((name, dict(profile_data.get('button_assignments', {})), macros))
+
+
+def _read_t4m(path, profile_name, report):
+    directory, file_name = os.path.split(path)
+    manifest = {}
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    name = profile_name or manifest.get('name') or os.path.basename(os.path.abspath(directory))
+    macro_name, settings = os.path.splitext(file_name)[0], {}
+    for entry_name, entry in manifest.get('macros', {}).items():
+        if entry.get('file') == file_name:
+            macro_name, settings = entry_name, entry
+            break
+    table = read_macro_file(path)
+    validate_table(table, f"{name}/{macro_name}", report)
+    report.profiles.append((name, {}, [(macro_name, settings, table)]))
+
+
+def read_file(path, profile_name=None):
+    # Runs in the pool: parses and validates one file. A file with any
+    # error is not imported at all.
+    report = FileReport(path)
+    try:
+        if path.endswith(EXTENSION):
+            _read_t4m(path, profile_name, report)
+        else:
+            _read_json(path, profile_name, report)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        report.error(f"can't read file: {e}")
+    if report.errors:
+        report.profiles = []
+    else:
+        report.macros = sum(len(macros) for _, _, macros in report.profiles)
+    return report
+
+
+def library_files(paths):
+    # Files to import from the given files and directories
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.endswith(EXTENSION) or name.endswith('.json'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def _run(func, *arg_lists, jobs=None):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs == 1 or len(arg_lists[0]) < 2:
+        return list(map(func, *arg_lists))
+    # Spawned workers everywhere, as on Windows: forking a process that
+    # runs the GUI and listener threads isn't safe
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(func, *arg_lists))
+
+
+def read_files(paths, profile_name=None, jobs=None):
+    files = list(library_files(paths))
+    return _run(read_file, files, [profile_name] * len(files), jobs=jobs)
+
+
+def merge_reports(store, reports, replace=False):
+    # Adds everything the reports read to the store's profiles, committed
+    # with one index write. A macro already in the store is only replaced
+    # with replace set; within one import the first file to have a macro
+    # wins. Returns the (profile, macro) pairs added.
+    profiles = {profile.name: profile for profile in store.profiles}
+    sources = {}
+    added = []
+    touched = False
+    for report in reports:
+        for profile_name, assignments, macros in report.profiles:
+            profile = profiles.get(profile_name)
+            if profile is None:
+                profile = profiles[profile_name] = Profile(profile_name)
+                store.profiles.append(profile)
+            touched = True
+            for button, macro_name in assignments.items():
+                if replace or button not in profile.button_assignments:
+                    profile.button_assignments[button] = macro_name
+            for macro_name, settings, table in macros:
+                key = (profile_name, macro_name)
+                if key in sources:
+                    report.error(f"{profile_name}/{macro_name} is also in {sources[key]}, skipped")
+                    report.macros -= 1
+                    continue
+                if macro_name in profile.macros and not replace:
+                    report.error(f"{profile_name}/{macro_name} already exists, skipped")
+                    report.macros -= 1
+                    continue
+                macro = Macro(macro_name)
+                apply_macro_meta(macro, settings)
+                macro.actions = table
+                profile.add_macro(macro)
+                sources[key] = report.path
+                added.append((profile, macro))
+    if touched:
+        store.macros_added(added)
+        store.flush()
+    return added
+
+
+def import_library(store, paths, profile_name=None, replace=False, jobs=None):
+    reports = read_files(paths, profile_name, jobs)
+    merge_reports(store, reports, replace)
+    return reports
+
+
+def safe_file_name(name, taken):
+    base = re.sub(r'[^\w .-]', '_', name).strip(' .') or 'unnamed'
+    file_name = base
+    number = 2
+    while file_name.lower() in taken:
+        file_name = f"{base}-{number}"
+        number += 1
+    taken.add(file_name.lower())
+    return file_name
+
+
+def _action_dicts(table):
+    values = [button_to_str(value) for value in table.values]
+    for code, x, y, button, amount, delay in zip(*table.columns()):
+        yield {
+            'type': ACTION_TYPES[code],
+            'button': values[button] if button >= 0 else None,
+            'x': None if x == NONE else x,
+            'y': None if y == NONE else y,
+            'scroll_amount': None if amount == NONE else amount,
+            'delay': delay,
+        }
+
+
+def _table(source, chunk_path):
+    # Macros not loaded in the exporting process are read from the
+    # store's chunks in the worker
+    if isinstance(source, ActionTable):
+        return source
+    table = ActionTable()
+    for name in source:
+        table.extend_table(read_macro_file(os.path.join(chunk_path, name)))
+    return table
+
+
+def write_profile_json(path, profile_name, assignments, macros, chunk_path):
+    report = FileReport(path)
+    try:
+        data = {'name': profile_name, 'button_assignments': assignments, 'macros': {}}
+        for macro_name, settings, source in macros:
+            data['macros'][macro_name] = dict(settings, actions=list(_action_dicts(_table(source, chunk_path))))
+            report.macros += 1
+        atomic_write(path, json.dumps(data))
+    except OSError as e:
+        report.error(f"can't write file: {e}")
+    return report
+
+
+def write_macro_t4m(path, source, chunk_path):
+    report = FileReport(path)
+    try:
+        atomic_write(path, encode_macro(_table(source, chunk_path)))
+        report.macros = 1
+    except OSError as e:
+        report.error(f"can't write file: {e}")
+    return report
+
+
+def _source(store, profile, macro):
+    if not macro.loaded:
+        names = store.macro_chunks(profile, macro)
+        if names is not None:
+            return names
+    table = macro.actions
+    if not all(value is None or isinstance(value, str) for value in table.values):
+        # pynput values would need pynput, and a display, to unpickle
+        table = table.copy()
+        table.values = [button_to_str(value) for value in table.values]
+    return table
+
+
+def export_library(store, profiles, directory, fmt='json', jobs=None):
+    # One .json file per profile, or with fmt 't4m' a directory per
+    # profile holding a .t4m file per macro and a profile.json
+    os.makedirs(directory, exist_ok=True)
+    taken = set()
+    if fmt == 'json':
+        paths, names, assignments, macro_lists = [], [], [], []
+        for profile in profiles:
+            paths.append(os.path.join(directory, safe_file_name(profile.name, taken) + '.json'))
+            names.append(profile.name)
+            assignments.append(dict(profile.button_assignments))
+            macro_lists.append([(name, macro_meta(macro), _source(store, profile, macro))
+                                for name, macro in profile.macros.items()])
+        return _run(write_profile_json, paths, names, assignments, macro_lists, [store.chunk_path] * len(paths),
+                    jobs=jobs)
+
+    paths, sources = [], []
+    reports = []
+    for profile in profiles:
+        profile_dir = os.path.join(directory, safe_file_name(profile.name, taken))
+        os.makedirs(profile_dir, exist_ok=True)
+        files = set()
+        manifest = {'name': profile.name, 'button_assignments': dict(profile.button_assignments), 'macros': {}}
+        for name, macro in profile.macros.items():
+            file_name = safe_file_name(name, files) + EXTENSION
+            manifest['macros'][name] = dict(macro_meta(macro), file=file_name)
+            paths.append(os.path.join(profile_dir, file_name))
+            sources.append(_source(store, profile, macro))
+        report = FileReport(os.path.join(profile_dir, MANIFEST))
+        try:
+            atomic_write(report.path, json.dumps(manifest, indent=2))
+        except OSError as e:
+            report.error(f"can't write file: {e}")
+        reports.append(report)
+    return reports + _run(write_macro_t4m, paths, sources, [store.chunk_path] * len(paths), jobs=jobs)
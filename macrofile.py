@@ -0,0 +1,134 @@
+import hashlib
+import mmap
+import sys
+import struct
+from array import array
+
+from models import ActionTable, MacroStats, NONE, button_to_str
+
+# File layout: header, string table (interned button/key names), then one
+# fixed-width record per action.
+MAGIC = b'T4WM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIdiiii')
+# type, x, y, button id, scroll amount, delay: the ActionTable column order
+RECORD = struct.Struct('<B3xiiiid')
+RECORD_WORDS = RECORD.size // 4
+STRING_LENGTH = struct.Struct('<H')
+EXTENSION = '.t4m'
+
+# Content-defined chunking: a chunk ends after a row whose fingerprint has
+# the low CHUNK_MASK bits clear, so a run of actions shared by two macros
+# is cut at the same rows in both wherever it starts
+CHUNK_MASK = (1 << 10) - 1
+MIN_CHUNK = 64
+MAX_CHUNK = 8192
+
+
+def encode_macro(table):
+    strings = bytearray()
+    for value in table.values:
+        data = button_to_str(value).encode('utf-8')
+        strings += STRING_LENGTH.pack(len(data))
+        strings += data
+    stats = table.stats()
+    min_x, min_y, max_x, max_y = stats.bbox or (NONE, NONE, NONE, NONE)
+    header = HEADER.pack(MAGIC, VERSION, 0, len(table), len(table.values), stats.duration,
+                         min_x, min_y, max_x, max_y)
+    records = b''.join(map(RECORD.pack, *table.columns()))
+    return header + bytes(strings) + records
+
+
+def _parse_header(data):
+    if len(data) < HEADER.size:
+        raise ValueError('truncated macro file')
+    magic, version, _, count, string_count, duration, min_x, min_y, max_x, max_y = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a macro file')
+    if version > VERSION:
+        raise ValueError(f'unsupported macro file version {version}')
+    bbox = None if min_x == NONE else (min_x, min_y, max_x, max_y)
+    return count, string_count, MacroStats(count, duration, bbox)
+
+
+def decode_macro(data):
+    count, string_count, stats = _parse_header(data)
+    offset = HEADER.size
+    # Button and key names stay strings, compile_plan resolves them, so
+    # loading a macro never needs pynput (or a display)
+    values = []
+    for _ in range(string_count):
+        (length,) = STRING_LENGTH.unpack_from(data, offset)
+        offset += STRING_LENGTH.size
+        values.append(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+    end = offset + count * RECORD.size
+    if len(data) < end:
+        raise ValueError('truncated macro file')
+
+    table = ActionTable()
+    if count:
+        # Each record is seven 32-bit words, so every column is a strided
+        # slice of one word array instead of a per-record unpack
+        words = array('i')
+        words.frombytes(data[offset:end])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        table.types = array('B', words[0::RECORD_WORDS])
+        table.xs = words[1::RECORD_WORDS]
+        table.ys = words[2::RECORD_WORDS]
+        table.buttons = words[3::RECORD_WORDS]
+        table.scrolls = words[4::RECORD_WORDS]
+        delay_words = array('i', bytes(8 * count))
+        delay_words[0::2] = words[5::RECORD_WORDS]
+        delay_words[1::2] = words[6::RECORD_WORDS]
+        if sys.byteorder == 'big':
+            delay_words.byteswap()
+        table.delays = array('d', delay_words.tobytes())
+    table.values = values
+    table._value_ids = {value: i for i, value in enumerate(values)}
+    table._stats = stats
+    return table
+
+
+def read_macro_stats(path):
+    with open(path, 'rb') as f:
+        return _parse_header(f.read(HEADER.size))[2]
+
+
+def read_macro_file(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return decode_macro(view)
+            finally:
+                view.release()
+
+
+def chunk_bounds(table, mask=CHUNK_MASK, min_rows=MIN_CHUNK, max_rows=MAX_CHUNK):
+    bounds = []
+    start = 0
+    for i, (code, x, y, delay) in enumerate(zip(table.types, table.xs, table.ys, table.delays)):
+        size = i + 1 - start
+        if size >= max_rows or (size >= min_rows and not (
+                (x * 73856093) ^ (y * 19349663) ^ (code * 83492791) ^ int(delay * 1000)) & mask):
+            bounds.append((start, i + 1))
+            start = i + 1
+    if start < len(table):
+        bounds.append((start, len(table)))
+    return bounds
+
+
+def chunk_name(data):
+    return hashlib.sha256(data).hexdigest()[:40] + EXTENSION
+
+
+def encode_chunks(table):
+    # (name, data) for every chunk of the table; the name is the hash of
+    # the encoded chunk, which is itself a small macro file
+    chunks = []
+    for start, end in chunk_bounds(table):
+        data = encode_macro(table.take(start, end))
+        chunks.append((chunk_name(data), data))
+    return chunks
@@ -0,0 +1,433 @@
+import re
+from array import array
+from collections.abc import MutableSequence
+from itertools import compress
+
+# A call plays another macro of the same profile, named in its button field
+ACTION_TYPES = ('move', 'click', 'key_press', 'key_release', 'scroll', 'call')
+TYPE_CODES = {name: code for code, name in enumerate(ACTION_TYPES)}
+MOVE, CLICK, KEY_PRESS, KEY_RELEASE, SCROLL, CALL = range(len(ACTION_TYPES))
+
+# Stored in the int columns for fields an action doesn't have
+NONE = -2 ** 31
+
+
+class Profile:
+    def __init__(self, name):
+        self.name = name
+        self.macros = {}
+        self.button_assignments = {}
+
+    def add_macro(self, macro):
+        # Macros resolve the sub-macros they call through their profile
+        self.macros[macro.name] = macro
+        macro.library = self.macros
+
+
+class Action:
+    __slots__ = ('type', 'button', 'x', 'y', 'scroll_amount', 'delay')
+
+    def __init__(self, action_type, **kwargs):
+        self.type = action_type
+        self.button = kwargs.get('button')
+        self.x = kwargs.get('x')
+        self.y = kwargs.get('y')
+        self.scroll_amount = kwargs.get('scroll_amount')
+        self.delay = kwargs.get('delay', 0)
+
+    @classmethod
+    def _make(cls, action_type, button, x, y, scroll_amount, delay):
+        action = cls.__new__(cls)
+        action.type = action_type
+        action.button = button
+        action.x = x
+        action.y = y
+        action.scroll_amount = scroll_amount
+        action.delay = delay
+        return action
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        return cls(data.pop('type'), **data)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Action({self.type!r}, button={self.button!r}, x={self.x}, y={self.y}, " \
+               f"scroll_amount={self.scroll_amount}, delay={self.delay})"
+
+
+class MacroStats:
+    __slots__ = ('count', 'duration', 'min_x', 'min_y', 'max_x', 'max_y')
+
+    def __init__(self, count=0, duration=0.0, bbox=None):
+        self.count = count
+        self.duration = duration  # Sum of recorded delays in milliseconds
+        self.min_x, self.min_y, self.max_x, self.max_y = bbox or (None, None, None, None)
+
+    @property
+    def bbox(self):
+        if self.min_x is None:
+            return None
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+    def add_point(self, x, y):
+        if self.min_x is None:
+            self.min_x = self.max_x = x
+            self.min_y = self.max_y = y
+            return
+        if x < self.min_x:
+            self.min_x = x
+        elif x > self.max_x:
+            self.max_x = x
+        if y < self.min_y:
+            self.min_y = y
+        elif y > self.max_y:
+            self.max_y = y
+
+    def add(self, other):
+        # Stats of two tables played one after the other
+        self.count += other.count
+        self.duration += other.duration
+        if other.min_x is not None:
+            self.add_point(other.min_x, other.min_y)
+            self.add_point(other.max_x, other.max_y)
+
+
+def _int(value):
+    return NONE if value is None else int(value)
+
+
+def _opt(value):
+    return None if value == NONE else value
+
+
+class ActionTable(MutableSequence):
+    # Columnar action storage: one typed array per field, with button and
+    # key values interned into a side table shared by every row.
+    def __init__(self, actions=()):
+        self.types = array('B')
+        self.xs = array('i')
+        self.ys = array('i')
+        self.buttons = array('i')
+        self.scrolls = array('i')
+        self.delays = array('d')
+        self.values = []
+        self._value_ids = {}
+        self.version = 0
+        self._stats = MacroStats()
+        self.extend(actions)
+
+    def _intern(self, value):
+        if value is None:
+            return -1
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self.values.append(value)
+            self._value_ids[value] = value_id
+        return value_id
+
+    def _changed(self):
+        self.version += 1
+        self._stats = None
+
+    def __len__(self):
+        return len(self.types)
+
+    def _index(self, index):
+        count = len(self.types)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('action index out of range')
+        return index
+
+    def _action(self, i):
+        button_id = self.buttons[i]
+        return Action._make(ACTION_TYPES[self.types[i]],
+                            self.values[button_id] if button_id >= 0 else None,
+                            _opt(self.xs[i]), _opt(self.ys[i]), _opt(self.scrolls[i]), self.delays[i])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ActionTable(self._action(i) for i in range(*index.indices(len(self))))
+        return self._action(self._index(index))
+
+    def __setitem__(self, index, action):
+        i = self._index(index)
+        self.types[i] = TYPE_CODES[action.type]
+        self.xs[i] = _int(action.x)
+        self.ys[i] = _int(action.y)
+        self.buttons[i] = self._intern(action.button)
+        self.scrolls[i] = _int(action.scroll_amount)
+        self.delays[i] = action.delay
+        self._changed()
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice):
+            index = self._index(index)
+            index = slice(index, index + 1)
+        for column in self.columns():
+            del column[index]
+        self._changed()
+
+    def __iter__(self):
+        values = self.values
+        make = Action._make
+        for code, x, y, button_id, scroll, delay in zip(*self.columns()):
+            yield make(ACTION_TYPES[code], values[button_id] if button_id >= 0 else None,
+                       None if x == NONE else x, None if y == NONE else y,
+                       None if scroll == NONE else scroll, delay)
+
+    def columns(self):
+        return self.types, self.xs, self.ys, self.buttons, self.scrolls, self.delays
+
+    def insert(self, index, action):
+        index = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        self.types.insert(index, TYPE_CODES[action.type])
+        self.xs.insert(index, _int(action.x))
+        self.ys.insert(index, _int(action.y))
+        self.buttons.insert(index, self._intern(action.button))
+        self.scrolls.insert(index, _int(action.scroll_amount))
+        self.delays.insert(index, action.delay)
+        self._changed()
+
+    def append(self, action):
+        self.append_row(TYPE_CODES[action.type], action.x, action.y, action.button,
+                        action.scroll_amount, action.delay)
+
+    def append_row(self, code, x=None, y=None, button=None, scroll_amount=None, delay=0):
+        self.types.append(code)
+        self.xs.append(_int(x))
+        self.ys.append(_int(y))
+        self.buttons.append(self._intern(button))
+        self.scrolls.append(_int(scroll_amount))
+        self.delays.append(delay)
+        self.version += 1
+        stats = self._stats
+        if stats is not None:
+            stats.count += 1
+            stats.duration += delay
+            if x is not None and y is not None:
+                stats.add_point(x, y)
+
+    def extend(self, actions):
+        if isinstance(actions, ActionTable):
+            self.extend_table(actions)
+            return
+        for action in actions:
+            self.append(action)
+
+    def extend_table(self, other, start=0, end=None):
+        # Column-wise append of rows start:end; only the button ids need
+        # mapping into this table's value list
+        ids = [self._intern(value) for value in other.values]
+        rows = slice(start, end)
+        self.types.extend(other.types[rows])
+        self.xs.extend(other.xs[rows])
+        self.ys.extend(other.ys[rows])
+        if ids == list(range(len(ids))):
+            self.buttons.extend(other.buttons[rows])
+        else:
+            ids.append(-1)  # So button id -1 maps to itself
+            self.buttons.extend(array('i', map(ids.__getitem__, other.buttons[rows])))
+        self.scrolls.extend(other.scrolls[rows])
+        self.delays.extend(other.delays[rows])
+        self._changed()
+
+    def take(self, start, end):
+        # Rows start:end as a table of their own, holding only the values
+        # those rows use
+        table = ActionTable()
+        table.types, table.xs, table.ys, table.scrolls, table.delays = (
+            column[start:end] for column in (self.types, self.xs, self.ys, self.scrolls, self.delays))
+        values = self.values
+        intern = table._intern
+        table.buttons = array('i', (intern(values[i]) if i >= 0 else -1 for i in self.buttons[start:end]))
+        table._stats = None
+        return table
+
+    def clear(self):
+        for column in self.columns():
+            del column[:]
+        self.values = []
+        self._value_ids = {}
+        self._changed()
+        self._stats = MacroStats()
+
+    def copy(self):
+        table = ActionTable()
+        table.types, table.xs, table.ys, table.buttons, table.scrolls, table.delays = (
+            column[:] for column in self.columns())
+        table.values = list(self.values)
+        table._value_ids = dict(self._value_ids)
+        table._stats = None
+        return table
+
+    def type_at(self, index):
+        return ACTION_TYPES[self.types[index]]
+
+    def position_at(self, index):
+        return _opt(self.xs[index]), _opt(self.ys[index])
+
+    def set_position(self, index, x, y):
+        self.xs[index] = _int(x)
+        self.ys[index] = _int(y)
+        self._changed()
+
+    def set_delay(self, index, delay):
+        if self._stats is not None:
+            self._stats.duration += delay - self.delays[index]
+        self.delays[index] = delay
+        self.version += 1
+
+    def stats(self):
+        if self._stats is None:
+            points = [(x, y) for x, y in zip(self.xs, self.ys) if x != NONE and y != NONE]
+            bbox = None
+            if points:
+                xs = [x for x, _ in points]
+                ys = [y for _, y in points]
+                bbox = (min(xs), min(ys), max(xs), max(ys))
+            self._stats = MacroStats(len(self.types), sum(self.delays), bbox)
+        return self._stats
+
+    # Bulk edits work on the columns directly; rows is any iterable of
+    # indices and defaults to every row
+    def shift_delays(self, amount, rows=None):
+        delays = self.delays
+        for i in range(len(delays)) if rows is None else rows:
+            delays[i] = max(0.0, delays[i] + amount)
+        self._changed()
+
+    def offset_positions(self, dx, dy, rows=None):
+        xs = self.xs
+        ys = self.ys
+        for i in range(len(xs)) if rows is None else rows:
+            if xs[i] != NONE:
+                xs[i] += dx
+            if ys[i] != NONE:
+                ys[i] += dy
+        self._changed()
+
+    def delete_rows(self, rows):
+        # A row's delay is the wait after it, so a deleted row's delay is
+        # folded into the row before it. Rows before the first one kept
+        # have none; theirs goes to the first row kept. Every later row,
+        # and the end of the macro, stay at the same time.
+        doomed = sorted(set(rows), reverse=True)
+        if not doomed:
+            return 0
+        delays = self.delays[:]
+        keep = bytearray(b'\x01') * len(delays)
+        for i in doomed:
+            keep[i] = 0
+            if i:
+                delays[i - 1] += delays[i]
+        # The leading deleted rows have all folded into row 0 by now
+        first = keep.find(1)
+        if first > 0:
+            delays[first] += delays[0]
+        self.types, self.xs, self.ys, self.buttons, self.scrolls, self.delays = (
+            array(column.typecode, compress(column, keep))
+            for column in (self.types, self.xs, self.ys, self.buttons, self.scrolls, delays))
+        self._changed()
+        return len(doomed)
+
+    def rows_of_type(self, codes, rows=None):
+        if rows is None:
+            # Scan the type column as bytes, which is much faster than
+            # comparing every row in Python
+            pattern = re.compile(b'[' + b''.join(re.escape(bytes([code])) for code in codes) + b']')
+            return array('l', (match.start() for match in pattern.finditer(self.types.tobytes())))
+        types = self.types
+        return array('l', (i for i in rows if types[i] in codes))
+
+    def rows_in_area(self, min_x, min_y, max_x, max_y, rows=None):
+        xs = self.xs
+        ys = self.ys
+        return array('l', (i for i in (range(len(xs)) if rows is None else rows)
+                           if xs[i] != NONE and min_x <= xs[i] <= max_x and min_y <= ys[i] <= max_y))
+
+
+class Macro:
+    def __init__(self, name):
+        self.name = name
+        self._actions = ActionTable()
+        self._loader = None
+        self._stats = None
+        self.plan = None  # Cached execution plan, see plan.get_plan
+        self.analysis = None  # Cached dry run, see analysis.get_analysis
+        self.library = None  # Macros this one can call, see Profile.add_macro
+        self.views = {}  # Named transform chains, see transforms.py
+        self.repeat = False
+        self.loops = 0  # Runs when repeating, 0 = until stopped
+        self.priority = 0
+        self.trigger_on_press = True
+        self.delay = 10  # Default delay in milliseconds
+        self.speed = 1.0  # Playback speed multiplier
+        self.max_gap = 0  # Cap on any single delay in milliseconds, 0 = off
+
+    @property
+    def actions(self):
+        if self._loader is not None:
+            self._actions = self._loader()
+            self._loader = None
+            self._stats = None
+        return self._actions
+
+    @actions.setter
+    def actions(self, actions):
+        self._loader = None
+        self._stats = None
+        self.plan = None
+        self.analysis = None
+        self._actions = actions if isinstance(actions, ActionTable) else ActionTable(actions)
+
+    def invalidate_plan(self):
+        self.plan = None
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def set_loader(self, loader, stats=None):
+        # Actions are decoded by loader() on first access; stats can be
+        # answered from stored metadata until then
+        self._actions = None
+        self._loader = loader
+        self._stats = stats
+
+    @property
+    def stats(self):
+        if self._loader is not None and self._stats is not None:
+            return self._stats
+        return self.actions.stats()
+
+
+def button_to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    # Button.left, Key.shift, 'a' or <65> for pynput values
+    return str(value)
+
+
+def button_from_str(text):
+    if not isinstance(text, str):
+        return text
+    if text.startswith('Button.'):
+        from pynput.mouse import Button
+        return Button[text[len('Button.'):]]
+    if text.startswith('Key.'):
+        from pynput.keyboard import Key
+        return Key[text[len('Key.'):]]
+    if len(text) >= 3 and text[0] == text[-1] == "'":
+        from pynput.keyboard import KeyCode
+        return KeyCode.from_char(text[1:-1])
+    if len(text) >= 3 and text[0] == '<' and text[-1] == '>':
+        from pynput.keyboard import KeyCode
+        return KeyCode.from_vk(int(text[1:-1]))
+    return text
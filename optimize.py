@@ -0,0 +1,86 @@
+from math import hypot
+
+DEFAULT_TOLERANCE = 2
+DEFAULT_MERGE_WINDOW = 50  # milliseconds
+
+
+def coalesce_moves(actions, tolerance=DEFAULT_TOLERANCE, window=DEFAULT_MERGE_WINDOW):
+    # Merged moves keep the latest position and the summed delay, so the
+    # pointer ends up in the same place and later actions keep their timing
+    result = []
+    for action in actions:
+        previous = result[-1] if result else None
+        if (action.type == 'move' and previous is not None and previous.type == 'move'
+                and previous.delay <= window
+                and hypot(action.x - previous.x, action.y - previous.y) <= tolerance):
+            previous.x = action.x
+            previous.y = action.y
+            previous.delay += action.delay
+        else:
+            result.append(action)
+    return result
+
+
+def _rdp_keep(points, epsilon):
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        norm = hypot(dx, dy)
+        best = -1.0
+        index = first
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                distance = hypot(x - x1, y - y1)
+            if distance > best:
+                best = distance
+                index = i
+        if best > epsilon:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+
+def simplify_path(actions, epsilon=DEFAULT_TOLERANCE):
+    # Ramer-Douglas-Peucker over every run of consecutive moves. Only moves
+    # inside a run are dropped; the delay of a dropped move is folded into
+    # the action before it so the timing of everything kept is unchanged.
+    actions = list(actions)
+    result = []
+    i = 0
+    count = len(actions)
+    while i < count:
+        if actions[i].type != 'move':
+            result.append(actions[i])
+            i += 1
+            continue
+        end = i
+        while end < count and actions[end].type == 'move':
+            end += 1
+        run = actions[i:end]
+        if len(run) > 2:
+            keep = _rdp_keep([(a.x, a.y) for a in run], epsilon)
+            for action, kept in zip(run, keep):
+                if kept:
+                    result.append(action)
+                else:
+                    result[-1].delay += action.delay
+        else:
+            result.extend(run)
+        i = end
+    return result
+
+
+def optimize_actions(actions, tolerance=DEFAULT_TOLERANCE, window=DEFAULT_MERGE_WINDOW):
+    before = len(actions)
+    actions = simplify_path(coalesce_moves(actions, tolerance, window), tolerance)
+    return actions, before - len(actions)
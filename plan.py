@@ -0,0 +1,226 @@
+from models import MOVE, CLICK, KEY_PRESS, KEY_RELEASE, SCROLL, CALL, NONE, button_from_str
+
+MIN_SPEED = 0.25
+MAX_SPEED = 20.0
+
+MISSING = object()
+
+
+def scaled_delay(delay, speed=1.0, max_gap=0):
+    delay = delay / speed
+    if max_gap and delay > max_gap:
+        return max_gap
+    return delay
+
+
+class PynputInjector:
+    def __init__(self, mouse=None, keyboard=None):
+        if mouse is None:
+            from pynput.mouse import Controller as MouseController
+            mouse = MouseController()
+        if keyboard is None:
+            from pynput.keyboard import Controller as KeyboardController
+            keyboard = KeyboardController()
+        self.mouse = mouse
+        self.keyboard = keyboard
+
+    def move(self, x, y):
+        self.mouse.position = (x, y)
+
+    def click(self, button):
+        self.mouse.click(button)
+
+    def press(self, key):
+        self.keyboard.press(key)
+
+    def release(self, key):
+        self.keyboard.release(key)
+
+    def scroll(self, amount):
+        self.mouse.scroll(0, amount)
+
+
+def mouse_button(value):
+    value = button_from_str(value)
+    if isinstance(value, str):
+        from pynput.mouse import Button
+        return Button[value]
+    return value
+
+
+class ExecutionPlan:
+    # A macro flattened into steps of (ops, delay). Each op is
+    # (kind, bound injector call, args); a step's ops are injected
+    # back-to-back and the next step is due delay seconds later.
+    __slots__ = ('steps', 'actions', 'version', 'injector', 'speed', 'max_gap', 'removed', 'calls')
+
+    def __init__(self, steps, actions, injector, speed, max_gap, removed, calls=()):
+        self.steps = steps
+        self.actions = actions
+        self.version = actions.version
+        self.injector = injector
+        self.speed = speed
+        self.max_gap = max_gap
+        self.removed = removed
+        # (library, name, macro, actions, version) of every sub-macro
+        # inlined into the steps
+        self.calls = calls
+
+    def matches(self, macro, injector):
+        return (self.actions is macro.actions and self.version == self.actions.version
+                and self.injector is injector and self.speed == macro.speed
+                and self.max_gap == macro.max_gap and calls_unchanged(self.calls))
+
+
+def calls_unchanged(calls):
+    # Whether every (library, name, macro, actions, version) recorded while
+    # expanding calls still names the same, unedited macro
+    return all(library.get(name) is called and called.actions is actions and actions.version == version
+               for library, name, called, actions, version in calls)
+
+
+def action_rows(table, library=None, stack=(), calls=None):
+    # The actions of a table as (code, x, y, value, scroll, delay) rows,
+    # zipped straight from the columns; button id -1 picks the None
+    # appended to the value list
+    values = table.values + [None]
+    rows = zip(table.types, table.xs, table.ys, map(values.__getitem__, table.buttons), table.scrolls, table.delays)
+    if CALL not in table.types:
+        return rows
+    return _expand_calls(rows, library, stack, calls)
+
+
+def _expand_calls(rows, library, stack, calls):
+    # Sub-macro calls are expanded in place. The call row is still yielded
+    # after the called macro's rows so its own delay is kept, and a macro
+    # already being expanded is never called again.
+    for row in rows:
+        if row[0] == CALL and library and row[3] is not None:
+            called = library.get(row[3])
+            if called is not None and called not in stack:
+                if calls is not None:
+                    calls.append((library, called.name, called, called.actions, called.actions.version))
+                yield from action_rows(called.actions, called.library, stack + (called,), calls)
+        yield row
+
+
+class StepCompiler:
+    # Turns a stream of action rows into playback steps. Moves within one
+    # zero-delay batch only keep the last position, so the number of moves
+    # dropped that way is counted in removed once the stream is done.
+    def __init__(self, injector, speed=1.0, max_gap=0):
+        self.injector = injector
+        self.speed = min(max(speed, MIN_SPEED), MAX_SPEED)
+        self.max_gap = max_gap
+        self.removed = 0
+
+    def steps(self, rows):
+        speed = self.speed
+        max_gap = self.max_gap
+        injector = self.injector
+        move = injector.move
+        click = injector.click
+        press = injector.press
+        release = injector.release
+        scroll = injector.scroll
+
+        # Resolve each button/key value once rather than once per action
+        keys = {}
+        buttons = {}
+
+        ops = []
+        pending_step = None  # Held back in case an empty batch adds to its delay
+        position = None  # Unknown until the plan moves the pointer itself
+        pending_move = None
+        removed = 0
+        for code, x, y, value, amount, delay in rows:
+            if code == MOVE:
+                if pending_move is not None:
+                    removed += 1
+                pending_move = (x, y)
+            else:
+                if code == CLICK:
+                    # Clicks carry their own position, so an earlier move in
+                    # the same batch is overwritten before anyone sees it
+                    if pending_move is not None:
+                        removed += 1
+                    pending_move = (x, y)
+                if pending_move is not None:
+                    if pending_move != position:
+                        ops.append((MOVE, move, pending_move))
+                        position = pending_move
+                    else:
+                        removed += 1
+                    pending_move = None
+                if value is not None:
+                    if code == CLICK:
+                        button = buttons.get(value, MISSING)
+                        if button is MISSING:
+                            try:
+                                button = mouse_button(value)
+                            except (KeyError, ValueError):
+                                button = None
+                            buttons[value] = button
+                        if button is not None:
+                            ops.append((CLICK, click, (button,)))
+                    elif code == KEY_PRESS or code == KEY_RELEASE:
+                        key = keys.get(value, MISSING)
+                        if key is MISSING:
+                            try:
+                                key = button_from_str(value)
+                            except (KeyError, ValueError):
+                                key = value
+                            keys[value] = key
+                        ops.append((code, press if code == KEY_PRESS else release, (key,)))
+                if code == SCROLL and amount != NONE:
+                    ops.append((SCROLL, scroll, (amount,)))
+
+            if delay <= 0:
+                continue
+            delay /= speed
+            if max_gap and delay > max_gap:
+                delay = max_gap
+            delay /= 1000.0
+            if pending_move is not None:
+                if pending_move != position:
+                    ops.append((MOVE, move, pending_move))
+                    position = pending_move
+                else:
+                    removed += 1
+                pending_move = None
+            if ops:
+                if pending_step is not None:
+                    yield pending_step
+                pending_step = (tuple(ops), delay)
+                ops = []
+            elif pending_step is not None:
+                # Nothing left to inject in this batch, keep its time
+                pending_step = (pending_step[0], pending_step[1] + delay)
+            else:
+                pending_step = ((), delay)
+
+        if pending_move is not None:
+            if pending_move != position:
+                ops.append((MOVE, move, pending_move))
+            else:
+                removed += 1
+        if pending_step is not None:
+            yield pending_step
+        if ops:
+            yield tuple(ops), 0.0
+        self.removed = removed
+
+
+def compile_plan(macro, injector):
+    table = macro.actions
+    calls = []
+    compiler = StepCompiler(injector, macro.speed, macro.max_gap)
+    steps = list(compiler.steps(action_rows(table, macro.library, (macro,), calls)))
+    return ExecutionPlan(steps, table, injector, macro.speed, macro.max_gap, compiler.removed, tuple(calls))
+
+
+def get_plan(macro, injector):
+    plan = macro.plan
+    if plan is None or not plan.matches(macro, injector):
+        plan = macro.plan = compile_plan(macro, injector)
+    return plan
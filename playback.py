@@ -0,0 +1,391 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+from collections import deque
+
+from models import KEY_PRESS, KEY_RELEASE
+from plan import get_plan
+from transforms import view_steps
+
+PLAYING = 'playing'
+PAUSED = 'paused'
+CANCELLED = 'cancelled'
+FINISHED = 'finished'
+
+# How overlapping instances share a key: 'share' keeps the key down until
+# the last holder releases it, 'priority' lets only the highest priority
+# holder press and release it
+KEY_SHARE = 'share'
+KEY_PRIORITY = 'priority'
+
+# Sleep until this close to a deadline, then spin for the rest
+SPIN_THRESHOLD = 0.002
+
+# A step source yields this when its next step hasn't arrived yet; the
+# instance is set aside until wake() is called for it
+STALLED = object()
+
+class PlaybackReport:
+    def __init__(self, macro_name, instance_id=None):
+        self.macro_name = macro_name
+        self.instance_id = instance_id
+        self.steps = 0
+        self.loops = 0
+        self.max_late = 0.0
+        self.total_late = 0.0
+        self.drift = 0.0
+        self.duration = 0.0
+        self.stopped = False
+        self.error = None
+
+    @property
+    def mean_late(self):
+        return self.total_late / self.steps if self.steps else 0.0
+
+    def summary(self):
+        text = (f"{self.macro_name}: {self.steps} steps in {self.duration:.3f}s, "
+                f"drift {self.drift * 1000:.3f} ms, "
+                f"mean late {self.mean_late * 1000:.3f} ms, max late {self.max_late * 1000:.3f} ms")
+        if self.error:
+            text += f", failed: {self.error}"
+        return text
+
+
+class LatencyStats:
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def summary(self):
+        if not self.count:
+            return "no triggers yet"
+        mean = sum(self.samples) / len(self.samples)
+        return (f"{self.count} triggers, mean {mean * 1000:.3f} ms, "
+                f"p99 {self.percentile(99) * 1000:.3f} ms, max {self.max * 1000:.3f} ms")
+
+
+class MacroInstance:
+    def __init__(self, instance_id, macro, source, priority, loops, trigger_time, view=None):
+        self.id = instance_id
+        self.macro = macro
+        self.view = view
+        self.priority = priority
+        self.loops = loops  # Total runs, 0 = until cancelled
+        self.trigger_time = trigger_time
+        self.state = PLAYING
+        self.index = 0
+        self.deadline = 0.0
+        self.generation = 0
+        self.started = 0.0
+        self.paused_at = 0.0
+        self.paused_time = 0.0
+        self.held_keys = set()
+        self.stalled = False  # Waiting for its source, see STALLED
+        self.woken = False
+        self.report = PlaybackReport(macro.name, instance_id)
+        # source() starts a new iterator over the steps of one run; the
+        # next step is fetched right after the current one is injected
+        self.source = source
+        self.steps = source()
+        self.next_step = next(self.steps, None)
+        self.trace = None  # RunTrace while instrumentation is on
+
+
+class MacroScheduler:
+    # Plays any number of macro instances from one thread. Every instance
+    # has an absolute deadline for its next action; a heap ordered by
+    # (deadline, priority) decides which instance runs next, so injection
+    # time and event loop stalls never accumulate as drift.
+    def __init__(self, injector, on_finished=None, key_policy=KEY_SHARE, instrumentation=None):
+        self.injector = injector
+        self.on_finished = on_finished
+        self.key_policy = key_policy
+        self.instrumentation = instrumentation
+        self.last_report = None
+        self.trigger_latency = LatencyStats()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._instances = {}
+        self._ids = itertools.count(1)
+        self._sequence = itertools.count()
+        self._key_holders = {}
+        self._closed = False
+        self._thread = None
+
+    @property
+    def instances(self):
+        return list(self._instances.values())
+
+    def find(self, macro):
+        for instance in list(self._instances.values()):
+            if instance.macro is macro:
+                return instance
+        return None
+
+    def _push(self, instance):
+        # Called with the lock held. Stale heap entries from before a pause
+        # or cancel are recognised by their generation and skipped.
+        instance.generation += 1
+        heapq.heappush(self._heap, (instance.deadline, -instance.priority, next(self._sequence),
+                                    instance.generation, instance))
+        self._cond.notify_all()
+
+    def prepare(self, macro):
+        # Compile now rather than on the first play
+        get_plan(macro, self.injector)
+
+    def play(self, macro, priority=None, loops=None, trigger_time=None, view=None, source=None):
+        # trigger_time is the perf_counter() time of the input event that
+        # started this run, used to measure trigger-to-injection latency.
+        # A view plays the macro through one of its transform chains,
+        # compiled step by step as playback goes instead of cached.
+        # source, a callable returning an iterator of steps, plays steps
+        # compiled elsewhere instead.
+        if priority is None:
+            priority = macro.priority
+        if loops is None:
+            loops = macro.loops if macro.repeat else 1
+        if source is None:
+            if view is None:
+                source = get_plan(macro, self.injector).steps.__iter__
+            else:
+                stages = macro.views[view]
+                source = lambda: view_steps(macro, stages, self.injector)
+        with self._cond:
+            instance = MacroInstance(next(self._ids), macro, source, priority, loops, trigger_time, view)
+            instance.started = instance.deadline = time.perf_counter()
+            if self.instrumentation is not None:
+                instance.trace = self.instrumentation.start_run(macro, instance.id, instance.started)
+            self._instances[instance.id] = instance
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._push(instance)
+        return instance
+
+    def pause(self, instance):
+        with self._cond:
+            if instance.state == PLAYING:
+                instance.state = PAUSED
+                instance.paused_at = time.perf_counter()
+                instance.generation += 1
+
+    def resume(self, instance):
+        with self._cond:
+            if instance.state == PAUSED:
+                paused = time.perf_counter() - instance.paused_at
+                instance.paused_time += paused
+                instance.deadline += paused
+                instance.state = PLAYING
+                self._push(instance)
+
+    def wake(self, instance):
+        # More steps may have arrived for an instance whose source stalled
+        with self._cond:
+            if instance.stalled:
+                instance.stalled = False
+                if instance.state == PLAYING:
+                    self._push(instance)
+            else:
+                instance.woken = True
+
+    def cancel(self, instance):
+        with self._cond:
+            if instance.state in (PLAYING, PAUSED):
+                if instance.state == PAUSED:
+                    instance.paused_time += time.perf_counter() - instance.paused_at
+                instance.state = CANCELLED
+                instance.deadline = time.perf_counter()
+                # The scheduler thread finishes it so held keys are
+                # released from the injection thread
+                self._push(instance)
+
+    def stop(self):
+        for instance in self.instances:
+            self.cancel(instance)
+
+    def close(self):
+        self.stop()
+        with self._cond:
+            thread = self._thread
+            while self._instances and thread is not None:
+                self._cond.wait(0.1)
+            self._closed = True
+            self._cond.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _next(self):
+        clock = time.perf_counter
+        with self._cond:
+            while not self._closed:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, _, generation, instance = self._heap[0]
+                if generation != instance.generation:
+                    heapq.heappop(self._heap)
+                    continue
+                remaining = deadline - clock()
+                if remaining <= SPIN_THRESHOLD:
+                    heapq.heappop(self._heap)
+                    return instance
+                self._cond.wait(remaining - SPIN_THRESHOLD)
+            self._thread = None
+            return None
+
+    def _run(self):
+        clock = time.perf_counter
+        if sys.platform == 'win32':
+            import ctypes
+            ctypes.windll.winmm.timeBeginPeriod(1)
+        try:
+            while True:
+                instance = self._next()
+                if instance is None:
+                    break
+                try:
+                    if instance.state == CANCELLED:
+                        self._finish(instance, stopped=True)
+                        continue
+                    while clock() < instance.deadline:
+                        time.sleep(0)
+                    self._step(instance)
+                except Exception as e:
+                    # An action the injector rejects, or a bad setting such
+                    # as loops, ends its own instance; the others play on
+                    self._fail(instance, e)
+        finally:
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+            if sys.platform == 'win32':
+                ctypes.windll.winmm.timeEndPeriod(1)
+
+    def _fail(self, instance, error):
+        if instance.report.error is None:
+            instance.report.error = str(error)
+        try:
+            self._finish(instance)
+        except Exception:
+            # Only on_finished can still raise here; the instance is
+            # already gone
+            pass
+
+    def _step(self, instance):
+        clock = time.perf_counter
+        report = instance.report
+        step = instance.next_step
+        if step is None:
+            self._finish(instance)
+            return
+        if step is STALLED:
+            self._advance(instance)
+            return
+
+        dispatched = clock()
+        late = dispatched - instance.deadline
+        report.total_late += late
+        if late > report.max_late:
+            report.max_late = late
+        report.drift = late
+
+        ops, delay = step
+        for kind, call, args in ops:
+            if (kind == KEY_PRESS or kind == KEY_RELEASE) and not self._claim_key(instance, kind, args[0]):
+                continue
+            call(*args)
+        if instance.trace is not None:
+            instance.trace.add_step(instance.deadline, dispatched, clock())
+        if instance.trigger_time is not None:
+            self.trigger_latency.add(clock() - instance.trigger_time)
+            instance.trigger_time = None
+        report.steps += 1
+        instance.index += 1
+        instance.deadline += delay
+        self._advance(instance)
+
+    def _advance(self, instance):
+        # Fetch the step after the one just played. After the last run the
+        # instance is still pushed once more, so it finishes (and lets go
+        # of its keys) only when the last step's delay has passed.
+        report = instance.report
+        instance.woken = False
+        step = next(instance.steps, None)
+        if step is None:
+            report.loops += 1
+            if not instance.loops or report.loops < instance.loops:
+                instance.index = 0
+                instance.steps = instance.source()
+                step = next(instance.steps, None)
+        instance.next_step = step
+        with self._cond:
+            if step is STALLED and not instance.woken:
+                instance.stalled = True
+            elif instance.state == PLAYING:
+                self._push(instance)
+
+    def _claim_key(self, instance, kind, key):
+        # Decide whether a key press or release from this instance reaches
+        # the OS
+        with self._cond:
+            holders = self._key_holders.get(key)
+            if kind == KEY_PRESS:
+                if holders is None:
+                    holders = self._key_holders[key] = []
+                if instance not in holders:
+                    holders.append(instance)
+                    instance.held_keys.add(key)
+                if self.key_policy == KEY_PRIORITY:
+                    return max(holders, key=lambda holder: holder.priority) is instance
+                return len(holders) == 1
+            if not holders or instance not in holders:
+                return not holders
+            owner = max(holders, key=lambda holder: holder.priority)
+            holders.remove(instance)
+            instance.held_keys.discard(key)
+            if not holders:
+                del self._key_holders[key]
+                return True
+            return self.key_policy == KEY_PRIORITY and owner is instance
+
+    def _finish(self, instance, stopped=False):
+        with self._cond:
+            if self._instances.pop(instance.id, None) is None:
+                return
+            if instance.state != CANCELLED:
+                instance.state = FINISHED
+            instance.generation += 1
+        report = instance.report
+        for key in list(instance.held_keys):
+            if self._claim_key(instance, KEY_RELEASE, key):
+                try:
+                    self.injector.release(key)
+                except Exception as e:
+                    if report.error is None:
+                        report.error = str(e)
+        report.stopped = stopped
+        report.duration = time.perf_counter() - instance.started - instance.paused_time
+        if instance.trace is not None:
+            instance.trace.finish(report)
+        with self._cond:
+            self._cond.notify_all()
+        self.last_report = report
+        if self.on_finished:
+            self.on_finished(report)
@@ -0,0 +1,222 @@
+import heapq
+import time
+from collections import deque
+from math import hypot
+
+from models import ActionTable, MOVE, CLICK, KEY_PRESS, KEY_RELEASE
+from optimize import DEFAULT_MERGE_WINDOW, simplify_path
+
+RING_CAPACITY = 1 << 16
+
+
+class EventRing:
+    # Bounded single-producer/single-consumer queue. The producer only ever
+    # writes _tail and the consumer only ever writes _head, so with the GIL
+    # no lock is needed on the input hook thread.
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._head = 0
+        self._tail = 0
+        self.queued = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def push(self, event):
+        tail = self._tail
+        if tail - self._head >= self.capacity:
+            self.dropped += 1
+            return False
+        self._slots[tail % self.capacity] = event
+        self._tail = tail + 1
+        self.queued += 1
+        return True
+
+    def drain(self):
+        head = self._head
+        tail = self._tail
+        if head == tail:
+            return []
+        capacity = self.capacity
+        start = head % capacity
+        end = tail % capacity
+        if start < end:
+            events = self._slots[start:end]
+        else:
+            events = self._slots[start:] + self._slots[:end]
+        self._head = tail
+        return events
+
+    def reset(self):
+        self._head = self._tail
+        self.queued = 0
+        self.dropped = 0
+
+
+class Recorder:
+    # With a log (storage.RecordingLog) the recorded rows are handed to it
+    # in batches. Rows leave macro.actions only once the log has written
+    # them, so if the log fails macro.actions holds exactly the rows it
+    # doesn't and neither copy repeats the other.
+    def __init__(self):
+        self.macro = None
+        self.log = None
+        self._base = 0  # Rows recorded before macro.actions[0]
+        self._handed = 0  # Rows handed to the log
+        self._batch_ends = deque()  # Row count at the end of each batch not yet written
+        self._written = 0  # Batches the log has confirmed
+        self.record_timing = True
+        self.move_tolerance = 0
+        self.move_window = DEFAULT_MERGE_WINDOW
+        self.removed = 0
+        self.mouse_events = EventRing()
+        self.key_events = EventRing()
+        self._last_time = None
+
+    @property
+    def active(self):
+        return self.macro is not None
+
+    @property
+    def queued(self):
+        return self.mouse_events.queued + self.key_events.queued
+
+    @property
+    def dropped(self):
+        return self.mouse_events.dropped + self.key_events.dropped
+
+    @property
+    def pending(self):
+        return len(self.mouse_events) + len(self.key_events)
+
+    def start(self, macro, record_timing=True, move_tolerance=0, move_window=DEFAULT_MERGE_WINDOW, log=None):
+        self.log = log
+        self.record_timing = record_timing
+        self.move_tolerance = move_tolerance
+        self.move_window = move_window
+        self.removed = 0
+        self._last_time = None
+        self.mouse_events.reset()
+        self.key_events.reset()
+        self._base = self._handed = self._written = 0
+        self._batch_ends.clear()
+        self.macro = macro
+
+    def stop(self):
+        # With a log every row is in it by the time this returns
+        self.drain()
+        logged = self.log is not None
+        if logged and self.macro is not None:
+            self._write_batches(len(self.macro.actions))
+            # Waits for the log, so a failure shows up here while the rows
+            # it didn't write are still in macro.actions
+            self.log.close()
+            self._drop_written()
+        self.log = None
+        macro, self.macro = self.macro, None
+        if macro is not None and not logged and self.move_tolerance and len(macro.actions):
+            before = len(macro.actions)
+            macro.actions = simplify_path(macro.actions, self.move_tolerance)
+            self.removed += before - len(macro.actions)
+        return macro
+
+    # Listener callbacks: these run on pynput's hook threads and only
+    # timestamp the event and queue it
+    def on_move(self, x, y):
+        self.mouse_events.push((time.perf_counter(), MOVE, x, y, None))
+
+    def on_click(self, x, y, button, pressed):
+        self.mouse_events.push((time.perf_counter(), CLICK, x, y, button))
+
+    def on_key_press(self, key):
+        self.key_events.push((time.perf_counter(), KEY_PRESS, None, None, key))
+
+    def on_key_release(self, key):
+        self.key_events.push((time.perf_counter(), KEY_RELEASE, None, None, key))
+
+    def drain(self):
+        if self.macro is None:
+            return 0
+        mouse_events = self.mouse_events.drain()
+        key_events = self.key_events.drain()
+        if mouse_events and key_events:
+            events = heapq.merge(mouse_events, key_events, key=lambda event: event[0])
+        else:
+            events = mouse_events or key_events
+        count = 0
+        for event in events:
+            self._add(*event)
+            count += 1
+        log = self.log
+        if log is not None:
+            handed = self._handed - self._base
+            waiting = len(self.macro.actions) - handed
+            if waiting > log.batch_rows:
+                # Full batches only; the last row always stays behind since
+                # its delay is only known once the next event arrives
+                self._write_batches(handed + (waiting - 1) // log.batch_rows * log.batch_rows)
+            else:
+                self._drop_written()
+        return count
+
+    def detach_log(self):
+        # Goes on recording in memory alone. Call once the log is closed:
+        # rows it wrote are dropped, the rest stay.
+        if self.log is not None and self.macro is not None:
+            self._drop_written()
+        self.log = None
+        self._handed = self._base
+        self._batch_ends.clear()
+
+    def _write_batches(self, end):
+        # Hands the rows from the last batch handed over up to end to the
+        # log in batch_rows pieces
+        actions = self.macro.actions
+        batch_rows = self.log.batch_rows
+        for start in range(self._handed - self._base, end, batch_rows):
+            stop = min(end, start + batch_rows)
+            batch = actions.take(start, stop)
+            if self.move_tolerance:
+                before = len(batch)
+                batch = ActionTable(simplify_path(batch, self.move_tolerance))
+                self.removed += before - len(batch)
+            self._handed = self._base + stop
+            if len(batch):
+                self.log.write(batch)
+                self._batch_ends.append(self._handed)
+        self._drop_written()
+
+    def _drop_written(self):
+        # Drops the rows of batches the log has written since last time
+        written = self.log.written
+        end = None
+        while self._batch_ends and self._written < written:
+            end = self._batch_ends.popleft()
+            self._written += 1
+        if end is not None:
+            actions = self.macro.actions
+            self.macro.actions = actions.take(end - self._base, len(actions))
+            self._base = end
+
+    def _add(self, now, code, x, y, button):
+        macro = self.macro
+        actions = macro.actions
+        if code == MOVE and self.move_tolerance and len(actions) and self._last_time is not None:
+            if actions.types[-1] == MOVE and (now - self._last_time) * 1000.0 <= self.move_window:
+                last_x, last_y = actions.position_at(-1)
+                if hypot(x - last_x, y - last_y) <= self.move_tolerance:
+                    actions.set_position(-1, x, y)
+                    self.removed += 1
+                    return
+        if self.record_timing:
+            # Each action waits for its delay before the next one, so the
+            # measured gap belongs to the previously recorded action
+            if len(actions) and self._last_time is not None:
+                actions.set_delay(-1, round((now - self._last_time) * 1000.0, 3))
+            delay = 0
+        else:
+            delay = macro.delay
+        self._last_time = now
+        actions.append_row(code, x, y, button, None, delay)
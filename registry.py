@@ -0,0 +1,198 @@
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QConcatenateTablesProxyModel, QStringListModel
+
+
+NO_MACRO = "None"
+
+
+class NameIndex:
+    # Names in display order and the row of each, so lookups by name
+    # don't scan the list
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def append(self, name):
+        self.rows[name] = len(self.names)
+        self.names.append(name)
+
+    def remove(self, name):
+        row = self.rows.pop(name)
+        del self.names[row]
+        names = self.names
+        rows = self.rows
+        for i in range(row, len(names)):
+            rows[names[i]] = i
+        return row
+
+    def rename(self, old, new):
+        row = self.rows.pop(old)
+        self.names[row] = new
+        self.rows[new] = row
+        return row
+
+
+class NameListModel(QAbstractListModel):
+    # Shows a NameIndex; switching to another index is a model reset, and
+    # changes made through the model are signalled row by row
+    def __init__(self, names=None, parent=None):
+        super().__init__(parent)
+        self.names = names if names is not None else NameIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.names)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role not in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return None
+        return self.names.names[index.row()]
+
+    def name(self, index):
+        return self.names.names[index.row()] if index.isValid() else None
+
+    def index_of(self, name):
+        row = self.names.rows.get(name)
+        return QModelIndex() if row is None else self.index(row)
+
+    def set_names(self, names):
+        self.beginResetModel()
+        self.names = names
+        self.endResetModel()
+
+    def append(self, name):
+        row = len(self.names)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.names.append(name)
+        self.endInsertRows()
+
+    def remove(self, name):
+        row = self.names.rows[name]
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.names.remove(name)
+        self.endRemoveRows()
+
+    def rename(self, old, new):
+        index = self.index(self.names.rename(old, new))
+        self.dataChanged.emit(index, index)
+
+
+class ProfileRegistry:
+    # Profiles by name and the list models the profile list, macro list
+    # and button assignment combos share. Each profile's macro names are
+    # indexed the first time it is selected and kept up to date from then
+    # on, so selecting a profile is one model reset whatever the number
+    # of profiles.
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.by_name = {}
+        self.current = None
+        self._macro_names = {}  # profile name -> NameIndex
+        self.profile_model = NameListModel()
+        self.macro_model = NameListModel()
+        # The assignment combos list "None" and then the current macros
+        self.assignment_model = QConcatenateTablesProxyModel()
+        self._no_macro_model = QStringListModel([NO_MACRO])
+        self.assignment_model.addSourceModel(self._no_macro_model)
+        self.assignment_model.addSourceModel(self.macro_model)
+        self.reload()
+
+    def reload(self):
+        # After the profile list itself was replaced, e.g. by store.load()
+        self.by_name = {profile.name: profile for profile in self.profiles}
+        self._macro_names = {}
+        self.current = None
+        self.profile_model.set_names(NameIndex(profile.name for profile in self.profiles))
+        self.macro_model.set_names(NameIndex())
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def profile(self, name):
+        return self.by_name.get(name)
+
+    def macro_names(self, profile):
+        names = self._macro_names.get(profile.name)
+        if names is None:
+            names = self._macro_names[profile.name] = NameIndex(profile.macros)
+        return names
+
+    def _model_for(self, profile):
+        # The macro model when the profile is the one shown, else None
+        return self.macro_model if profile is self.current else None
+
+    def select(self, profile):
+        self.current = profile
+        self.macro_model.set_names(self.macro_names(profile) if profile is not None else NameIndex())
+
+    def add_profile(self, profile):
+        self.profiles.append(profile)
+        self.by_name[profile.name] = profile
+        self.profile_model.append(profile.name)
+
+    def remove_profile(self, profile):
+        self.profiles.remove(profile)
+        del self.by_name[profile.name]
+        self._macro_names.pop(profile.name, None)
+        self.profile_model.remove(profile.name)
+        if profile is self.current:
+            self.select(None)
+
+    def rename_profile(self, profile, name):
+        old = profile.name
+        self.by_name[name] = self.by_name.pop(old)
+        if old in self._macro_names:
+            self._macro_names[name] = self._macro_names.pop(old)
+        profile.name = name
+        self.profile_model.rename(old, name)
+
+    def add_macro(self, profile, macro):
+        # Replaces a macro of the same name
+        profile.add_macro(macro)
+        names = self._macro_names.get(profile.name)
+        if names is None or macro.name in names:
+            return
+        model = self._model_for(profile)
+        if model is not None:
+            model.append(macro.name)
+        else:
+            names.append(macro.name)
+
+    def remove_macro(self, profile, name):
+        macro = profile.macros.pop(name)
+        macro.library = None
+        for button, assigned in list(profile.button_assignments.items()):
+            if assigned == name:
+                del profile.button_assignments[button]
+        names = self._macro_names.get(profile.name)
+        if names is not None:
+            model = self._model_for(profile)
+            if model is not None:
+                model.remove(name)
+            else:
+                names.remove(name)
+        return macro
+
+    def rename_macro(self, profile, macro, name):
+        # Button assignments follow the macro; calls and views naming it
+        # in other macros are left as they are
+        old = macro.name
+        del profile.macros[old]
+        macro.name = name
+        profile.add_macro(macro)
+        for button, assigned in profile.button_assignments.items():
+            if assigned == old:
+                profile.button_assignments[button] = name
+        names = self._macro_names.get(profile.name)
+        if names is not None:
+            model = self._model_for(profile)
+            if model is not None:
+                model.rename(old, name)
+            else:
+                names.rename(old, name)
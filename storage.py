@@ -0,0 +1,699 @@
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from macrofile import EXTENSION, chunk_name, encode_chunks, encode_macro, read_macro_file, read_macro_stats
+from models import Profile, Macro, Action, ActionTable, MacroStats
+
+DEFAULT_PATH = 'ts4windows_profiles'
+LEGACY_FILE = 'ts4windows_profiles.json'
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 3
+MACRO_DIR = 'macros'  # Whole-macro files of index versions 1 and 2
+CHUNK_DIR = 'chunks'
+RECORDING_DIR = 'recordings'
+RECORDING_EXTENSION = '.log'
+LOCK_EXTENSION = '.lock'
+SAVE_DELAY = 0.5  # Seconds to wait for more edits before writing
+MAX_RETRY_DELAY = 30.0  # Longest wait between attempts after a failed write
+CHUNK_CACHE_ROWS = 1 << 18  # Decoded chunk rows kept for reuse by later loads
+BATCH_ROWS = 4096  # Rows per chunk written while recording
+MAX_PENDING_BATCHES = 4
+
+
+def atomic_write(path, data):
+    tmp = path + '.tmp'
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def lock_file(path):
+    # Opens path and locks it without waiting; None if another process, or
+    # another open of it in this one, holds the lock. The lock goes when
+    # the file is closed or its process dies.
+    f = open(path, 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def unlock_file(f):
+    # Releases a lock from lock_file and removes its file. Where it can
+    # be, the file is removed first so nobody locks it on its way out.
+    if fcntl is None:
+        f.close()
+    try:
+        os.remove(f.name)
+    except OSError:
+        pass
+    f.close()
+
+
+def macro_meta(macro):
+    stats = macro.stats
+    return {
+        'repeat': macro.repeat,
+        'loops': macro.loops,
+        'priority': macro.priority,
+        'trigger_on_press': macro.trigger_on_press,
+        'delay': macro.delay,
+        'speed': macro.speed,
+        'max_gap': macro.max_gap,
+        'views': macro.views,
+        'count': stats.count,
+        'duration': stats.duration,
+        'bbox': stats.bbox
+    }
+
+
+def apply_macro_meta(macro, data):
+    macro.repeat = data.get('repeat', False)
+    macro.loops = data.get('loops', 0)
+    macro.priority = data.get('priority', 0)
+    macro.trigger_on_press = data.get('trigger_on_press', True)
+    macro.delay = data.get('delay', 10)  # Default to 10ms if not specified
+    macro.speed = data.get('speed', 1.0)
+    macro.max_gap = data.get('max_gap', 0)
+    macro.views = data.get('views', {})
+
+
+def meta_stats(data):
+    if 'count' not in data:
+        return None
+    bbox = data.get('bbox')
+    return MacroStats(data['count'], data.get('duration', 0.0), tuple(bbox) if bbox else None)
+
+
+def decode_actions(data):
+    # Column-wise JSON macro files written by version 1 of the index
+    table = ActionTable()
+    table.types = array('B', data['type'])
+    table.xs = array('i', data['x'])
+    table.ys = array('i', data['y'])
+    table.buttons = array('i', data['button'])
+    table.scrolls = array('i', data['scroll'])
+    table.delays = array('d', data['delay'])
+    table.values = list(data['values'])  # Names, resolved by the plan compiler at play time
+    table._value_ids = {value: i for i, value in enumerate(table.values)}
+    table._stats = None
+    return table
+
+
+class RecordingLog:
+    # Append-only log of a recording in progress. The first line holds the
+    # profile, macro name and settings; every batch of recorded rows is
+    # then written as a chunk of its own and its name appended as a line,
+    # so after a crash the log lists exactly the chunks that reached the
+    # disk. A thread does the writing behind a short bounded queue: a slow
+    # disk holds up the recorder instead of letting batches pile up. The
+    # log is locked (see lock_file) from before it exists until it is
+    # removed, so no other store takes a live recording for a crashed one.
+    def __init__(self, path, chunk_path, profile_name, macro):
+        self.lock = lock_file(path + LOCK_EXTENSION)
+        if self.lock is None:
+            raise OSError(f"{path} is already in use")
+        self.path = path
+        self.chunk_path = chunk_path
+        self.profile_name = profile_name
+        self.macro_name = macro.name
+        self.batch_rows = BATCH_ROWS
+        self.chunks = []
+        self.written = 0  # Batches whose chunk is listed in the log
+        self.stats = MacroStats()
+        self.error = None
+        self._queue = queue.Queue(MAX_PENDING_BATCHES)
+        try:
+            self._file = open(path, 'w')
+            self._append(json.dumps({'profile': profile_name, 'macro': macro.name, 'meta': macro_meta(macro)}))
+        except OSError:
+            unlock_file(self.lock)
+            raise
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _append(self, line):
+        self._file.write(line + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        while True:
+            table = self._queue.get()
+            if table is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                data = encode_macro(table)
+                name = chunk_name(data)
+                # Listed before the file exists so a store sweep running
+                # meanwhile never takes it for garbage
+                self.chunks.append(name)
+                path = os.path.join(self.chunk_path, name)
+                if not os.path.exists(path):
+                    atomic_write(path, data)
+                self._append(name)
+                self.written += 1
+                self.stats.add(table.stats())
+            except OSError as e:
+                self.error = e
+
+    def write(self, table):
+        if self.error is not None:
+            raise self.error
+        if len(table):
+            self._queue.put(table)
+
+    def close(self):
+        # Waits for every batch to be written
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+        if self.error is not None:
+            raise self.error
+        return self.chunks
+
+
+def read_recording_log(path):
+    # (header, chunk names) of a log left behind; a line cut short by a
+    # crash is ignored
+    with open(path, 'r') as f:
+        lines = f.read().split('\n')
+    if len(lines) < 2:
+        return None, []
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return None, []
+    return header, [name for name in lines[1:-1] if name]
+
+
+class ProfileStore:
+    # Profiles and macro settings live in a small index file. Macro actions
+    # are cut into content-defined chunks stored once each under the hash
+    # of their contents, and each macro in the index lists its chunks, so
+    # actions shared between macros or profiles are only written once.
+    # Edits only mark things dirty and a background thread writes them
+    # after SAVE_DELAY of quiet, so bursts of edits turn into one write.
+    # Recordings stream their chunks to disk as they go (see RecordingLog)
+    # and finishing one only has to update the index. A write that fails
+    # leaves everything marked dirty, is retried with a growing delay and
+    # is reported through on_error(exception), called on the writer thread.
+    def __init__(self, path=DEFAULT_PATH, delay=SAVE_DELAY, on_error=None):
+        self.path = path
+        self.delay = delay
+        self.on_error = on_error
+        self.error = None  # Last failed write, None once a write succeeds
+        self.profiles = []
+        self._cond = threading.Condition()
+        self._index = None
+        self._last_index = None
+        self._macros = {}
+        self._deleted = set()
+        self._collect = False
+        self._manifests = {}  # (profile name, macro name) -> chunk names
+        self._known_chunks = set()
+        self._chunk_cache = OrderedDict()  # chunk name -> decoded table, least recently used first
+        self._chunk_cache_rows = 0
+        self._chunk_cache_lock = threading.Lock()
+        self._recordings = {}  # log path -> RecordingLog
+        self._log_locks = {}  # log path -> lock held until the log is removed
+        self.recovered = []  # (profile, macro) rebuilt from logs by load()
+        self._last_change = 0.0
+        self._retry_at = 0.0
+        self._retry_delay = delay
+        self._writing = False
+        self._closed = False
+        self._thread = None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, INDEX_FILE)
+
+    @property
+    def macro_path(self):
+        return os.path.join(self.path, MACRO_DIR)
+
+    @property
+    def chunk_path(self):
+        return os.path.join(self.path, CHUNK_DIR)
+
+    @property
+    def recording_path(self):
+        return os.path.join(self.path, RECORDING_DIR)
+
+    def read_chunks(self, names):
+        # Each macro gets a table of its own, copied from the decoded
+        # chunks; a chunk shared by several macros or repeated in one is
+        # decoded once as long as it stays in the cache
+        table = ActionTable()
+        for name in names:
+            table.extend_table(self._read_chunk(name))
+        return table
+
+    def _read_chunk(self, name):
+        # Chunk names are hashes of their contents, so a cached chunk
+        # never goes stale; the least recently used are dropped once the
+        # cache holds more than CHUNK_CACHE_ROWS rows
+        cache = self._chunk_cache
+        with self._chunk_cache_lock:
+            chunk = cache.get(name)
+            if chunk is not None:
+                cache.move_to_end(name)
+                return chunk
+        chunk = read_macro_file(os.path.join(self.chunk_path, name))
+        with self._chunk_cache_lock:
+            if name not in cache:
+                cache[name] = chunk
+                self._chunk_cache_rows += len(chunk)
+                while self._chunk_cache_rows > CHUNK_CACHE_ROWS and len(cache) > 1:
+                    _, dropped = cache.popitem(last=False)
+                    self._chunk_cache_rows -= len(dropped)
+        return chunk
+
+    def load(self, read_only=False):
+        # A read-only load writes nothing: old index versions aren't
+        # converted and recordings left behind aren't recovered
+        self.profiles.clear()
+        self._manifests = {}
+        self.recovered = []
+        if not os.path.exists(self.index_path):
+            if os.path.exists(LEGACY_FILE):
+                self.import_legacy(LEGACY_FILE, save=not read_only)
+            if not read_only:
+                self.recover_recordings()
+            return self.profiles
+
+        with open(self.index_path, 'r') as f:
+            data = json.load(f)
+        version = data.get('version', 1)
+
+        old_files = []
+        for profile_data in data['profiles']:
+            profile = Profile(profile_data['name'])
+            for macro_name, macro_data in profile_data['macros'].items():
+                macro = Macro(macro_name)
+                apply_macro_meta(macro, macro_data)
+                if version >= 3:
+                    names = macro_data.get('chunks', [])
+                    self._manifests[(profile.name, macro_name)] = names
+                    macro.set_loader(lambda names=names: self.read_chunks(names), meta_stats(macro_data))
+                else:
+                    path = os.path.join(self.macro_path, macro_data['file'])
+                    if version == 1:
+                        with open(path, 'r') as f:
+                            macro.actions = decode_actions(json.load(f))
+                    else:
+                        macro.actions = read_macro_file(path)
+                    old_files.append(path)
+                profile.add_macro(macro)
+            profile.button_assignments = profile_data.get('button_assignments', {})
+            self.profiles.append(profile)
+
+        if read_only:
+            return self.profiles
+        if version < INDEX_VERSION:
+            for profile in self.profiles:
+                for macro in profile.macros.values():
+                    self.macro_changed(profile, macro, update_index=False)
+            with self._cond:
+                self._deleted.update(old_files)
+            self.profile_changed()
+            self.flush()
+        self.recover_recordings()
+        return self.profiles
+
+    def recover_recordings(self):
+        # Turns logs of recordings that never finished into macros. A log
+        # still locked belongs to a recording in progress, here or in
+        # another process; one this store can lock is kept locked until
+        # the writer has removed it.
+        if not os.path.isdir(self.recording_path):
+            return self.recovered
+        for file_name in sorted(os.listdir(self.recording_path)):
+            path = os.path.join(self.recording_path, file_name)
+            if (not file_name.endswith(RECORDING_EXTENSION) or path in self._recordings
+                    or path in self._log_locks):
+                continue
+            lock = lock_file(path + LOCK_EXTENSION)
+            if lock is None:
+                continue
+            try:
+                header, names = read_recording_log(path)
+            except FileNotFoundError:
+                # Removed by its owner before the lock was let go
+                unlock_file(lock)
+                continue
+            names = [name for name in names if os.path.exists(os.path.join(self.chunk_path, name))]
+            if header is not None and names:
+                profile = next((p for p in self.profiles if p.name == header['profile']), None)
+                if profile is None:
+                    profile = Profile(header['profile'])
+                    self.profiles.append(profile)
+                macro_name = header['macro']
+                if macro_name in profile.macros:
+                    macro_name += " (recovered)"
+                    number = 2
+                    while macro_name in profile.macros:
+                        macro_name = f"{header['macro']} (recovered {number})"
+                        number += 1
+                macro = Macro(macro_name)
+                apply_macro_meta(macro, header.get('meta', {}))
+                stats = MacroStats()
+                for name in names:
+                    stats.add(read_macro_stats(os.path.join(self.chunk_path, name)))
+                profile.add_macro(macro)
+                self.add_recorded(profile, macro, names, stats)
+                self.recovered.append((profile, macro))
+            with self._cond:
+                self._log_locks[path] = lock
+                self._deleted.add(path)
+                self._schedule()
+        if self.recovered:
+            self.flush()
+        return self.recovered
+
+    def start_recording(self, profile, macro):
+        os.makedirs(self.recording_path, exist_ok=True)
+        os.makedirs(self.chunk_path, exist_ok=True)
+        path = os.path.join(self.recording_path, f"{time.time_ns()}{RECORDING_EXTENSION}")
+        log = RecordingLog(path, self.chunk_path, profile.name, macro)
+        with self._cond:
+            self._recordings[path] = log
+        return log
+
+    def finish_recording(self, profile, macro, log):
+        # The chunks are already on disk, so the macro only needs its
+        # entry in the index; the log goes once that is written
+        try:
+            names = log.close()
+        except OSError:
+            self.abandon_recording(log)
+            raise
+        self.add_recorded(profile, macro, names, log.stats)
+        with self._cond:
+            self._recordings.pop(log.path, None)
+            self._log_locks[log.path] = log.lock
+            self._deleted.add(log.path)
+            self._schedule()
+
+    def abandon_recording(self, log):
+        # Stops using a log that failed. It stays on disk, unlocked, so the
+        # next load recovers whatever reached it.
+        try:
+            log.close()
+        except OSError:
+            pass
+        with self._cond:
+            self._recordings.pop(log.path, None)
+        unlock_file(log.lock)
+
+    def add_recorded(self, profile, macro, names, stats):
+        names = list(names)
+        macro.set_loader(lambda: self.read_chunks(names), stats)
+        with self._cond:
+            self._macros[(profile.name, macro.name)] = names
+            self._index = self._build_index()
+            self._schedule()
+
+    def import_legacy(self, path, save=True):
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        for profile_data in data:
+            profile = Profile(profile_data['name'])
+            for macro_name, macro_data in profile_data['macros'].items():
+                macro = Macro(macro_name)
+                apply_macro_meta(macro, macro_data)
+                # Buttons and keys stay names until a plan is compiled, so
+                # converting doesn't need pynput
+                macro.actions = [Action.from_dict(action_data) for action_data in macro_data['actions']]
+                profile.add_macro(macro)
+                if save:
+                    self.macro_changed(profile, macro, update_index=False)
+            profile.button_assignments = profile_data.get('button_assignments', {})
+            self.profiles.append(profile)
+        if save:
+            self.profile_changed()
+            self.flush()
+
+    def _build_index(self):
+        # Chunk lists are filled in by the writer once the chunks exist
+        self._last_index = {
+            'version': INDEX_VERSION,
+            'profiles': [{
+                'name': profile.name,
+                'button_assignments': dict(profile.button_assignments),
+                'macros': {
+                    macro_name: macro_meta(macro)
+                    for macro_name, macro in profile.macros.items()
+                }
+            } for profile in self.profiles]
+        }
+        return self._last_index
+
+    def _schedule(self):
+        self._last_change = time.monotonic()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._cond.notify_all()
+
+    def profile_changed(self):
+        # Names, assignments and macro settings all live in the index
+        with self._cond:
+            self._index = self._build_index()
+            self._schedule()
+
+    def macro_changed(self, profile, macro, update_index=True):
+        snapshot = macro.actions.copy()
+        with self._cond:
+            self._macros[(profile.name, macro.name)] = snapshot
+            if update_index:
+                self._index = self._build_index()
+            self._schedule()
+
+    def macros_added(self, items):
+        # (profile, macro) pairs committed with a single index write, so a
+        # bulk import lands all at once
+        with self._cond:
+            for profile, macro in items:
+                self._macros[(profile.name, macro.name)] = macro.actions
+            self._index = self._build_index()
+            self._schedule()
+
+    def macro_chunks(self, profile, macro):
+        # Names of the chunks the macro was last written as, if it has
+        # been written and has no changes waiting
+        with self._cond:
+            key = (profile.name, macro.name)
+            if key in self._macros or self._writing:
+                return None
+            names = self._manifests.get(key)
+            return list(names) if names is not None else None
+
+    def macro_removed(self, profile, macro_name):
+        with self._cond:
+            self._macros.pop((profile.name, macro_name), None)
+            self._collect = True
+            self._index = self._build_index()
+            self._schedule()
+
+    def _renamed(self, old_key, new_key):
+        # Called with the lock held and no write running: the macro keeps
+        # its chunks under the new key
+        pending = self._macros.pop(old_key, None)
+        if pending is None and old_key in self._manifests:
+            pending = list(self._manifests[old_key])
+        if pending is not None:
+            self._macros[new_key] = pending
+
+    def macro_renamed(self, profile, old_name, macro):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._renamed((profile.name, old_name), (profile.name, macro.name))
+            self._index = self._build_index()
+            self._schedule()
+
+    def profile_renamed(self, old_name, profile):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            for macro_name in profile.macros:
+                self._renamed((old_name, macro_name), (profile.name, macro_name))
+            self._index = self._build_index()
+            self._schedule()
+
+    def profile_removed(self, profile):
+        # Chunks only this profile used are collected once the index
+        # without it has been written
+        with self._cond:
+            for macro_name in profile.macros:
+                self._macros.pop((profile.name, macro_name), None)
+            self._collect = True
+            self._index = self._build_index()
+            self._schedule()
+
+    def _pending(self):
+        return self._index is not None or self._macros or self._deleted
+
+    def _run(self):
+        with self._cond:
+            try:
+                while not self._closed:
+                    if not self._pending():
+                        self._cond.wait()
+                        continue
+                    remaining = max(self._last_change + self.delay, self._retry_at) - time.monotonic()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                        continue
+                    try:
+                        self._write_pending()
+                    except Exception as e:
+                        self._failed(e)
+            finally:
+                # Lets the next change start a new writer
+                self._thread = None
+
+    def _failed(self, error):
+        # Called with the lock held once the unwritten changes are back
+        self.error = error
+        self._retry_at = time.monotonic() + self._retry_delay
+        self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+        if self.on_error is not None:
+            self._cond.release()
+            try:
+                self.on_error(error)
+            finally:
+                self._cond.acquire()
+
+    def _write_chunks(self, table):
+        names = []
+        for name, data in encode_chunks(table):
+            if name not in self._known_chunks:
+                path = os.path.join(self.chunk_path, name)
+                if not os.path.exists(path):
+                    atomic_write(path, data)
+                self._known_chunks.add(name)
+            names.append(name)
+        return names
+
+    def _write_pending(self):
+        # Called with the lock held; the lock is released while writing so
+        # the GUI thread can keep marking changes
+        index, self._index = self._index, None
+        macros, self._macros = self._macros, {}
+        deleted, self._deleted = self._deleted, set()
+        collect, self._collect = self._collect, False
+        if index is None and macros:
+            index = self._last_index
+        self._writing = True
+        self._cond.release()
+        written = False
+        try:
+            os.makedirs(self.chunk_path, exist_ok=True)
+            replaced = set()
+            for key, table in macros.items():
+                replaced.update(self._manifests.get(key, ()))
+                if isinstance(table, list):
+                    # Chunk names of a finished recording, already written
+                    self._manifests[key] = table
+                    self._known_chunks.update(table)
+                else:
+                    self._manifests[key] = self._write_chunks(table)
+            if index is not None:
+                # The index is committed after the chunks it points at
+                manifests = {}
+                for profile_data in index['profiles']:
+                    for macro_name, macro_data in profile_data['macros'].items():
+                        key = (profile_data['name'], macro_name)
+                        macro_data['chunks'] = manifests[key] = self._manifests.get(key, [])
+                atomic_write(self.index_path, json.dumps(index))
+                self._manifests = manifests
+                live = set()
+                for names in manifests.values():
+                    live.update(names)
+                if collect:
+                    replaced.update(name for name in os.listdir(self.chunk_path) if name.endswith(EXTENSION))
+                for log in list(self._recordings.values()):
+                    live.update(log.chunks)
+                for name in replaced - live:
+                    deleted.add(os.path.join(self.chunk_path, name))
+                    self._known_chunks.discard(name)
+            for path in deleted:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                lock = self._log_locks.pop(path, None)
+                if lock is not None:
+                    unlock_file(lock)
+            written = True
+        finally:
+            self._cond.acquire()
+            self._writing = False
+            if written:
+                self.error = None
+                self._retry_at = 0.0
+                self._retry_delay = self.delay
+            else:
+                # Put back whatever wasn't written; changes made meanwhile
+                # are newer and win. Chunks already written are known and
+                # not written again, and a full sweep catches any the
+                # failed write left without an owner.
+                if self._index is None:
+                    self._index = index
+                for key, table in macros.items():
+                    self._macros.setdefault(key, table)
+                self._deleted.update(deleted)
+                self._collect = True
+            self._cond.notify_all()
+
+    def flush(self):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            if self._pending():
+                try:
+                    self._write_pending()
+                except Exception:
+                    # The writer keeps trying what didn't make it
+                    self._schedule()
+                    raise
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def convert_json(json_path=LEGACY_FILE, path=DEFAULT_PATH):
+    store = ProfileStore(path)
+    store.import_legacy(json_path)
+    store.close()
+    return store.profiles
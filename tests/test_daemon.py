@@ -0,0 +1,131 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from daemon import MacroDaemon, DaemonError, ensure_token, send_request
+from models import Profile, Macro, Action
+from storage import ProfileStore
+
+
+class NullInjector:
+    def __init__(self):
+        self.moves = []
+
+    def move(self, x, y):
+        self.moves.append((x, y))
+
+    def click(self, button):
+        pass
+
+    def press(self, key):
+        pass
+
+    def release(self, key):
+        pass
+
+    def scroll(self, amount):
+        pass
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    profile = Profile('main')
+    macro = Macro('walk')
+    macro.actions = [Action('move', x=i, y=i, delay=1) for i in range(10)]
+    profile.add_macro(macro)
+    store = ProfileStore('store', delay=0)
+    store.load()
+    store.profiles.append(profile)
+    store.macro_changed(profile, macro, update_index=False)
+    store.profile_changed()
+    store.close()
+
+    daemon = MacroDaemon('store', NullInjector(), port=0, token_path=str(tmp_path / 'token'))
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    deadline = time.perf_counter() + 5
+    while daemon.server is None and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    daemon.port = daemon.server.server_address[1]
+    daemon.token_path = str(tmp_path / 'token')
+    yield daemon
+    if thread.is_alive():
+        daemon.server.shutdown()
+        thread.join(5)
+
+
+def request(daemon, body):
+    return send_request(body, port=daemon.port, token_path=daemon.token_path)
+
+
+def raw(daemon, *lines):
+    # Replies to lines sent as they are, until the daemon hangs up
+    with socket.create_connection(('127.0.0.1', daemon.port), timeout=5) as sock:
+        sock.sendall(b''.join(lines))
+        with sock.makefile('rb') as f:
+            return [json.loads(line) for line in f]
+
+
+def test_token_is_private(tmp_path):
+    path = str(tmp_path / 'token')
+    token = ensure_token(path)
+    assert ensure_token(path) == token
+    if hasattr(os, 'getuid'):
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        os.chmod(path, 0o644)
+        with pytest.raises(DaemonError):
+            ensure_token(path)
+
+
+def test_authorized_requests(daemon):
+    assert request(daemon, {'command': 'list'}) == {'profiles': {'main': ['walk']}}
+    assert 'instance' in request(daemon, {'command': 'play', 'profile': 'main', 'macro': 'walk'})
+    deadline = time.perf_counter() + 5
+    while len(daemon.injector.moves) < 10 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert daemon.injector.moves == [(i, i) for i in range(10)]
+
+
+def test_wrong_token_is_refused(daemon):
+    token = json.dumps({'token': 'x' * 64}).encode() + b'\n'
+    play = json.dumps({'command': 'play', 'profile': 'main', 'macro': 'walk'}).encode() + b'\n'
+    assert raw(daemon, token, play) == [{'ok': False, 'error': 'not authorized'}]
+    assert raw(daemon, play) == [{'ok': False, 'error': 'not authorized'}]
+    assert raw(daemon, b'[1, 2]\n', play) == [{'ok': False, 'error': 'not authorized'}]
+    reply, = raw(daemon, b'not json\n', play)
+    assert not reply['ok'] and reply['error'].startswith('invalid request')
+    assert daemon.injector.moves == []
+
+
+def test_long_line_is_refused(daemon):
+    reply, = raw(daemon, b'x' * (1 << 17) + b'\n')
+    assert not reply['ok']
+
+
+def test_invalid_json_after_token_closes(daemon):
+    with open(daemon.token_path) as f:
+        token = json.dumps({'token': f.read().strip()}).encode() + b'\n'
+    list_request = json.dumps({'command': 'list'}).encode() + b'\n'
+    replies = raw(daemon, token, b'{oops\n', list_request)
+    assert len(replies) == 1 and not replies[0]['ok']
+
+
+@pytest.mark.parametrize('loops', [-1, 1.5, 'two', True])
+def test_bad_loops_are_refused(daemon, loops):
+    with pytest.raises(DaemonError, match='loops'):
+        request(daemon, {'command': 'play', 'profile': 'main', 'macro': 'walk', 'loops': loops})
+    assert daemon.playback.instances == []
+
+
+def test_shutdown_replies(daemon):
+    assert request(daemon, {'command': 'shutdown'}) == {}
+    deadline = time.perf_counter() + 5
+    while daemon.server.socket.fileno() != -1 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(OSError):
+        request(daemon, {'command': 'list'})
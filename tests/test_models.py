@@ -0,0 +1,33 @@
+from models import ActionTable, MOVE, KEY_PRESS, NONE
+from transforms import drop
+
+
+def make_table(delays):
+    table = ActionTable()
+    for i, delay in enumerate(delays):
+        table.append_row(KEY_PRESS if i % 2 else MOVE, i, i, button='a' if i % 2 else None, delay=delay)
+    return table
+
+
+def test_delete_rows_keeps_times():
+    table = make_table([1, 2, 4, 8, 16, 32])
+    assert table.delete_rows([0, 1, 3]) == 3
+    assert list(table.xs) == [2, 4, 5]
+    # Row 2 now comes first, so it waits for the rows deleted before it
+    assert list(table.delays) == [15, 16, 32]
+    assert sum(table.delays) == 63
+
+
+def test_delete_rows_at_the_end():
+    table = make_table([1, 2, 4])
+    table.delete_rows([2])
+    assert list(table.delays) == [1, 6]
+
+
+def test_filter_keeps_times():
+    delays = [1, 2, 4, 8, 16, 32]
+    rows = [(MOVE if i % 2 == 0 else KEY_PRESS, i, i, -1, NONE, delay) for i, delay in enumerate(delays)]
+    kept = list(drop(lambda: iter(rows), 'move')())
+    assert [row[1] for row in kept] == [1, 3, 5]
+    assert [row[5] for row in kept] == [7, 24, 32]
+    assert sum(row[5] for row in kept) == sum(delays)
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from benchmark import FakeMouse, FakeKeyboard
+from models import Macro, Action
+from plan import PynputInjector
+from playback import MacroScheduler, CANCELLED
+
+
+class KeyLog(FakeKeyboard):
+    # Keeps the keys as well, and rejects any named in bad
+    def __init__(self, bad=()):
+        super().__init__()
+        self.bad = set(bad)
+        self.events = []
+
+    def press(self, key):
+        if key in self.bad:
+            raise ValueError(f"cannot press {key}")
+        super().press(key)
+        self.events.append(('press', key))
+
+    def release(self, key):
+        super().release(key)
+        self.events.append(('release', key))
+
+
+class Finished:
+    def __init__(self):
+        self.reports = []
+        self._cond = threading.Condition()
+
+    def __call__(self, report):
+        with self._cond:
+            self.reports.append(report)
+            self._cond.notify_all()
+
+    def wait(self, count=1, timeout=5.0):
+        with self._cond:
+            assert self._cond.wait_for(lambda: len(self.reports) >= count, timeout)
+        return self.reports
+
+
+def make_macro(name, actions, loops=1):
+    macro = Macro(name)
+    macro.actions = [Action(action_type, **kwargs) for action_type, kwargs in actions]
+    if loops != 1:
+        macro.repeat = True
+        macro.loops = loops
+    return macro
+
+
+def moves(count, delay):
+    return [('move', {'x': i, 'y': i, 'delay': delay}) for i in range(1, count + 1)]
+
+
+def test_steps_keep_their_times():
+    mouse = FakeMouse()
+    finished = Finished()
+    scheduler = MacroScheduler(PynputInjector(mouse, KeyLog()), on_finished=finished)
+    macro = make_macro('walk', moves(4, 25), loops=3)
+    start = time.perf_counter()
+    scheduler.play(macro)
+    report, = finished.wait()
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+
+    assert report.error is None and not report.stopped
+    assert (report.loops, report.steps) == (3, 12)
+    # The run ends after the last step's delay too
+    assert 0.3 <= elapsed < 0.5
+    for i, at in enumerate(mouse.times):
+        assert at - start >= i * 0.025 - 0.002
+    assert report.max_late < 0.02
+
+
+def test_cancel_releases_held_keys():
+    keyboard = KeyLog()
+    finished = Finished()
+    scheduler = MacroScheduler(PynputInjector(FakeMouse(), keyboard), on_finished=finished)
+    macro = make_macro('hold', [('key_press', {'button': 'shift', 'delay': 5000}),
+                                ('key_release', {'button': 'shift', 'delay': 0})])
+    instance = scheduler.play(macro)
+    deadline = time.perf_counter() + 5
+    while not keyboard.events and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    scheduler.cancel(instance)
+    report, = finished.wait()
+    scheduler.close()
+
+    assert instance.state == CANCELLED
+    assert report.stopped and report.steps == 1
+    assert keyboard.events == [('press', 'shift'), ('release', 'shift')]
+
+
+def test_failing_injector_ends_only_its_instance():
+    keyboard = KeyLog(bad={'bad'})
+    finished = Finished()
+    scheduler = MacroScheduler(PynputInjector(FakeMouse(), keyboard), on_finished=finished)
+    bad = make_macro('bad', [('key_press', {'button': 'shift', 'delay': 1}),
+                             ('key_press', {'button': 'bad', 'delay': 1})])
+    good = make_macro('good', moves(5, 20))
+    scheduler.play(good)
+    scheduler.play(bad)
+    reports = {report.macro_name: report for report in finished.wait(2)}
+
+    assert reports['bad'].error == 'cannot press bad'
+    assert reports['good'].error is None and reports['good'].steps == 5
+    # Keys held by the failed instance are let go
+    assert ('release', 'shift') in keyboard.events
+
+    # The scheduler keeps playing after a failure
+    scheduler.play(good)
+    assert finished.wait(3)[2].steps == 5
+    start = time.perf_counter()
+    scheduler.close()
+    assert time.perf_counter() - start < 1.0
@@ -0,0 +1,264 @@
+import json
+import os
+
+import storage
+from macrofile import MIN_CHUNK, MAX_CHUNK, chunk_bounds, decode_macro, encode_chunks, encode_macro
+from models import Profile, Macro, ActionTable, MOVE, CLICK, KEY_PRESS, KEY_RELEASE, SCROLL
+from storage import ProfileStore, INDEX_VERSION
+
+
+def make_table(rows, seed=0):
+    # Every action type, with buttons given as names and uneven delays so
+    # the chunker finds boundaries
+    table = ActionTable()
+    for i in range(rows):
+        n = i * 7919 + seed
+        kind = n % 5
+        if kind == 0:
+            table.append_row(CLICK, n % 640, n % 480, button='Button.left', delay=n % 13)
+        elif kind == 1:
+            table.append_row(KEY_PRESS, button="'a'", delay=n % 5)
+        elif kind == 2:
+            table.append_row(KEY_RELEASE, button='Key.shift', delay=0.5)
+        elif kind == 3:
+            table.append_row(SCROLL, scroll_amount=n % 3 - 1, delay=n % 11)
+        else:
+            table.append_row(MOVE, n % 1920, n % 1080, delay=n % 17)
+    return table
+
+
+def rows(table):
+    return [action.to_dict() for action in table]
+
+
+def save_profile(path, profile):
+    store = ProfileStore(path, delay=0)
+    store.load()
+    store.profiles.append(profile)
+    for macro in profile.macros.values():
+        store.macro_changed(profile, macro, update_index=False)
+    store.profile_changed()
+    store.close()
+
+
+def test_macro_file_round_trip():
+    table = make_table(1000)
+    decoded = decode_macro(encode_macro(table))
+    assert rows(decoded) == rows(table)
+    assert len(decode_macro(encode_macro(ActionTable()))) == 0
+
+
+def test_chunks_cover_the_table():
+    table = make_table(50000)
+    bounds = chunk_bounds(table)
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(table)
+    for (start, end), (next_start, _) in zip(bounds, bounds[1:]):
+        assert end == next_start
+    for start, end in bounds[:-1]:
+        assert MIN_CHUNK <= end - start <= MAX_CHUNK
+    joined = ActionTable()
+    for name, data in encode_chunks(table):
+        joined.extend_table(decode_macro(data))
+    assert rows(joined) == rows(table)
+
+
+def test_chunks_survive_an_insert():
+    # Content-defined boundaries move with the data, so an edit near the
+    # start leaves most later chunks as they were
+    table = make_table(50000)
+    before = {name for name, _ in encode_chunks(table)}
+    table.insert(10, table[3])
+    after = {name for name, _ in encode_chunks(table)}
+    assert len(before & after) >= len(before) - 3
+
+
+def test_save_and_reload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    profile = Profile('main')
+    macro = Macro('walk')
+    macro.actions = make_table(20000)
+    macro.repeat = True
+    macro.loops = 3
+    profile.add_macro(macro)
+    profile.button_assignments = {'F5': 'walk'}
+    save_profile('store', profile)
+
+    store = ProfileStore('store')
+    loaded, = store.load()
+    assert loaded.name == 'main'
+    assert loaded.button_assignments == {'F5': 'walk'}
+    copy = loaded.macros['walk']
+    assert not copy.loaded
+    assert copy.stats.count == 20000
+    assert (copy.repeat, copy.loops) == (True, 3)
+    assert rows(copy.actions) == rows(macro.actions)
+
+
+def test_shared_actions_are_stored_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = make_table(20000)
+    profile = Profile('main')
+    for name in ('one', 'two'):
+        macro = Macro(name)
+        macro.actions = table.copy()
+        profile.add_macro(macro)
+    save_profile('store', profile)
+
+    with open(os.path.join('store', 'index.json')) as f:
+        index = json.load(f)
+    macros = index['profiles'][0]['macros']
+    assert macros['one']['chunks'] == macros['two']['chunks']
+    assert len(os.listdir(os.path.join('store', 'chunks'))) == len(set(macros['one']['chunks']))
+
+    # Both macros decode each chunk once between them
+    reads = []
+    read_macro_file = storage.read_macro_file
+    monkeypatch.setattr(storage, 'read_macro_file', lambda path: reads.append(path) or read_macro_file(path))
+    store = ProfileStore('store')
+    loaded, = store.load()
+    assert rows(loaded.macros['one'].actions) == rows(loaded.macros['two'].actions) == rows(table)
+    assert len(reads) == len(set(reads)) == len(set(macros['one']['chunks']))
+
+
+def write_v1_store(path, table):
+    os.makedirs(os.path.join(path, 'macros'))
+    types, xs, ys, buttons, scrolls, delays = table.columns()
+    with open(os.path.join(path, 'macros', 'walk.json'), 'w') as f:
+        json.dump({'type': list(types), 'x': list(xs), 'y': list(ys), 'button': list(buttons),
+                   'scroll': list(scrolls), 'delay': list(delays), 'values': table.values}, f)
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump({'version': 1, 'profiles': [{
+            'name': 'main',
+            'button_assignments': {'F5': 'walk'},
+            'macros': {'walk': {'repeat': True, 'loops': 2, 'file': 'walk.json'}},
+        }]}, f)
+
+
+def test_version_1_index_is_converted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = make_table(5000)
+    write_v1_store('store', table)
+
+    store = ProfileStore('store', delay=0)
+    loaded, = store.load()
+    assert rows(loaded.macros['walk'].actions) == rows(table)
+    store.close()
+
+    with open(os.path.join('store', 'index.json')) as f:
+        index = json.load(f)
+    assert index['version'] == INDEX_VERSION
+    assert index['profiles'][0]['macros']['walk']['chunks']
+    assert not os.path.exists(os.path.join('store', 'macros', 'walk.json'))
+
+    loaded, = ProfileStore('store').load()
+    macro = loaded.macros['walk']
+    assert (macro.repeat, macro.loops) == (True, 2)
+    assert loaded.button_assignments == {'F5': 'walk'}
+    assert rows(macro.actions) == rows(table)
+
+
+def test_read_only_load_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = make_table(500)
+    write_v1_store('store', table)
+    with open(os.path.join('store', 'index.json')) as f:
+        before = f.read()
+
+    loaded, = ProfileStore('store').load(read_only=True)
+    assert rows(loaded.macros['walk'].actions) == rows(table)
+    with open(os.path.join('store', 'index.json')) as f:
+        assert f.read() == before
+    assert sorted(os.listdir('store')) == ['index.json', 'macros']
+
+
+def test_legacy_json_is_imported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    actions = [
+        {'type': 'move', 'x': 10, 'y': 20, 'delay': 5},
+        {'type': 'click', 'x': 10, 'y': 20, 'button': 'Button.left', 'delay': 12},
+        {'type': 'key_press', 'button': "'q'", 'delay': 1},
+        {'type': 'key_release', 'button': "'q'", 'delay': 0},
+        {'type': 'scroll', 'scroll_amount': -1, 'delay': 3},
+    ]
+    with open(storage.LEGACY_FILE, 'w') as f:
+        json.dump([{'name': 'old', 'button_assignments': {}, 'macros': {
+            'legacy': {'repeat': False, 'actions': actions}}}], f)
+
+    store = ProfileStore('store', delay=0)
+    store.load()
+    store.close()
+    loaded, = ProfileStore('store').load()
+    expected = [dict({'button': None, 'x': None, 'y': None, 'scroll_amount': None}, **action)
+                for action in actions]
+    assert rows(loaded.macros['legacy'].actions) == expected
+
+
+def record(store, profile, batches):
+    macro = Macro('take')
+    log = store.start_recording(profile, macro)
+    for batch in batches:
+        log.write(batch)
+    return log
+
+
+def test_crashed_recording_is_recovered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = ProfileStore('store', delay=0)
+    store.load()
+    profile = Profile('main')
+    batches = [make_table(3000, seed) for seed in range(3)]
+    log = record(store, profile, batches)
+    # What a crash leaves behind: the log on disk and nobody holding it
+    store.abandon_recording(log)
+    store.close()
+
+    store = ProfileStore('store', delay=0)
+    store.load()
+    (recovered_profile, macro), = store.recovered
+    assert recovered_profile.name == 'main' and macro.name == 'take'
+    expected = ActionTable()
+    for batch in batches:
+        expected.extend_table(batch)
+    assert rows(macro.actions) == rows(expected)
+    store.close()
+    assert os.listdir(os.path.join('store', 'recordings')) == []
+
+    loaded, = ProfileStore('store').load()
+    assert rows(loaded.macros['take'].actions) == rows(expected)
+
+
+def test_live_recording_is_left_alone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = ProfileStore('store', delay=0)
+    store.load()
+    profile = Profile('main')
+    store.profiles.append(profile)
+    log = record(store, profile, [make_table(100)])
+
+    other = ProfileStore('store')
+    other.load()
+    assert other.recovered == []
+
+    macro = Macro('take')
+    profile.add_macro(macro)
+    store.finish_recording(profile, macro, log)
+    store.close()
+    assert os.listdir(os.path.join('store', 'recordings')) == []
+    loaded, = ProfileStore('store').load()
+    assert rows(loaded.macros['take'].actions) == rows(make_table(100))
+
+
+def test_chunk_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 'CHUNK_CACHE_ROWS', 1000)
+    profile = Profile('main')
+    macro = Macro('walk')
+    macro.actions = make_table(20000)
+    profile.add_macro(macro)
+    save_profile('store', profile)
+
+    store = ProfileStore('store')
+    loaded, = store.load()
+    assert rows(loaded.macros['walk'].actions) == rows(macro.actions)
+    assert store._chunk_cache_rows <= 1000 or len(store._chunk_cache) == 1
+    assert store._chunk_cache_rows == sum(len(chunk) for chunk in store._chunk_cache.values())
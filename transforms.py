@@ -0,0 +1,153 @@
+from itertools import chain
+
+from models import ACTION_TYPES, TYPE_CODES, NONE
+from plan import StepCompiler, action_rows
+
+# A view is a chain of stages applied to a macro's actions while it plays.
+# Each stage wraps a source, a function returning a fresh iterator of
+# (code, x, y, value, scroll, delay) rows, so nothing is copied and loops
+# simply start the stream again. Views are stored as a list of
+# [name, *arguments] so they fit in the profile index.
+
+
+def offset(source, dx, dy):
+    def rows():
+        for code, x, y, value, amount, delay in source():
+            if x != NONE:
+                yield code, x + dx, y + dy, value, amount, delay
+            else:
+                yield code, x, y, value, amount, delay
+    return rows
+
+
+def scale(source, sx, sy=None, ox=0, oy=0):
+    # Scales positions around (ox, oy)
+    if sy is None:
+        sy = sx
+
+    def rows():
+        for code, x, y, value, amount, delay in source():
+            if x != NONE:
+                yield code, round(ox + (x - ox) * sx), round(oy + (y - oy) * sy), value, amount, delay
+            else:
+                yield code, x, y, value, amount, delay
+    return rows
+
+
+def speed(source, factor):
+    def rows():
+        for code, x, y, value, amount, delay in source():
+            yield code, x, y, value, amount, delay / factor
+    return rows
+
+
+def _filter(source, codes, keep):
+    # The delay of a dropped action goes to the action before it, and the
+    # delays of actions dropped before the first one kept go to that one,
+    # so every later action and the end of the run keep their times (the
+    # same rule as ActionTable.delete_rows)
+    def rows():
+        held = None
+        lead = 0
+        for row in source():
+            if (row[0] in codes) == keep:
+                if held is not None:
+                    yield held
+                    held = row
+                else:
+                    held = row[:5] + (row[5] + lead,)
+            elif held is not None:
+                held = held[:5] + (held[5] + row[5],)
+            else:
+                lead += row[5]
+        if held is not None:
+            yield held
+    return rows
+
+
+def keep(source, *types):
+    return _filter(source, {TYPE_CODES[name] for name in types}, True)
+
+
+def drop(source, *types):
+    return _filter(source, {TYPE_CODES[name] for name in types}, False)
+
+
+def loop(source, count):
+    def rows():
+        return chain.from_iterable(source() for _ in range(count))
+    return rows
+
+
+def then(source, *names, library=None):
+    # Plays other macros of the profile after this one
+    def rows():
+        streams = [source()]
+        for name in names:
+            macro = library.get(name) if library else None
+            if macro is not None:
+                streams.append(action_rows(macro.actions, macro.library, (macro,)))
+        return chain.from_iterable(streams)
+    return rows
+
+
+# name: (stage, argument types, least arguments)
+STAGES = {
+    'offset': (offset, (int, int), 2),
+    'scale': (scale, (float, float, int, int), 1),
+    'speed': (speed, (float,), 1),
+    'keep': (keep, None, 1),
+    'drop': (drop, None, 1),
+    'loop': (loop, (int,), 1),
+    'then': (then, None, 1),
+}
+
+
+def parse_stage(words):
+    if not words:
+        raise ValueError("empty stage")
+    name, args = words[0], list(words[1:])
+    if name not in STAGES:
+        raise ValueError(f"unknown stage {name!r}, expected one of {', '.join(STAGES)}")
+    _, types, least = STAGES[name]
+    if len(args) < least or (types is not None and len(args) > len(types)):
+        raise ValueError(f"wrong number of arguments for {name}")
+    if types is not None:
+        args = [kind(arg) for kind, arg in zip(types, args)]
+    if name in ('keep', 'drop'):
+        for arg in args:
+            if arg not in TYPE_CODES:
+                raise ValueError(f"unknown action type {arg!r}, expected one of {', '.join(ACTION_TYPES)}")
+    if name == 'speed' and args[0] <= 0:
+        raise ValueError("speed must be above 0")
+    if name == 'loop' and args[0] < 1:
+        raise ValueError("loop count must be at least 1")
+    return [name] + args
+
+
+def parse_view(text):
+    # "offset 100 0 | speed 2 | drop move | loop 3"
+    return [parse_stage(part.split()) for part in text.split('|') if part.strip()]
+
+
+def format_view(stages):
+    return " | ".join(" ".join(str(word) for word in stage) for stage in stages)
+
+
+def view_rows(macro, stages):
+    # Source of the macro's rows with every stage applied
+    library = macro.library
+    table = macro.actions
+
+    def source():
+        return action_rows(table, library, (macro,))
+
+    for name, *args in stages:
+        stage = STAGES[name][0]
+        source = stage(source, *args, library=library) if stage is then else stage(source, *args)
+    return source
+
+
+def view_steps(macro, stages, injector):
+    # Playback steps for a view, compiled only as playback reaches them
+    return StepCompiler(injector, macro.speed, macro.max_gap).steps(view_rows(macro, stages)())
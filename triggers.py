@@ -0,0 +1,79 @@
+import time
+
+from models import button_from_str, button_to_str
+
+MOUSE_BUTTONS = ('left', 'right', 'middle', 'back', 'forward')
+
+# pynput names for the side buttons differ between platforms
+MOUSE_BUTTON_ALIASES = {
+    'back': ('x1', 'button8'),
+    'forward': ('x2', 'button9'),
+}
+
+
+def _mouse_buttons(name):
+    from pynput.mouse import Button
+    for alias in MOUSE_BUTTON_ALIASES.get(name, (name,)):
+        button = getattr(Button, alias, None)
+        if button is not None:
+            yield button
+
+
+def _key_name(name):
+    # Match str() of the key objects the keyboard listener reports
+    key = button_from_str(name)
+    if isinstance(key, str):
+        return repr(key) if len(key) == 1 else key
+    return button_to_str(key)
+
+
+class TriggerDispatcher:
+    # Turns the active profile's button_assignments into two dicts keyed by
+    # (input, pressed) so the listener callbacks do a single lookup and
+    # start playback directly from the hook thread.
+    def __init__(self, playback):
+        self.playback = playback
+        self.enabled = True
+        self._mouse = {}
+        self._keys = {}
+
+    def compile(self, profile):
+        mouse_table = {}
+        key_table = {}
+        if profile is not None:
+            for name, macro_name in profile.button_assignments.items():
+                macro = profile.macros.get(macro_name)
+                if macro is None:
+                    continue
+                # Decode and compile now rather than on first trigger
+                self.playback.prepare(macro)
+                if name in MOUSE_BUTTONS:
+                    for button in _mouse_buttons(name):
+                        mouse_table[(button, macro.trigger_on_press)] = macro
+                    continue
+                try:
+                    key_table[(_key_name(name), macro.trigger_on_press)] = macro
+                except (KeyError, ValueError):
+                    continue
+        self._mouse = mouse_table
+        self._keys = key_table
+
+    def _fire(self, macro, trigger_time):
+        if self.playback.find(macro) is not None:
+            # Ignore our own injected input while the macro is running
+            return
+        self.playback.play(macro, trigger_time=trigger_time)
+
+    def on_click(self, button, pressed):
+        if self.enabled and self._mouse:
+            trigger_time = time.perf_counter()
+            macro = self._mouse.get((button, pressed))
+            if macro is not None:
+                self._fire(macro, trigger_time)
+
+    def on_key(self, key, pressed):
+        if self.enabled and self._keys:
+            trigger_time = time.perf_counter()
+            macro = self._keys.get((str(key), pressed))
+            if macro is not None:
+                self._fire(macro, trigger_time)
@@ -3,35 +3,27 @@ import json
 import hashlib
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QPushButton, QListWidget, QTabWidget, QLabel, QLineEdit, 
-                             QMessageBox, QInputDialog, QSpinBox, QFormLayout, QCheckBox,
-                             QComboBox, QDialog, QDialogButtonBox, QGridLayout, QGroupBox)
-from PyQt6.QtCore import Qt, QTimer
+                             QMessageBox, QInputDialog, QSpinBox, QDoubleSpinBox, QFormLayout, QCheckBox,
+                             QComboBox, QDialog, QDialogButtonBox, QGridLayout, QGroupBox,
+                             QTableView, QHeaderView, QAbstractItemView, QFileDialog, QListView)
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
 from pynput import mouse, keyboard
 from pynput.mouse import Button, Controller as MouseController
 from pynput.keyboard import Key, Controller as KeyboardController
-
-class Profile:
-    def __init__(self, name):
-        self.name = name
-        self.macros = {}
-        self.button_assignments = {}
-
-class Macro:
-    def __init__(self, name):
-        self.name = name
-        self.actions = []
-        self.repeat = False
-        self.trigger_on_press = True
-        self.delay = 10  # Default delay in milliseconds
-
-class Action:
-    def __init__(self, action_type, **kwargs):
-        self.type = action_type
-        self.button = kwargs.get('button')
-        self.x = kwargs.get('x')
-        self.y = kwargs.get('y')
-        self.scroll_amount = kwargs.get('scroll_amount')
-        self.delay = kwargs.get('delay', 0)
+from models import ACTION_TYPES, Profile, Macro, Action, button_from_str, button_to_str
+from actionmodel import ActionListModel
+from playback import MacroScheduler, PLAYING, KEY_SHARE, KEY_PRIORITY
+from injectworker import RemoteScheduler
+from analysis import get_analysis
+from plan import PynputInjector, MIN_SPEED, MAX_SPEED
+from recording import Recorder
+from optimize import DEFAULT_TOLERANCE, DEFAULT_MERGE_WINDOW, optimize_actions
+from library import export_library, import_library
+from registry import ProfileRegistry, NO_MACRO
+from storage import ProfileStore
+from triggers import TriggerDispatcher
+from instrumentation import Instrumentation, timed_callback
+from transforms import format_view, parse_view
 
 class LoginDialog(QDialog):
     def __init__(self, parent=None):
@@ -53,6 +45,10 @@ class LoginDialog(QDialog):
         self.buttonBox.rejected.connect(self.reject)
 
 class TS4Windows(QMainWindow):
+    playback_finished = pyqtSignal(object)
+    injector_status = pyqtSignal(str)
+    store_error = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("TS4Windows")
@@ -60,13 +56,25 @@ class TS4Windows(QMainWindow):
 
         self.mouse = MouseController()
         self.keyboard = KeyboardController()
-        self.profiles = []
+        self.injector = PynputInjector(self.mouse, self.keyboard)
+        self.store = ProfileStore(on_error=self.store_error.emit)
+        self.profiles = self.store.profiles
+        self.registry = ProfileRegistry(self.profiles)
         self.current_profile = None
         self.recording = False
         self.current_macro = None
-        self.macro_timer = QTimer(self)
-        self.macro_timer.timeout.connect(self.execute_macro_step)
-        self.current_macro_index = 0
+        self.recorder = Recorder()
+        self.recording_profile = None
+        self.recording_log = None
+        self.record_timer = QTimer(self)
+        self.record_timer.setInterval(20)
+        self.record_timer.timeout.connect(self.drain_recording)
+        self.playback = MacroScheduler(self.injector, on_finished=self.playback_finished.emit)
+        self.playback_finished.connect(self.on_playback_finished)
+        self.injector_status.connect(self.on_injector_status)
+        self.store_error.connect(self.on_store_error)
+        self.triggers = TriggerDispatcher(self.playback)
+        self.instrumentation = None  # Set while timing stats are collected
 
         self.users = {}  # Store user credentials
         self.load_users()
@@ -87,6 +95,7 @@ class TS4Windows(QMainWindow):
         self.tabs.addTab(self.create_profiles_tab(), "Profiles")
         self.tabs.addTab(self.create_macro_editor_tab(), "Macro Editor")
         self.tabs.addTab(self.create_button_assignment_tab(), "Button Assignment")
+        self.tabs.addTab(self.create_stats_tab(), "Timing Stats")
         layout.addWidget(self.tabs)
 
         central_widget.setLayout(layout)
@@ -101,7 +110,7 @@ class TS4Windows(QMainWindow):
         tab = QWidget()
         layout = QVBoxLayout()
 
-        self.profile_list = QListWidget()
+        self.profile_list = self.create_name_list(self.registry.profile_model)
         layout.addWidget(self.profile_list)
 
         button_layout = QHBoxLayout()
@@ -113,10 +122,22 @@ class TS4Windows(QMainWindow):
         edit_profile_button.clicked.connect(self.edit_profile)
         button_layout.addWidget(edit_profile_button)
 
+        rename_profile_button = QPushButton("Rename Profile")
+        rename_profile_button.clicked.connect(self.rename_profile)
+        button_layout.addWidget(rename_profile_button)
+
         delete_profile_button = QPushButton("Delete Profile")
         delete_profile_button.clicked.connect(self.delete_profile)
         button_layout.addWidget(delete_profile_button)
 
+        import_button = QPushButton("Import...")
+        import_button.clicked.connect(self.import_library)
+        button_layout.addWidget(import_button)
+
+        export_button = QPushButton("Export...")
+        export_button.clicked.connect(self.export_library)
+        button_layout.addWidget(export_button)
+
         layout.addLayout(button_layout)
         tab.setLayout(layout)
         return tab
@@ -125,7 +146,9 @@ class TS4Windows(QMainWindow):
         tab = QWidget()
         layout = QVBoxLayout()
 
-        self.macro_list = QListWidget()
+        self.macro_list = self.create_name_list(self.registry.macro_model)
+        self.macro_list.selectionModel().currentChanged.connect(self.update_play_button)
+        self.macro_list.selectionModel().currentChanged.connect(self.update_view_combo)
         layout.addWidget(self.macro_list)
 
         button_layout = QHBoxLayout()
@@ -133,9 +156,11 @@ class TS4Windows(QMainWindow):
         record_button.clicked.connect(self.toggle_recording)
         button_layout.addWidget(record_button)
 
-        play_button = QPushButton("Play Macro")
-        play_button.clicked.connect(self.play_macro)
-        button_layout.addWidget(play_button)
+        self.play_button = QPushButton("Play Macro")
+        self.play_button.setToolTip("Click to play, pause or resume the selected macro. "
+                                    "Shift+click to stop it, or every macro if it isn't playing.")
+        self.play_button.clicked.connect(self.play_macro)
+        button_layout.addWidget(self.play_button)
 
         save_button = QPushButton("Save Macro")
         save_button.clicked.connect(self.save_macro)
@@ -145,6 +170,22 @@ class TS4Windows(QMainWindow):
         edit_button.clicked.connect(self.edit_macro)
         button_layout.addWidget(edit_button)
 
+        optimize_button = QPushButton("Optimize Macro")
+        optimize_button.clicked.connect(self.optimize_macro)
+        button_layout.addWidget(optimize_button)
+
+        analyze_button = QPushButton("Analyze Macro")
+        analyze_button.clicked.connect(self.analyze_macro)
+        button_layout.addWidget(analyze_button)
+
+        rename_button = QPushButton("Rename Macro")
+        rename_button.clicked.connect(self.rename_macro)
+        button_layout.addWidget(rename_button)
+
+        delete_button = QPushButton("Delete Macro")
+        delete_button.clicked.connect(self.delete_macro)
+        button_layout.addWidget(delete_button)
+
         layout.addLayout(button_layout)
 
         # Add delay settings
@@ -155,20 +196,105 @@ class TS4Windows(QMainWindow):
         self.delay_spinbox.setSuffix(" ms")
         delay_layout.addRow("Delay between actions:", self.delay_spinbox)
 
+        # Record measured time between events instead of the fixed delay
+        self.timing_checkbox = QCheckBox("Record real timing")
+        self.timing_checkbox.setChecked(True)
+        delay_layout.addRow(self.timing_checkbox)
+
+        # Write recordings to disk in batches as they go, so long sessions
+        # keep memory flat and a crash loses nothing
+        self.stream_checkbox = QCheckBox("Stream recording to disk")
+        self.stream_checkbox.setChecked(True)
+        delay_layout.addRow(self.stream_checkbox)
+
+        self.speed_spinbox = self.create_speed_spinbox(1.0)
+        delay_layout.addRow("Playback speed:", self.speed_spinbox)
+
+        self.max_gap_spinbox = self.create_max_gap_spinbox(0)
+        delay_layout.addRow("Compress idle gaps to:", self.max_gap_spinbox)
+
+        # Merge and simplify mouse moves while recording
+        self.move_tolerance_spinbox = QSpinBox()
+        self.move_tolerance_spinbox.setRange(0, 100)
+        self.move_tolerance_spinbox.setValue(0)
+        self.move_tolerance_spinbox.setSuffix(" px")
+        self.move_tolerance_spinbox.setSpecialValueText("Off")
+        delay_layout.addRow("Move tolerance:", self.move_tolerance_spinbox)
+
+        self.move_window_spinbox = QSpinBox()
+        self.move_window_spinbox.setRange(0, 1000)
+        self.move_window_spinbox.setValue(DEFAULT_MERGE_WINDOW)
+        self.move_window_spinbox.setSuffix(" ms")
+        delay_layout.addRow("Move merge window:", self.move_window_spinbox)
+
         # Add repeat checkbox
         self.repeat_checkbox = QCheckBox("Repeat Macro")
         delay_layout.addRow(self.repeat_checkbox)
 
+        self.loops_spinbox = self.create_loops_spinbox(0)
+        delay_layout.addRow("Repeat count:", self.loops_spinbox)
+
+        # How macros playing at the same time share a key
+        self.key_policy_combo = QComboBox()
+        self.key_policy_combo.addItem("Hold until the last macro releases", KEY_SHARE)
+        self.key_policy_combo.addItem("Highest priority macro wins", KEY_PRIORITY)
+        self.key_policy_combo.currentIndexChanged.connect(
+            lambda: setattr(self.playback, 'key_policy', self.key_policy_combo.currentData()))
+        delay_layout.addRow("Shared keys:", self.key_policy_combo)
+
+        self.worker_checkbox = QCheckBox("Inject from a separate process")
+        self.worker_checkbox.setToolTip("Macros keep their timing while this window is busy. "
+                                        "Timing stats only cover macros played in this process.")
+        self.worker_checkbox.toggled.connect(self.set_injector_worker)
+        delay_layout.addRow(self.worker_checkbox)
+
         # Add trigger option
         self.trigger_combo = QComboBox()
         self.trigger_combo.addItems(["On Press", "On Release"])
         delay_layout.addRow("Trigger macro:", self.trigger_combo)
 
+        # Play the selected macro through one of its saved views
+        self.view_combo = QComboBox()
+        delay_layout.addRow("Play through view:", self.view_combo)
+        self.update_view_combo()
+
         layout.addLayout(delay_layout)
 
         tab.setLayout(layout)
         return tab
 
+    def create_speed_spinbox(self, value):
+        spinbox = QDoubleSpinBox()
+        spinbox.setRange(MIN_SPEED, MAX_SPEED)
+        spinbox.setSingleStep(0.25)
+        spinbox.setValue(value)
+        spinbox.setSuffix("x")
+        return spinbox
+
+    def create_loops_spinbox(self, value):
+        spinbox = QSpinBox()
+        spinbox.setRange(0, 1000000)
+        spinbox.setValue(value)
+        spinbox.setSpecialValueText("Forever")
+        return spinbox
+
+    def create_max_gap_spinbox(self, value):
+        spinbox = QSpinBox()
+        spinbox.setRange(0, 60000)
+        spinbox.setValue(value)
+        spinbox.setSuffix(" ms")
+        spinbox.setSpecialValueText("Off")
+        return spinbox
+
+    def create_name_list(self, model):
+        # Views over the registry's models; uniform rows let a long list
+        # lay out without measuring every name
+        view = QListView()
+        view.setUniformItemSizes(True)
+        view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        view.setModel(model)
+        return view
+
     def create_button_assignment_tab(self):
         tab = QWidget()
         layout = QVBoxLayout()
@@ -177,166 +303,470 @@ class TS4Windows(QMainWindow):
         button_layout = QGridLayout()
 
         buttons = ['left', 'right', 'middle', 'back', 'forward']
+        self.assignment_combos = []
         for i, button in enumerate(buttons):
             label = QLabel(f"{button.capitalize()} Button:")
             combo = QComboBox()
-            combo.addItem("None")
-            if self.current_profile:
-                combo.addItems(self.current_profile.macros.keys())
-            combo.setCurrentText(self.current_profile.button_assignments.get(button, "None") if self.current_profile else "None")
-            combo.currentTextChanged.connect(lambda text, btn=button: self.assign_macro_to_button(btn, text))
+            combo.setModel(self.registry.assignment_model)
+            combo.view().setUniformItemSizes(True)
+            combo.setProperty("button", button)
+            # Only a choice made by the user assigns; the combo's own index
+            # moving as the model changes doesn't
+            combo.textActivated.connect(lambda text, btn=button: self.assign_macro_to_button(btn, text))
+            self.assignment_combos.append(combo)
             button_layout.addWidget(label, i, 0)
             button_layout.addWidget(combo, i, 1)
 
         button_group.setLayout(button_layout)
         layout.addWidget(button_group)
+        self.update_button_assignments()
+
+        self.trigger_latency_label = QLabel()
+        layout.addWidget(self.trigger_latency_label)
+        self.latency_timer = QTimer(self)
+        self.latency_timer.timeout.connect(self.update_trigger_latency)
+        self.latency_timer.start(1000)
+        self.update_trigger_latency()
+
+        tab.setLayout(layout)
+        return tab
+
+    def create_stats_tab(self):
+        tab = QWidget()
+        layout = QVBoxLayout()
+
+        self.stats_checkbox = QCheckBox("Collect timing stats")
+        self.stats_checkbox.setToolTip("Time every playback step and listener callback. "
+                                       "Adds a little overhead to playback while on.")
+        self.stats_checkbox.toggled.connect(self.toggle_instrumentation)
+        layout.addWidget(self.stats_checkbox)
+
+        self.stats_label = QLabel("Timing stats are off")
+        self.stats_label.setStyleSheet("font-family: monospace")
+        self.stats_label.setAlignment(Qt.AlignmentFlag.AlignTop)
+        layout.addWidget(self.stats_label, 1)
+
+        run_layout = QHBoxLayout()
+        self.stats_run_combo = QComboBox()
+        run_layout.addWidget(self.stats_run_combo, 1)
+        export_json_button = QPushButton("Export JSON")
+        export_json_button.clicked.connect(lambda: self.export_run_stats('json'))
+        run_layout.addWidget(export_json_button)
+        export_csv_button = QPushButton("Export CSV")
+        export_csv_button.clicked.connect(lambda: self.export_run_stats('csv'))
+        run_layout.addWidget(export_csv_button)
+        reset_button = QPushButton("Reset")
+        reset_button.clicked.connect(self.reset_instrumentation)
+        run_layout.addWidget(reset_button)
+        layout.addLayout(run_layout)
+
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(500)
+        self.stats_timer.timeout.connect(self.update_stats_panel)
 
         tab.setLayout(layout)
         return tab
 
+    def toggle_instrumentation(self, enabled):
+        self.instrumentation = Instrumentation() if enabled else None
+        self.playback.instrumentation = self.instrumentation
+        if enabled:
+            self.stats_timer.start()
+            self.update_stats_panel()
+        else:
+            self.stats_timer.stop()
+            self.stats_label.setText("Timing stats are off")
+            self.stats_run_combo.clear()
+
+    def reset_instrumentation(self):
+        if self.instrumentation:
+            self.instrumentation.reset()
+            self.update_stats_panel()
+
+    def update_stats_panel(self):
+        if not self.instrumentation:
+            return
+        self.stats_label.setText(self.instrumentation.summary())
+        runs = self.instrumentation.finished_runs()
+        if self.stats_run_combo.count() != len(runs) or (runs and self.stats_run_combo.itemData(0) is not runs[-1]):
+            self.stats_run_combo.clear()
+            for trace in reversed(runs):
+                self.stats_run_combo.addItem(trace.title, trace)
+
+    def export_run_stats(self, kind):
+        trace = self.stats_run_combo.currentData()
+        if trace is None:
+            QMessageBox.information(self, "Export", "No finished macro runs to export yet.")
+            return
+        name = f"{trace.macro_name}-{trace.instance_id}.{kind}"
+        path, _ = QFileDialog.getSaveFileName(self, "Export Run Stats", name,
+                                              "JSON files (*.json)" if kind == 'json' else "CSV files (*.csv)")
+        if not path:
+            return
+        try:
+            if kind == 'json':
+                trace.write_json(path)
+            else:
+                trace.write_csv(path)
+        except OSError as e:
+            QMessageBox.warning(self, "Error", f"Could not export run stats: {e}")
+
     def assign_macro_to_button(self, button, macro_name):
         if self.current_profile:
-            if macro_name == "None":
+            if macro_name == NO_MACRO:
                 self.current_profile.button_assignments.pop(button, None)
             else:
                 self.current_profile.button_assignments[button] = macro_name
-            self.save_profiles()
+            self.triggers.compile(self.current_profile)
+            self.store.profile_changed()
 
     def create_new_profile(self):
         name, ok = QInputDialog.getText(self, "New Profile", "Enter profile name:")
         if ok and name:
+            if name in self.registry:
+                QMessageBox.warning(self, "New Profile", f"There already is a profile named {name}.")
+                return
             profile = Profile(name)
-            self.profiles.append(profile)
-            self.profile_list.addItem(name)
-            self.current_profile = profile
-            self.save_profiles()
+            self.registry.add_profile(profile)
+            self.select_profile(profile)
+            self.store.profile_changed()
+
+    def selected_profile(self):
+        return self.registry.profile(self.registry.profile_model.name(self.profile_list.currentIndex()))
+
+    def select_profile(self, profile):
+        self.current_profile = profile
+        self.registry.select(profile)
+        self.profile_list.setCurrentIndex(self.registry.profile_model.index_of(profile.name if profile else None))
+        self.update_button_assignments()
 
     def edit_profile(self):
-        selected_items = self.profile_list.selectedItems()
-        if not selected_items:
-            return
+        profile = self.selected_profile()
+        if profile is not None:
+            self.select_profile(profile)
 
-        profile_name = selected_items[0].text()
-        for profile in self.profiles:
-            if profile.name == profile_name:
-                self.current_profile = profile
-                self.macro_list.clear()
-                self.macro_list.addItems(profile.macros.keys())
-                self.update_button_assignments()
-                break
+    def rename_profile(self):
+        profile = self.selected_profile()
+        if profile is None:
+            return
+        name, ok = QInputDialog.getText(self, "Rename Profile", "Enter profile name:", text=profile.name)
+        if not ok or not name or name == profile.name:
+            return
+        if name in self.registry:
+            QMessageBox.warning(self, "Rename Profile", f"There already is a profile named {name}.")
+            return
+        old_name = profile.name
+        self.registry.rename_profile(profile, name)
+        self.store.profile_renamed(old_name, profile)
+
+    def show_library_report(self, title, message, reports):
+        box = QMessageBox(QMessageBox.Icon.Warning if any(not report.ok for report in reports)
+                          else QMessageBox.Icon.Information, title, message, parent=self)
+        box.setDetailedText("\n".join(report.summary() for report in reports))
+        box.exec()
+
+    def import_library(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "Import Macros", "", "Macro files (*.json *.t4m)")
+        if not paths:
+            return
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            reports = import_library(self.store, paths)
+        finally:
+            QApplication.restoreOverrideCursor()
+        # Imports add profiles and macros anywhere, so the registry starts over
+        current = self.current_profile
+        self.registry.reload()
+        if current is not None:
+            self.select_profile(current)
+        failed = sum(1 for report in reports if not report.ok)
+        self.show_library_report("Import Macros", f"Imported {sum(report.macros for report in reports)} macros "
+                                 f"from {len(paths)} files, {failed} with errors.", reports)
+
+    def export_library(self):
+        directory = QFileDialog.getExistingDirectory(self, "Export Profiles")
+        if not directory:
+            return
+        fmt, ok = QInputDialog.getItem(self, "Export Profiles", "Format:",
+                                       ["json", "t4m"], 0, False)
+        if not ok:
+            return
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            reports = export_library(self.store, self.profiles, directory, fmt)
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.show_library_report("Export Profiles", f"Exported {sum(report.macros for report in reports)} macros "
+                                 f"from {len(self.profiles)} profiles.", reports)
 
     def update_button_assignments(self):
-        assignment_tab = self.tabs.widget(2)
-        button_group = assignment_tab.findChild(QGroupBox)
-        if button_group:
-            for combo in button_group.findChildren(QComboBox):
-                combo.clear()
-                combo.addItem("None")
-                combo.addItems(self.current_profile.macros.keys())
-                button = combo.property("button")
-                if button:
-                    combo.setCurrentText(self.current_profile.button_assignments.get(button, "None"))
+        # Only the current entry of each combo changes, they all share the
+        # registry's model
+        assignments = self.current_profile.button_assignments if self.current_profile else {}
+        for combo in self.assignment_combos:
+            combo.setCurrentText(assignments.get(combo.property("button"), NO_MACRO))
+        self.triggers.compile(self.current_profile)
+
+    def update_trigger_latency(self):
+        self.trigger_latency_label.setText(f"Trigger latency: {self.playback.trigger_latency.summary()}")
 
     def delete_profile(self):
-        selected_items = self.profile_list.selectedItems()
-        if not selected_items:
+        profile = self.selected_profile()
+        if profile is None:
             return
-
-        profile_name = selected_items[0].text()
-        for profile in self.profiles:
-            if profile.name == profile_name:
-                self.profiles.remove(profile)
-                self.profile_list.takeItem(self.profile_list.row(selected_items[0]))
-                if self.current_profile == profile:
-                    self.current_profile = None
-                    self.macro_list.clear()
-                break
-        self.save_profiles()
+        self.registry.remove_profile(profile)
+        if self.current_profile is profile:
+            self.current_profile = None
+            self.update_button_assignments()
+        self.store.profile_removed(profile)
 
     def toggle_recording(self):
-        self.recording = not self.recording
-        if self.recording:
+        if not self.recording:
             name, ok = QInputDialog.getText(self, "New Macro", "Enter macro name:")
             if ok and name:
-                self.current_macro = Macro(name)
-                self.current_macro.delay = self.delay_spinbox.value()
-                self.current_macro.repeat = self.repeat_checkbox.isChecked()
-                self.current_macro.trigger_on_press = self.trigger_combo.currentText() == "On Press"
+                macro = Macro(name)
+                macro.delay = self.delay_spinbox.value()
+                macro.repeat = self.repeat_checkbox.isChecked()
+                macro.loops = self.loops_spinbox.value()
+                macro.trigger_on_press = self.trigger_combo.currentText() == "On Press"
+                macro.speed = self.speed_spinbox.value()
+                macro.max_gap = self.max_gap_spinbox.value()
+                self.recording_profile = self.current_profile
+                self.recording_log = None
+                if self.stream_checkbox.isChecked() and self.current_profile:
+                    try:
+                        self.recording_log = self.store.start_recording(self.current_profile, macro)
+                    except OSError as e:
+                        QMessageBox.warning(self, "Recording", f"Can't stream to disk, recording in memory: {e}")
+                self.recorder.start(macro, self.timing_checkbox.isChecked(),
+                                    self.move_tolerance_spinbox.value(), self.move_window_spinbox.value(),
+                                    self.recording_log)
+                self.recording = True
+                self.record_timer.start()
         else:
-            self.save_macro()
+            self.recording = False
+            self.record_timer.stop()
+            try:
+                self.current_macro = self.recorder.stop()
+            except OSError as e:
+                # The rows the log didn't get are saved as the macro and
+                # the log is left for recovery
+                self.store.abandon_recording(self.recording_log)
+                self.recorder.detach_log()
+                self.recording_log = None
+                self.current_macro = self.recorder.stop()
+                QMessageBox.warning(self, "Recording", f"Could not finish writing the recording: {e}\n"
+                                    "What reached the disk will be recovered from its log on the next "
+                                    "start; the rest is saved as this macro.")
+            message = f"Recorded {self.recorder.queued} events, {self.recorder.dropped} dropped"
+            if self.recorder.removed:
+                message += f", removed {self.recorder.removed} redundant mouse moves"
+            self.statusBar().showMessage(message)
+            if self.recording_log is not None:
+                self.finish_recording_log()
+            else:
+                self.save_macro()
+
+    def finish_recording_log(self):
+        log, self.recording_log = self.recording_log, None
+        profile, macro = self.recording_profile, self.current_macro
+        self.current_macro = None
+        self.registry.add_macro(profile, macro)
+        try:
+            self.store.finish_recording(profile, macro, log)
+        except OSError as e:
+            QMessageBox.warning(self, "Recording", f"Could not write {macro.name}: {e}\n"
+                                "It will be recovered from its log on the next start.")
+        self.update_button_assignments()
 
+    def drain_recording(self):
+        try:
+            self.recorder.drain()
+        except OSError as e:
+            # Keep recording in memory; what reached the log is recovered
+            # on the next start
+            self.store.abandon_recording(self.recording_log)
+            self.recorder.detach_log()
+            self.recording_log = None
+            QMessageBox.warning(self, "Recording", f"Stopped streaming to disk: {e}")
+        self.statusBar().showMessage(f"Recording: {self.recorder.queued} events, "
+                                     f"{self.recorder.dropped} dropped, {self.recorder.pending} queued")
+
+    @timed_callback('click')
     def on_click(self, x, y, button, pressed):
-        if self.recording and self.current_macro:
-            self.current_macro.actions.append(Action('click', button=button, x=x, y=y, delay=self.current_macro.delay))
+        if self.recording:
+            self.recorder.on_click(x, y, button, pressed)
+        else:
+            self.triggers.on_click(button, pressed)
 
+    @timed_callback('move')
     def on_move(self, x, y):
-        if self.recording and self.current_macro:
-            self.current_macro.actions.append(Action('move', x=x, y=y, delay=self.current_macro.delay))
+        if self.recording:
+            self.recorder.on_move(x, y)
 
+    @timed_callback('press')
     def on_key_press(self, key):
-        if self.recording and self.current_macro:
-            self.current_macro.actions.append(Action('key_press', button=key, delay=self.current_macro.delay))
+        if self.recording:
+            self.recorder.on_key_press(key)
+        else:
+            self.triggers.on_key(key, True)
 
+    @timed_callback('release')
     def on_key_release(self, key):
-        if self.recording and self.current_macro:
-            self.current_macro.actions.append(Action('key_release', button=key, delay=self.current_macro.delay))
+        if self.recording:
+            self.recorder.on_key_release(key)
+        else:
+            self.triggers.on_key(key, False)
 
     def save_macro(self):
         if self.current_macro and self.current_profile:
-            self.current_profile.macros[self.current_macro.name] = self.current_macro
-            self.macro_list.addItem(self.current_macro.name)
+            self.registry.add_macro(self.current_profile, self.current_macro)
+            self.store.macro_changed(self.current_profile, self.current_macro)
             self.current_macro = None
-            self.save_profiles()
             self.update_button_assignments()
 
-    def play_macro(self):
-        selected_items = self.macro_list.selectedItems()
-        if not selected_items or not self.current_profile:
+    def optimize_macro(self):
+        macro = self.selected_macro()
+        if not macro:
+            return
+        macro_name = macro.name
+
+        before = len(macro.actions)
+        macro.actions, removed = optimize_actions(macro.actions,
+                                                  self.move_tolerance_spinbox.value() or DEFAULT_TOLERANCE,
+                                                  self.move_window_spinbox.value())
+        self.triggers.compile(self.current_profile)
+        self.store.macro_changed(self.current_profile, macro)
+        QMessageBox.information(self, "Optimize Macro",
+                                f"Removed {removed} of {before} actions from {macro_name}.")
+
+    def analyze_macro(self):
+        macro = self.selected_macro()
+        if not macro:
+            return
+        analysis = get_analysis(macro)
+        if analysis.held:
+            QMessageBox.warning(self, "Analyze Macro", analysis.summary())
+        else:
+            QMessageBox.information(self, "Analyze Macro", analysis.summary())
+
+    def selected_macro(self):
+        name = self.registry.macro_model.name(self.macro_list.currentIndex())
+        if name is None or not self.current_profile:
+            return None
+        return self.current_profile.macros.get(name)
+
+    def rename_macro(self):
+        macro = self.selected_macro()
+        if not macro:
             return
+        name, ok = QInputDialog.getText(self, "Rename Macro", "Enter macro name:", text=macro.name)
+        if not ok or not name or name == macro.name:
+            return
+        if name in self.current_profile.macros:
+            QMessageBox.warning(self, "Rename Macro", f"There already is a macro named {name}.")
+            return
+        old_name = macro.name
+        self.registry.rename_macro(self.current_profile, macro, name)
+        self.store.macro_renamed(self.current_profile, old_name, macro)
+        self.update_button_assignments()
 
-        macro_name = selected_items[0].text()
-        macro = self.current_profile.macros.get(macro_name)
+    def delete_macro(self):
+        macro = self.selected_macro()
         if not macro:
             return
+        instance = self.playback.find(macro)
+        if instance:
+            self.playback.cancel(instance)
+        self.registry.remove_macro(self.current_profile, macro.name)
+        self.store.macro_removed(self.current_profile, macro.name)
+        self.update_button_assignments()
 
-        self.current_macro = macro
-        self.current_macro_index = 0
-        self.execute_macro_step()
+    def play_macro(self):
+        macro = self.selected_macro()
+        instance = self.playback.find(macro) if macro else None
 
-    def execute_macro_step(self):
-        if self.current_macro_index >= len(self.current_macro.actions):
-            if self.current_macro.repeat:
-                self.current_macro_index = 0
+        if QApplication.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier:
+            if instance:
+                self.playback.cancel(instance)
             else:
-                self.macro_timer.stop()
-                return
+                self.playback.stop()
+            return
 
-        action = self.current_macro.actions[self.current_macro_index]
-        if action.type == 'move':
-            self.mouse.position = (action.x, action.y)
-        elif action.type == 'click':
-            self.mouse.position = (action.x, action.y)
-            if action.button:
-                self.mouse.click(action.button)
-        elif action.type == 'key_press':
-            self.keyboard.press(action.button)
-        elif action.type == 'key_release':
-            self.keyboard.release(action.button)
-        elif action.type == 'scroll':
-            self.mouse.scroll(0, action.scroll_amount)
-
-        self.current_macro_index += 1
-        self.macro_timer.start(action.delay)
+        if instance is None:
+            if macro:
+                view = self.view_combo.currentData()
+                self.playback.play(macro, view=view if view in macro.views else None)
+        elif instance.state == PLAYING:
+            self.playback.pause(instance)
+        else:
+            self.playback.resume(instance)
+        self.update_play_button()
+
+    def update_view_combo(self):
+        macro = self.selected_macro()
+        self.view_combo.clear()
+        self.view_combo.addItem("None", None)
+        if macro:
+            for name, stages in sorted(macro.views.items()):
+                self.view_combo.addItem(name, name)
+                self.view_combo.setItemData(self.view_combo.count() - 1, format_view(stages),
+                                            Qt.ItemDataRole.ToolTipRole)
+
+    def update_play_button(self):
+        macro = self.selected_macro()
+        instance = self.playback.find(macro) if macro else None
+        if instance is None:
+            self.play_button.setText("Play Macro")
+        elif instance.state == PLAYING:
+            self.play_button.setText("Pause Macro")
+        else:
+            self.play_button.setText("Resume Macro")
+
+    def set_injector_worker(self, enabled):
+        # Swap schedulers; whatever is playing is stopped first
+        key_policy = self.key_policy_combo.currentData()
+        self.playback.close()
+        playback = None
+        if enabled:
+            try:
+                playback = RemoteScheduler(on_finished=self.playback_finished.emit, key_policy=key_policy,
+                                           on_status=self.injector_status.emit)
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, "Injector Worker", f"Could not start the injector process: {e}")
+                self.worker_checkbox.blockSignals(True)
+                self.worker_checkbox.setChecked(False)
+                self.worker_checkbox.blockSignals(False)
+        if playback is None:
+            playback = MacroScheduler(self.injector, on_finished=self.playback_finished.emit,
+                                      key_policy=key_policy, instrumentation=self.instrumentation)
+        self.playback = playback
+        self.triggers.playback = playback
+        if self.current_profile:
+            self.triggers.compile(self.current_profile)
+        self.update_play_button()
 
-    def edit_macro(self):
-        selected_items = self.macro_list.selectedItems()
-        if not selected_items or not self.current_profile:
-            return
+    def on_injector_status(self, message):
+        self.statusBar().showMessage(message)
+        if isinstance(self.playback, RemoteScheduler) and not self.playback.alive:
+            # Fall back to injecting from this process
+            self.worker_checkbox.setChecked(False)
+
+    def on_store_error(self, error):
+        # The store keeps the changes and tries again
+        self.statusBar().showMessage(f"Could not save changes, retrying: {error}")
+
+    def on_playback_finished(self, report):
+        self.update_play_button()
+        self.statusBar().showMessage(report.summary())
+        self.update_trigger_latency()
+        self.update_stats_panel()
 
-        macro_name = selected_items[0].text()
-        macro = self.current_profile.macros.get(macro_name)
+    def edit_macro(self):
+        macro = self.selected_macro()
         if not macro:
             return
+        macro_name = macro.name
 
         dialog = QDialog(self)
         dialog.setWindowTitle(f"Edit Macro: {macro_name}")
@@ -353,26 +783,125 @@ class TS4Windows(QMainWindow):
         repeat_checkbox.setChecked(macro.repeat)
         layout.addWidget(repeat_checkbox)
 
+        loops_spinbox = self.create_loops_spinbox(macro.loops)
+        layout.addWidget(QLabel("Repeat count:"))
+        layout.addWidget(loops_spinbox)
+
+        priority_spinbox = QSpinBox()
+        priority_spinbox.setRange(-100, 100)
+        priority_spinbox.setValue(macro.priority)
+        layout.addWidget(QLabel("Priority:"))
+        layout.addWidget(priority_spinbox)
+
         trigger_combo = QComboBox()
         trigger_combo.addItems(["On Press", "On Release"])
         trigger_combo.setCurrentText("On Press" if macro.trigger_on_press else "On Release")
         layout.addWidget(QLabel("Trigger macro:"))
         layout.addWidget(trigger_combo)
 
-        action_list = QListWidget()
-        for action in macro.actions:
-            action_list.addItem(f"{action.type}: {action.button if action.button else ''} "
-                                f"{'x=' + str(action.x) + ' y=' + str(action.y) if action.x is not None else ''} "
-                                f"{'scroll=' + str(action.scroll_amount) if action.scroll_amount is not None else ''} "
-                                f"delay={action.delay}")
-
-        layout.addWidget(QLabel("Actions:"))
-        layout.addWidget(action_list)
+        speed_spinbox = self.create_speed_spinbox(macro.speed)
+        layout.addWidget(QLabel("Playback speed:"))
+        layout.addWidget(speed_spinbox)
+
+        max_gap_spinbox = self.create_max_gap_spinbox(macro.max_gap)
+        layout.addWidget(QLabel("Compress idle gaps to:"))
+        layout.addWidget(max_gap_spinbox)
+
+        views = dict(macro.views)
+        views_list = QListWidget()
+        views_list.setMaximumHeight(80)
+        fill_views = lambda: (views_list.clear(),
+                              views_list.addItems(f"{name}: {format_view(stages)}" for name, stages in sorted(views.items())))
+        fill_views()
+        layout.addWidget(QLabel("Views:"))
+        layout.addWidget(views_list)
+        view_layout = QHBoxLayout()
+        add_view_button = QPushButton("Add View")
+        add_view_button.clicked.connect(lambda: self.edit_view(views) and fill_views())
+        view_layout.addWidget(add_view_button)
+        edit_view_button = QPushButton("Edit View")
+        edit_view_button.clicked.connect(
+            lambda: views_list.currentItem() and self.edit_view(views, views_list.currentItem().text().split(':')[0])
+            and fill_views())
+        view_layout.addWidget(edit_view_button)
+        remove_view_button = QPushButton("Remove View")
+        remove_view_button.clicked.connect(
+            lambda: views_list.currentItem() and views.pop(views_list.currentItem().text().split(':')[0], None)
+            and fill_views())
+        view_layout.addWidget(remove_view_button)
+        layout.addLayout(view_layout)
+
+        action_model = ActionListModel(macro.actions, dialog)
+        # A one column table rather than a QListView: with fixed row
+        # heights it only ever touches the visible rows, where QListView
+        # lays out every row up front
+        action_view = QTableView()
+        action_view.horizontalHeader().hide()
+        action_view.horizontalHeader().setStretchLastSection(True)
+        action_view.verticalHeader().hide()
+        action_view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        action_view.setShowGrid(False)
+        action_view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        action_view.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        action_view.setModel(action_model)
+        action_view.doubleClicked.connect(lambda: self.edit_action(action_view, macro))
+
+        stats_label = QLabel()
+        update_stats = lambda: stats_label.setText(self.action_stats_text(macro, action_model))
+        update_stats()
+        layout.addWidget(stats_label)
+
+        filter_layout = QHBoxLayout()
+        type_filter = QComboBox()
+        type_filter.addItem("All actions", None)
+        for code, name in enumerate(ACTION_TYPES):
+            type_filter.addItem(name, code)
+        filter_layout.addWidget(type_filter)
+        area_checkbox = QCheckBox("Only in area")
+        filter_layout.addWidget(area_checkbox)
+        area_spinboxes = []
+        stats = macro.stats
+        for value in stats.bbox or (0, 0, 0, 0):
+            spinbox = QSpinBox()
+            spinbox.setRange(-10000, 10000)
+            spinbox.setValue(value)
+            area_spinboxes.append(spinbox)
+            filter_layout.addWidget(spinbox)
+        layout.addLayout(filter_layout)
+
+        def apply_filter():
+            code = type_filter.currentData()
+            area = tuple(spinbox.value() for spinbox in area_spinboxes) if area_checkbox.isChecked() else None
+            action_model.set_filter(None if code is None else (code,), area)
+            update_stats()
+
+        type_filter.currentIndexChanged.connect(apply_filter)
+        area_checkbox.toggled.connect(apply_filter)
+        for spinbox in area_spinboxes:
+            spinbox.valueChanged.connect(lambda: area_checkbox.isChecked() and apply_filter())
+        layout.addWidget(action_view)
 
         edit_action_button = QPushButton("Edit Action")
-        edit_action_button.clicked.connect(lambda: self.edit_action(action_list, macro))
+        edit_action_button.clicked.connect(lambda: self.edit_action(action_view, macro))
         layout.addWidget(edit_action_button)
 
+        call_button = QPushButton("Insert Sub-macro")
+        call_button.setToolTip("Play another macro of this profile after the selected action")
+        call_button.clicked.connect(lambda: self.insert_sub_macro(action_view, macro) and update_stats())
+        layout.addWidget(call_button)
+
+        bulk_layout = QHBoxLayout()
+        shift_button = QPushButton("Shift Delays")
+        shift_button.clicked.connect(lambda: self.bulk_edit_actions(action_view, macro, 'shift') and update_stats())
+        bulk_layout.addWidget(shift_button)
+        offset_button = QPushButton("Offset Coordinates")
+        offset_button.clicked.connect(lambda: self.bulk_edit_actions(action_view, macro, 'offset') and update_stats())
+        bulk_layout.addWidget(offset_button)
+        delete_moves_button = QPushButton("Delete All Moves")
+        delete_moves_button.clicked.connect(lambda: self.bulk_edit_actions(action_view, macro, 'delete_moves') and update_stats())
+        bulk_layout.addWidget(delete_moves_button)
+        layout.addLayout(bulk_layout)
+
         button_box = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel)
         button_box.accepted.connect(dialog.accept)
         button_box.rejected.connect(dialog.reject)
@@ -383,15 +912,112 @@ class TS4Windows(QMainWindow):
         if dialog.exec() == QDialog.DialogCode.Accepted:
             macro.delay = delay_spinbox.value()
             macro.repeat = repeat_checkbox.isChecked()
+            macro.loops = loops_spinbox.value()
+            macro.priority = priority_spinbox.value()
             macro.trigger_on_press = trigger_combo.currentText() == "On Press"
-            self.save_profiles()
-
-    def edit_action(self, action_list, macro):
-        selected_items = action_list.selectedItems()
-        if not selected_items:
+            macro.speed = speed_spinbox.value()
+            macro.max_gap = max_gap_spinbox.value()
+            macro.views = views
+            macro.invalidate_plan()
+            self.triggers.compile(self.current_profile)
+            self.store.profile_changed()
+            self.update_view_combo()
+
+    def edit_view(self, views, name=None):
+        if name is None:
+            name, ok = QInputDialog.getText(self, "Add View", "View name:")
+            if not ok or not name:
+                return False
+        text = format_view(views.get(name, []))
+        while True:
+            text, ok = QInputDialog.getText(
+                self, f"View: {name}",
+                "Stages, separated by |\n"
+                "offset DX DY, scale SX [SY [OX OY]], speed FACTOR, keep TYPES, drop TYPES, loop N, then MACROS",
+                text=text)
+            if not ok:
+                return False
+            try:
+                views[name] = parse_view(text)
+                return True
+            except ValueError as e:
+                QMessageBox.warning(self, "Error", f"Invalid view: {e}")
+
+    def action_stats_text(self, macro, action_model):
+        stats = macro.stats
+        bbox = f", area {stats.bbox[0]},{stats.bbox[1]} to {stats.bbox[2]},{stats.bbox[3]}" if stats.bbox else ""
+        shown = f", {action_model.rowCount()} shown" if action_model.filtered else ""
+        return f"Actions: {stats.count}, {stats.duration / 1000:.3f} s recorded{bbox}{shown}"
+
+    def selected_action_rows(self, action_view):
+        # Model rows of the selection, or None for every visible row
+        ranges = action_view.selectionModel().selection()
+        if ranges.isEmpty():
+            return None
+        rows = set()
+        for selection_range in ranges:
+            rows.update(range(selection_range.top(), selection_range.bottom() + 1))
+        return sorted(rows)
+
+    def bulk_edit_actions(self, action_view, macro, operation):
+        action_model = action_view.model()
+        rows = self.selected_action_rows(action_view)
+        count = action_model.rowCount() if rows is None else len(rows)
+        if not count:
+            return False
+
+        if operation == 'shift':
+            amount, ok = QInputDialog.getDouble(self, "Shift Delays", f"Add to the delay of {count} actions (ms):",
+                                                0, -600000, 600000, 3)
+            if not ok or not amount:
+                return False
+            action_model.shift_delays(amount, rows)
+        elif operation == 'offset':
+            text, ok = QInputDialog.getText(self, "Offset Coordinates", f"Move {count} actions by x,y:", text="0,0")
+            if not ok:
+                return False
+            try:
+                dx, dy = (int(value) for value in text.split(','))
+            except ValueError:
+                QMessageBox.warning(self, "Error", "Enter the offset as two whole numbers, e.g. 10,-5")
+                return False
+            action_model.offset_positions(dx, dy, rows)
+        elif operation == 'delete_moves':
+            if not action_model.delete_moves(rows):
+                return False
+            action_view.clearSelection()
+
+        macro.invalidate_plan()
+        self.triggers.compile(self.current_profile)
+        self.store.macro_changed(self.current_profile, macro)
+        return True
+
+    def insert_sub_macro(self, action_view, macro):
+        names = [name for name in self.current_profile.macros if name != macro.name]
+        if not names:
+            QMessageBox.information(self, "Insert Sub-macro", "This profile has no other macros to call.")
+            return False
+        name, ok = QInputDialog.getItem(self, "Insert Sub-macro", "Macro to play:", names, 0, False)
+        if not ok:
+            return False
+
+        action_model = action_view.model()
+        current = action_view.currentIndex()
+        index = action_model.source_row(current.row()) + 1 if current.isValid() else len(macro.actions)
+        macro.actions.insert(index, Action('call', button=name, delay=0))
+        action_model.refresh()
+        macro.invalidate_plan()
+        self.triggers.compile(self.current_profile)
+        self.store.macro_changed(self.current_profile, macro)
+        return True
+
+    def edit_action(self, action_view, macro):
+        current = action_view.currentIndex()
+        if not current.isValid():
             return
 
-        index = action_list.row(selected_items[0])
+        action_model = action_view.model()
+        index = action_model.source_row(current.row())
         action = macro.actions[index]
 
         dialog = QDialog(self)
@@ -399,12 +1025,12 @@ class TS4Windows(QMainWindow):
         layout = QVBoxLayout()
 
         action_type_combo = QComboBox()
-        action_type_combo.addItems(['move', 'click', 'key_press', 'key_release', 'scroll'])
+        action_type_combo.addItems(ACTION_TYPES)
         action_type_combo.setCurrentText(action.type)
         layout.addWidget(QLabel("Action Type:"))
         layout.addWidget(action_type_combo)
 
-        button_input = QLineEdit(str(action.button) if action.button else '')
+        button_input = QLineEdit(button_to_str(action.button) or '')
         layout.addWidget(QLabel("Button:"))
         layout.addWidget(button_input)
 
@@ -426,8 +1052,9 @@ class TS4Windows(QMainWindow):
         layout.addWidget(QLabel("Scroll Amount:"))
         layout.addWidget(scroll_input)
 
-        delay_input = QSpinBox()
-        delay_input.setRange(0, 10000)
+        delay_input = QDoubleSpinBox()
+        delay_input.setDecimals(3)
+        delay_input.setRange(0, 600000)
         delay_input.setValue(action.delay)
         delay_input.setSuffix(" ms")
         layout.addWidget(QLabel("Delay:"))
@@ -442,57 +1069,32 @@ class TS4Windows(QMainWindow):
 
         if dialog.exec() == QDialog.DialogCode.Accepted:
             action.type = action_type_combo.currentText()
-            action.button = button_input.text() if button_input.text() else None
+            action.button = button_from_str(button_input.text()) if button_input.text() else None
             action.x = x_input.value() if action.type in ['move', 'click'] else None
             action.y = y_input.value() if action.type in ['move', 'click'] else None
             action.scroll_amount = scroll_input.value() if action.type == 'scroll' else None
             action.delay = delay_input.value()
-
-            action_list.item(index).setText(f"{action.type}: {action.button if action.button else ''} "
-                                            f"{'x=' + str(action.x) + ' y=' + str(action.y) if action.x is not None else ''} "
-                                            f"{'scroll=' + str(action.scroll_amount) if action.scroll_amount is not None else ''} "
-                                            f"delay={action.delay}")
-            self.save_profiles()
+            macro.actions[index] = action
+            macro.invalidate_plan()
+            self.triggers.compile(self.current_profile)
+            action_model.rows_changed(current.row(), current.row())
+            self.store.macro_changed(self.current_profile, macro)
 
     def save_profiles(self):
-        data = []
-        for profile in self.profiles:
-            profile_data = {
-                'name': profile.name,
-                'macros': {},
-                'button_assignments': profile.button_assignments
-            }
-            for macro_name, macro in profile.macros.items():
-                profile_data['macros'][macro_name] = {
-                    'actions': [vars(action) for action in macro.actions],
-                    'repeat': macro.repeat,
-                    'trigger_on_press': macro.trigger_on_press,
-                    'delay': macro.delay
-                }
-            data.append(profile_data)
-
-        with open('ts4windows_profiles.json', 'w') as f:
-            json.dump(data, f)
+        try:
+            self.store.flush()
+        except OSError as e:
+            QMessageBox.warning(self, "Save Profiles", f"Could not save changes: {e}")
 
     def load_profiles(self):
-        try:
-            with open('ts4windows_profiles.json', 'r') as f:
-                data = json.load(f)
-
-            for profile_data in data:
-                profile = Profile(profile_data['name'])
-                for macro_name, macro_data in profile_data['macros'].items():
-                    macro = Macro(macro_name)
-                    macro.actions = [Action(**action_data) for action_data in macro_data['actions']]
-                    macro.repeat = macro_data['repeat']
-                    macro.trigger_on_press = macro_data['trigger_on_press']
-                    macro.delay = macro_data.get('delay', 10)  # Default to 10ms if not specified
-                    profile.macros[macro_name] = macro
-                profile.button_assignments = profile_data.get('button_assignments', {})
-                self.profiles.append(profile)
-                self.profile_list.addItem(profile.name)
-        except FileNotFoundError:
-            pass
+        self.store.load()
+        self.registry.reload()
+        self.current_profile = None
+        self.update_button_assignments()
+        if self.store.recovered:
+            names = "\n".join(f"{profile.name}: {macro.name}" for profile, macro in self.store.recovered)
+            QMessageBox.information(self, "Recovered Recordings",
+                                    f"Recordings that were not finished have been saved as:\n{names}")
 
     def show_login(self):
         dialog = LoginDialog(self)
@@ -526,7 +1128,17 @@ class TS4Windows(QMainWindow):
         self.save_users()
 
     def closeEvent(self, event):
-        self.save_profiles()
+        if self.recording:
+            self.toggle_recording()
+        try:
+            self.store.close()
+        except OSError as e:
+            answer = QMessageBox.question(self, "Save Profiles",
+                                          f"Could not save changes: {e}\nQuit anyway and lose them?")
+            if answer != QMessageBox.StandardButton.Yes:
+                event.ignore()
+                return
+        self.playback.close()
         self.mouse_listener.stop()
         self.keyboard_listener.stop()
         event.accept()